@@ -0,0 +1,54 @@
+"""
+Compares the original `argmax` loop with the greedy and optimal solvers of `sticky_pi_ml.assignment`,
+on random n x n score matrices that are either dense or sparse (as after candidate gating).
+Usage: python benchmark_assignment.py
+"""
+
+import time
+
+import numpy as np
+
+from sticky_pi_ml.assignment import assign
+
+SIZES = [10, 30, 100, 300, 1000, 2000]
+DENSITIES = [1.0, 0.02]
+# the argmax loop gets really slow for large matrices
+MAX_SIZE_ARGMAX_LOOP = 1000
+
+
+def argmax_loop(arr):
+    arr = np.copy(arr)
+    out = []
+    while np.sum(arr) > 0:
+        i, j = np.unravel_index(arr.argmax(), arr.shape)
+        out.append((i, j, arr[i, j]))
+        arr[i, :] = 0
+        arr[:, j] = 0
+    return out
+
+
+def timed(function, arr):
+    start = time.perf_counter()
+    out = function(arr)
+    return time.perf_counter() - start, out
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(1)
+    print('%6s %8s %12s %12s %12s %14s' % ('n', 'density', 'argmax (ms)', 'greedy (ms)', 'optimal (ms)',
+                                           'optimal/greedy'))
+    for density in DENSITIES:
+        for n in SIZES:
+            arr = rng.random_sample((n, n)) * (rng.random_sample((n, n)) < density)
+            t_greedy, greedy = timed(lambda a: assign(a, 'greedy'), arr)
+            t_optimal, optimal = timed(lambda a: assign(a, 'optimal'), arr)
+            if n <= MAX_SIZE_ARGMAX_LOOP:
+                t_loop, loop = timed(argmax_loop, arr)
+                assert loop == greedy
+                t_loop = '%12.2f' % (t_loop * 1000)
+            else:
+                t_loop = '%12s' % 'NA'
+            # total score gain of the optimal assignment
+            gain = sum(s for _, _, s in optimal) / sum(s for _, _, s in greedy)
+            print('%6i %8.2f %s %12.2f %12.2f %14.3f' % (n, density, t_loop, t_greedy * 1000, t_optimal * 1000,
+                                                         gain))
@@ -0,0 +1,78 @@
+"""
+Compares the assembly of drafted tuboids (the groups of annotations linked across consecutive frames)
+with a networkx graph, as `Matcher._draft_graph` used to do, and with the edge arrays of `_draft_components`.
+Frames and matches are synthetic: each frame has N_ANNOTATIONS annotations and most are matched in the next frame.
+Usage: python benchmark_graph_assembly.py
+"""
+
+import time
+import tracemalloc
+
+import networkx as nx
+import numpy as np
+
+from sticky_pi_ml.siamese_insect_matcher.matcher import _draft_components
+
+N_FRAMES = [100, 1000, 5000]
+N_ANNOTATIONS = 100
+MATCH_PROBABILITY = 0.9
+
+
+class FakeAnnotation(object):
+    def __init__(self, frame, index):
+        self.frame = frame
+        self.index = index
+
+
+def make_frames(n_frames, rng):
+    frames = [[FakeAnnotation(f, i) for i in range(N_ANNOTATIONS)] for f in range(n_frames)]
+    all_edges = []
+    for _ in range(n_frames - 1):
+        j0 = np.flatnonzero(rng.random_sample(N_ANNOTATIONS) < MATCH_PROBABILITY)
+        j1 = rng.permutation(N_ANNOTATIONS)[:len(j0)]
+        all_edges.append([(a, b, 1.0) for a, b in zip(j0.tolist(), j1.tolist())])
+    return frames, all_edges
+
+
+def networkx_assembly(frames, all_edges):
+    dg = nx.DiGraph()
+    for i, edges in enumerate(all_edges):
+        dg.add_weighted_edges_from([('%i|%i' % (i, a), '%i|%i' % (i + 1, b), s) for a, b, s in edges], stitched=False)
+        for f in (i, i + 1):
+            for m, a in enumerate(frames[f]):
+                k = '%i|%i' % (f, m)
+                if k not in dg.nodes:
+                    dg.add_node(k)
+                dg.nodes[k].update({'annotation': a})
+    return [[nd[1]['annotation'] for nd in dg.subgraph(sub_graph).nodes(data=True)]
+            for sub_graph in nx.weakly_connected_components(dg)]
+
+
+def array_assembly(frames, all_edges):
+    annotations = [a for f in frames for a in f]
+    return [[annotations[k] for k in nodes] for nodes in _draft_components([len(f) for f in frames], all_edges)]
+
+
+def measure(function, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    out = function(*args)
+    duration = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return out, duration, peak
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(1)
+    print('%8s %12s %14s %14s %14s %14s' % ('frames', 'annotations', 'networkx (s)', 'arrays (s)',
+                                            'networkx (MB)', 'arrays (MB)'))
+    for n_frames in N_FRAMES:
+        frames, all_edges = make_frames(n_frames, rng)
+        nx_groups, nx_time, nx_peak = measure(networkx_assembly, frames, all_edges)
+        groups, time_, peak = measure(array_assembly, frames, all_edges)
+        # the same groups, in the same order (annotations are then sorted by time in tuboids)
+        assert [sorted((a.frame, a.index) for a in g) for g in nx_groups] == \
+               [sorted((a.frame, a.index) for a in g) for g in groups]
+        print('%8i %12i %14.2f %14.2f %14.1f %14.1f' % (n_frames, n_frames * N_ANNOTATIONS, nx_time, time_,
+                                                        nx_peak / 1e6, peak / 1e6))
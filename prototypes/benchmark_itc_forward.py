@@ -0,0 +1,59 @@
+"""
+Compares the throughput of the insect tuboid classifier (ResNetPlus, resnet-50, random weights) on CPU,
+in inference mode, with one resnet pass per shot (`_forward_per_shot`) and with all shots in a single pass
+(`_forward_impl`), in the default and channels-last (CL) memory formats, and with at most
+MAX_IMAGES_PER_PASS images per pass.
+Usage: python benchmark_itc_forward.py [n_threads]
+"""
+
+import sys
+import time
+
+import torch
+
+from sticky_pi_ml.insect_tuboid_classifier.model import make_resnet
+
+BATCH_SIZES = [1, 4, 8]
+N_SHOTS = 6
+N_CLASSES = 3
+N_REPEATS = 3
+MAX_IMAGES_PER_PASS = 8
+
+
+def make_inputs(batch_size):
+    return {'array': torch.randn(batch_size, N_SHOTS, 3, 224, 224),
+            'scale': torch.rand(batch_size, N_SHOTS, 1)}
+
+
+def measure(function, inputs):
+    with torch.inference_mode():
+        # warm up
+        out = function(inputs)
+        start = time.perf_counter()
+        for _ in range(N_REPEATS):
+            function(inputs)
+    return out, (time.perf_counter() - start) / N_REPEATS
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        torch.set_num_threads(int(sys.argv[1]))
+    torch.manual_seed(1)
+    model = make_resnet(pretrained=False, n_classes=N_CLASSES).eval()
+    model_cl = make_resnet(pretrained=False, n_classes=N_CLASSES, channels_last=True).eval()
+    model_cl.load_state_dict(model.state_dict())
+
+    print('%6s %14s %14s %14s %18s %14s' % ('batch', 'per shot', 'fused', 'fused + CL',
+                                            'fused + CL (%i/pass)' % MAX_IMAGES_PER_PASS, 'max abs diff'))
+    for batch_size in BATCH_SIZES:
+        inputs = make_inputs(batch_size)
+        ref, t_ref = measure(model._forward_per_shot, inputs)
+        out, t_fused = measure(model, inputs)
+        out_cl, t_cl = measure(model_cl, inputs)
+        model_cl.max_images_per_pass = MAX_IMAGES_PER_PASS
+        out_cl_k, t_cl_k = measure(model_cl, inputs)
+        model_cl.max_images_per_pass = None
+        diff = max((ref - o).abs().max().item() for o in (out, out_cl, out_cl_k))
+        # in tuboids per second
+        print('%6i %14.2f %14.2f %14.2f %18.2f %14.2e' % (batch_size, batch_size / t_ref, batch_size / t_fused,
+                                                         batch_size / t_cl, batch_size / t_cl_k, diff))
@@ -0,0 +1,59 @@
+"""
+Compares the straight-polygon fast path of `SVGImage._svg_path_to_contour` with the generic svgpathtools parser.
+Test SVGs are re-written with `Image.to_svg`, so their paths are the `M x,y ... Z` polygons we produce in practice.
+Usage: python benchmark_svg_path_parsing.py [SVG_DIR]
+"""
+
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from sticky_pi_ml.image import SVGImage
+
+DEFAULT_SVG_DIR = os.path.join(os.path.dirname(__file__), '..', 'src', 'sticky_pi_ml', 'tests',
+                               'ml_bundles', 'universal-insect-detector', 'data')
+N_REPEATS = 5
+
+
+def time_parser(parser, paths):
+    start = time.perf_counter()
+    for _ in range(N_REPEATS):
+        out = [parser(p) for p in paths]
+    return (time.perf_counter() - start) / N_REPEATS, out
+
+
+if __name__ == '__main__':
+    svg_dir = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SVG_DIR
+    tmp_dir = tempfile.mkdtemp(prefix='sticky_pi_bench_')
+    try:
+        images = []
+        for f in sorted(glob.glob(os.path.join(svg_dir, '*.svg'))):
+            target = os.path.join(tmp_dir, os.path.basename(f))
+            SVGImage(f, foreign=True).to_svg(target)
+            im = SVGImage(target, foreign=True, skip_annotations=True)
+            images.append((im, im._parse_svg()['paths']))
+
+        n_paths = sum(len(paths) for _, paths in images)
+        results = {}
+        for name in ['_svg_path_to_contour', '_svgpathtools_path_to_contour']:
+            total, contours = 0, []
+            for im, paths in images:
+                t, out = time_parser(getattr(im, name), paths)
+                total += t
+                contours.extend(out)
+            results[name] = (total, contours)
+
+        fast, fast_contours = results['_svg_path_to_contour']
+        slow, slow_contours = results['_svgpathtools_path_to_contour']
+        for f, s in zip(fast_contours, slow_contours):
+            assert len(f) == len(s) and all(np.array_equal(a, b) for a, b in zip(f, s))
+
+        print(f'{len(images)} images, {n_paths} paths')
+        print(f'svgpathtools: {slow * 1000:.1f} ms, fast path: {fast * 1000:.1f} ms, speedup: {slow / fast:.1f}x')
+    finally:
+        shutil.rmtree(tmp_dir)
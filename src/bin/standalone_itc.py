@@ -8,6 +8,7 @@ from sticky_pi_ml.insect_tuboid_classifier.ml_bundle import MLBundle
 from sticky_pi_ml.insect_tuboid_classifier.trainer import Trainer
 from sticky_pi_ml.insect_tuboid_classifier.predictor import Predictor
 from sticky_pi_ml.tuboid import TiledTuboid
+from sticky_pi_ml.tuboid_pack import PACK_EXTENSION
 
 
 OUTPUT_FILENAME = "results.csv"
@@ -32,6 +33,8 @@ if __name__ == '__main__':
 
     args_parse.add_argument("-f", "--force", dest="force", default=False, help="force", action="store_true")
     args_parse.add_argument("-k", "--filter", default=1, help="force", type=int)
+    args_parse.add_argument("--batch-size", dest="batch_size", default=8, type=int,
+                            help="Number of tuboids classified together (predict_dir)")
 
     # training specific
     args_parse.add_argument("-r", "--restart-training", dest="restart_training", default=False, action="store_true")
@@ -68,19 +71,23 @@ if __name__ == '__main__':
         ml_bundle = MLBundle(option_dict["bundle_dir"])
         predictor = Predictor(ml_bundle)
         tuboid_metadata = sorted(glob.glob(os.path.join(option_dict['target'], "**", "metadata.txt"), recursive=True))
+        tiled_tuboids = [TiledTuboid(os.path.dirname(met)) for met in tuboid_metadata]
+        # tuboids saved in packs (i.e. `standalone_sim.py predict_dir --pack`)
+        for pack in sorted(glob.glob(os.path.join(option_dict['target'], "**", "*" + PACK_EXTENSION), recursive=True)):
+            tiled_tuboids += TiledTuboid.from_pack(pack)
         out = []
+        batch_size = option_dict["batch_size"]
+        assert batch_size > 0, "--batch-size must be positive"
         try:
-            for met in tuboid_metadata:
-                tt_dir = os.path.dirname(met)
-                tt = TiledTuboid(tt_dir)
-                prediction = predictor.predict(tt)
-                prediction["directory"] = tt_dir
+            # tuboids are classified `batch_size` at a time
+            for tt, prediction in zip(tiled_tuboids, predictor.predict_batch(tiled_tuboids, batch_size)):
+                prediction["directory"] = tt.directory
 
                 logging.info(prediction)
 
                 out.append(prediction)
         except Exception as e:
-            logging.error(f"Failed to analyse tuboid {tt_dir}. Saving what we have so far.")
+            logging.error(f"Failed to analyse tuboids in {tuboid_dir}")
             raise e
         finally:
             dt = pd.DataFrame(out)
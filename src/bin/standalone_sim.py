@@ -11,6 +11,7 @@ from sticky_pi_ml.siamese_insect_matcher.matcher import Matcher
 from sticky_pi_ml.siamese_insect_matcher.siam_svg import SiamSVG
 from sticky_pi_ml.image import SVGImage
 from sticky_pi_ml.tuboid import Tuboid, TiledTuboid
+from sticky_pi_ml.tuboid_pack import TuboidPackWriter, PACK_EXTENSION
 
 
 from sticky_pi_ml.image import ImageSeriesSVGDir
@@ -40,6 +41,12 @@ if __name__ == '__main__':
 
     args_parse.add_argument("-f", "--force", dest="force", default=False, help="force", action="store_true")
     args_parse.add_argument("-k", "--filter", default=1, help="force", type=int)
+    args_parse.add_argument("-w", "--workers", dest="workers", default=1, type=int,
+                            help="Number of workers matching consecutive frames in parallel (predict_dir)")
+    args_parse.add_argument("--draft-backend", dest="draft_backend", default='process',
+                            help="Type of the parallel workers: `process` or `thread`")
+    args_parse.add_argument("--pack", dest="pack", default=False, action="store_true",
+                            help="Save the tuboids of the series in a single pack file, rather than one directory each")
 
     # training specific
     args_parse.add_argument("-r", "--restart-training", dest="restart_training", default=False, action="store_true")
@@ -74,11 +81,17 @@ if __name__ == '__main__':
         im_series = ImageSeriesSVGDir(option_dict["target"])
 
         ml_bundle = MLBundle(option_dict["bundle_dir"])
-        matcher = Matcher(ml_bundle)
+        assert option_dict["workers"] > 0, "--workers must be positive"
+        matcher = Matcher(ml_bundle, n_workers=option_dict["workers"], draft_backend=option_dict["draft_backend"])
 
         tuboids = matcher.match(im_series)
         series_id = tuboids[0].parent_series.name + "." + tuboids[0].matcher_version
-        tiled_tuboids = [TiledTuboid.from_tuboid(t, tuboid_dir).directory for t in tuboids]
+        if option_dict["pack"]:
+            os.makedirs(os.path.join(tuboid_dir, series_id))
+            with TuboidPackWriter(os.path.join(tuboid_dir, series_id, series_id + PACK_EXTENSION)) as pack:
+                tiled_tuboids = [TiledTuboid.from_tuboid(t, pack=pack).directory for t in tuboids]
+        else:
+            tiled_tuboids = [TiledTuboid.from_tuboid(t, tuboid_dir).directory for t in tuboids]
 
         logging.info("Making video")
         matcher.make_video(tuboids, os.path.join(tuboid_dir,series_id, im_series.name + '.mp4'),
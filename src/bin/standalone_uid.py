@@ -4,6 +4,11 @@ import argparse
 import logging
 import os
 import glob
+import time
+import functools
+import multiprocessing
+import cv2
+import torch
 from sticky_pi_ml.universal_insect_detector.ml_bundle import MLBundle
 from sticky_pi_ml.universal_insect_detector.predictor import Predictor
 from sticky_pi_ml.universal_insect_detector.trainer import Trainer
@@ -17,6 +22,84 @@ MANUAL_ANNOTATION_PREFIX = "a_"
 # * train -> train
 valid_actions = {'predict_dir', 'train', 'check_data', 'validate', 'visualise'}
 
+# the predictor of the current worker process, when predicting with several workers
+_worker_predictor = None
+
+
+def init_worker(bundle_dir, device, n_threads, de_novo):
+    global _worker_predictor
+    # we cap intra-op threads so that workers do not oversubscribe the cores
+    torch.set_num_threads(n_threads)
+    cv2.setNumThreads(n_threads)
+    if not de_novo:
+        # the post-processing threads share the thread budget of the worker
+        _worker_predictor = Predictor(MLBundle(bundle_dir, device=device), n_postprocessing_threads=n_threads)
+
+
+def svg_path(img, prefix=""):
+    # foreign image may have arbitrary filenames
+    return os.path.join(os.path.dirname(img), prefix + os.path.splitext(os.path.basename(img))[0] + ".svg")
+
+
+def predict_images(imgs, target_dir, de_novo, force, pred=None):
+    """
+    Detects insects in a batch of images and saves the results as SVGs next to them.
+    The tiles of all images are sent to the model together (see ``Predictor.detect_batch``).
+    :return: a list of ``(pid, path, processing time in s)``, the time being ``None`` when an image was skipped.
+        The time of the batch is shared evenly by its images
+    """
+    if pred is None:
+        pred = _worker_predictor
+    t0 = time.time()
+    to_detect = []
+    for path in imgs:
+        if (os.path.exists(svg_path(path, MANUAL_ANNOTATION_PREFIX)) or os.path.exists(svg_path(path))) and not force:
+            logging.info(f"SVG output file exist: {os.path.relpath(svg_path(path), target_dir)}. Skipping. "
+                         f"Use --force to overwrite")
+        else:
+            to_detect.append(path)
+    if len(to_detect) == 0:
+        return [(os.getpid(), path, None) for path in imgs]
+
+    images = [Image(path, foreign=True) for path in to_detect]
+    if de_novo:
+        annotated_images = images
+    else:
+        logging.info(f"Detecting in {', '.join(os.path.relpath(img.path, target_dir) for img in images)}")
+        annotated_images = pred.detect_batch(images)
+
+    for path, annotated in zip(to_detect, annotated_images):
+        new_name = svg_path(path)
+        logging.info(f"Saving results in {os.path.relpath(new_name, target_dir)}")
+        # we write in the same directory, then rename, so that a partial SVG is never visible
+        tmp_name = os.path.join(os.path.dirname(new_name), f".{os.path.basename(new_name)}.{os.getpid()}.tmp")
+        try:
+            annotated.to_svg(target=tmp_name)
+            os.replace(tmp_name, new_name)
+        finally:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+        assert os.path.exists(new_name)
+    t = (time.time() - t0) / len(to_detect)
+    return [(os.getpid(), path, t if path in to_detect else None) for path in imgs]
+
+
+def print_worker_summary(results, wall_time):
+    per_worker = {}
+    for pid, _, t in results:
+        if t is None:
+            continue
+        if pid not in per_worker:
+            per_worker[pid] = [0, 0.0]
+        per_worker[pid][0] += 1
+        per_worker[pid][1] += t
+    total = 0
+    for i, (pid, (n, t)) in enumerate(sorted(per_worker.items())):
+        total += n
+        print(f"Worker {i} (pid {pid}): {n} images, {n / t if t > 0 else 0:.3f} images/s")
+    print(f"Total: {total} images in {wall_time:.1f}s, {total / wall_time if wall_time > 0 else 0:.3f} images/s")
+
+
 if __name__ == '__main__':
     args_parse = argparse.ArgumentParser()
     args_parse.add_argument("action", help=str(valid_actions))
@@ -37,6 +120,11 @@ if __name__ == '__main__':
                                                                                    "for manual annotation.",
                             action="store_true")
     args_parse.add_argument("-f", "--force", dest="force", default=False, help="force", action="store_true")
+    args_parse.add_argument("-w", "--workers", dest="workers", default=1, type=int,
+                            help="Number of worker processes for predict_dir. Each loads the ML bundle once")
+    args_parse.add_argument("-B", "--batch-size", dest="batch_size", default=4, type=int,
+                            help="Number of images detected together by predict_dir, so that the batches of tiles "
+                                 "sent to the model stay full at image boundaries")
 
     # training specific
     args_parse.add_argument("-r", "--restart-training", dest="restart_training", default=False, action="store_true")
@@ -65,7 +153,9 @@ if __name__ == '__main__':
     if option_dict['action'] not in valid_actions:
         raise ValueError(f"Unexpected action{option_dict['action']}. Valid actions are:{str(valid_actions)}")
 
-    if not option_dict["de_novo"]:
+    bundle = None
+    # with several workers, each worker process loads its own bundle, so the parent does not need one
+    if not option_dict["de_novo"] and (option_dict['action'] != 'predict_dir' or option_dict["workers"] == 1):
         bundle = MLBundle(option_dict["bundle_dir"], device=device)
 
     if option_dict['action'] == 'predict_dir':
@@ -75,33 +165,39 @@ if __name__ == '__main__':
         if not os.path.isdir(option_dict['target']):
             raise ValueError(f"Target directory does not exist: {option_dict['target']}")
         # fixme (could be a other formats/patterns)
-        if not option_dict["de_novo"]:
-            pred = Predictor(bundle)
-
         valid_imgs = sorted(glob.glob(os.path.join(option_dict['target'], "**", "*.jpg"), recursive=True))
         assert len(valid_imgs) > 0, f"No image found in {option_dict['target']}"
         logging.info(f"Found {len(valid_imgs)} images")
-        for img in valid_imgs:
-            # foreign image may have arbitrary filenames
-            new_name = os.path.join(os.path.dirname(img), os.path.splitext(os.path.basename(img))[0] + ".svg")
-            new_name_manual_annotation = os.path.join(os.path.dirname(img), MANUAL_ANNOTATION_PREFIX +
-                                                      os.path.splitext(os.path.basename(img))[0] + ".svg")
-
-            img = Image(img, foreign=True)
-
-            if (os.path.exists(new_name_manual_annotation) or os.path.exists(new_name)) and not option_dict["force"]:
-                logging.info(f"SVG output file exist: {os.path.relpath(new_name, option_dict['target'])}. Skipping. "
-                             f"Use --force to overwrite")
-                continue
-            if option_dict["de_novo"]:
-                annotated = img
-            else:
-                logging.info(f"Detecting in {os.path.relpath(img.path, option_dict['target'])}")
-                annotated = pred.detect(img)
-                logging.info(f"Saving results in {os.path.relpath(new_name, option_dict['target'])}")
-
-            annotated.to_svg(target=new_name)
-            assert os.path.exists(new_name)
+
+        n_workers = option_dict["workers"]
+        assert n_workers > 0, "--workers must be positive"
+        batch_size = option_dict["batch_size"]
+        assert batch_size > 0, "--batch-size must be positive"
+        batches = [valid_imgs[i: i + batch_size] for i in range(0, len(valid_imgs), batch_size)]
+        t0 = time.time()
+        if n_workers == 1:
+            pred = None
+            if not option_dict["de_novo"]:
+                pred = Predictor(bundle)
+            try:
+                results = [r for batch in batches
+                           for r in predict_images(batch, option_dict['target'], option_dict["de_novo"],
+                                                   option_dict["force"], pred)]
+            finally:
+                if pred is not None:
+                    pred.close()
+        else:
+            n_threads = max(1, multiprocessing.cpu_count() // n_workers)
+            logging.info(f"Predicting with {n_workers} workers, {n_threads} threads each")
+            with multiprocessing.Pool(n_workers, initializer=init_worker,
+                                      initargs=(option_dict["bundle_dir"], device, n_threads,
+                                                option_dict["de_novo"])) as pool:
+                predict = functools.partial(predict_images, target_dir=option_dict['target'],
+                                            de_novo=option_dict["de_novo"], force=option_dict["force"])
+                # chunksize=1: workers pull batches one at a time from the shared queue
+                results = [r for batch_results in pool.imap_unordered(predict, batches, chunksize=1)
+                           for r in batch_results]
+        print_worker_summary(results, time.time() - t0)
 
     if option_dict['action'] == 'train':
 
@@ -122,9 +218,9 @@ if __name__ == '__main__':
 
     elif option_dict['action'] == 'validate':
         t = Trainer(bundle)
-        pred = Predictor(bundle)
         os.makedirs(option_dict['target'], exist_ok=True)
-        t.validate(pred, out_dir=option_dict['target'])
+        with Predictor(bundle) as pred:
+            t.validate(pred, out_dir=option_dict['target'])
 
     elif option_dict['action'] == 'visualise':
         # bundle.dataset.visualise(subset="val")
@@ -41,9 +41,9 @@ if __name__ == '__main__':
         client = make_client(option_dict)
         ml_bundle = ClientMLBundle(bundle_dir, client, device=option_dict['device'], cache_dir=ml_bundle_cache)
         t = Trainer(ml_bundle)
-        pred = Predictor(ml_bundle)
         os.makedirs(VALIDATION_OUT_DIR, exist_ok=True)
-        t.validate(pred, out_dir=VALIDATION_OUT_DIR)
+        with Predictor(ml_bundle) as pred:
+            t.validate(pred, out_dir=VALIDATION_OUT_DIR)
 
 
     elif option_dict['action'] == 'train':
@@ -56,8 +56,8 @@ if __name__ == '__main__':
     elif option_dict['action'] == 'predict':
         client = make_client(option_dict)
         ml_bundle = ClientMLBundle(bundle_dir, client, device=option_dict['device'], cache_dir=ml_bundle_cache)
-        pred = Predictor(ml_bundle)
-        pred.detect_client()
+        with Predictor(ml_bundle) as pred:
+            pred.detect_client()
 
     # elif option_dict['action'] == 'predict-dir':
     #     client = make_client(option_dict)
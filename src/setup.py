@@ -26,10 +26,10 @@ setup(
         'svgpathtools',
         'CairoSVG',
         'opencv_python',
-        'networkx',
         'detectron2',
-        'torch >= 1.4',
+        'torch >= 1.9',
         'shapely',
+        'scipy',
         'torchvision',
         'sklearn'],
     extras_require={
@@ -29,7 +29,6 @@ class Annotation(object):
             else:
                 logging.warning('Division by zero in contour moment')
 
-        self._cached_conv = {}
         self._area = cv2.contourArea(contour)
 
     def to_dict(self):
@@ -137,16 +136,6 @@ class Annotation(object):
     def center(self):
         return self._center
 
-    def set_cached_conv(self, hash, array):
-        self._cached_conv[hash] = array
-
-    def clear_cached_conv(self):
-        self._cached_conv = {}
-    @property
-    def cached_conv(self):
-        return self._cached_conv
-
-
     def svg_element(self, offset=(0,0)):
         d_list = []
         for i in range(len(self._contour)):
@@ -0,0 +1,83 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from typing import List, Tuple
+
+ASSIGNMENT_METHODS = {'greedy', 'optimal'}
+
+
+def greedy_assignment(arr: np.ndarray) -> List[Tuple[int, int, float]]:
+    """
+    Iteratively matches the row and column of the highest remaining score.
+    This gives the same result as repeatedly taking the ``argmax`` of the matrix and zeroing its row and column,
+    (including how ties are resolved) but sorts the positive scores once instead.
+
+    :param arr: a 2d array of non-negative scores
+    :return: a list of ``(row, column, score)``, by decreasing score
+    """
+    flat = arr.ravel()
+    candidates = np.flatnonzero(flat > 0)
+    # stable sort: among equal scores, the first in C order (as `argmax`) comes first
+    candidates = candidates[np.argsort(-flat[candidates], kind='stable')]
+    rows, cols = np.unravel_index(candidates, arr.shape)
+
+    used_rows = np.zeros(arr.shape[0], dtype=bool)
+    used_cols = np.zeros(arr.shape[1], dtype=bool)
+    max_matches = min(arr.shape)
+    out = []
+    for i, j, k in zip(rows.tolist(), cols.tolist(), candidates.tolist()):
+        if used_rows[i] or used_cols[j]:
+            continue
+        used_rows[i] = True
+        used_cols[j] = True
+        out.append((i, j, flat[k]))
+        if len(out) == max_matches:
+            break
+    return out
+
+
+def optimal_assignment(arr: np.ndarray) -> List[Tuple[int, int, float]]:
+    """
+    Finds the matching that maximises the sum of scores (linear sum assignment).
+    Score matrices are generally sparse, so the problem is split in independent sub-problems:
+    the connected components of the bipartite graph of positive scores, which are solved separately.
+
+    :param arr: a 2d array of non-negative scores
+    :return: a list of ``(row, column, score)``, by decreasing score
+    """
+    rows, cols = np.nonzero(arr > 0)
+    if len(rows) == 0:
+        return []
+    n_rows, n_cols = arr.shape
+    # rows and columns are the nodes of a single graph, columns after rows
+    graph = coo_matrix((np.ones(len(rows)), (rows, cols + n_rows)), shape=(n_rows + n_cols, n_rows + n_cols))
+    _, labels = connected_components(graph, directed=False)
+    row_labels, col_labels = labels[:n_rows], labels[n_rows:]
+
+    out = []
+    for component in np.unique(labels[rows]):
+        sub_rows = np.flatnonzero(row_labels == component)
+        sub_cols = np.flatnonzero(col_labels == component)
+        sub_arr = arr[np.ix_(sub_rows, sub_cols)]
+        for i, j in zip(*linear_sum_assignment(sub_arr, maximize=True)):
+            if sub_arr[i, j] > 0:
+                out.append((int(sub_rows[i]), int(sub_cols[j]), arr[sub_rows[i], sub_cols[j]]))
+    out.sort(key=lambda e: -e[2])
+    return out
+
+
+def assign(arr: np.ndarray, method: str = 'greedy') -> List[Tuple[int, int, float]]:
+    """
+    Matches the rows and columns of a score matrix, one to one.
+
+    :param arr: a 2d array of non-negative scores. Zero means no possible match
+    :param method: either ``'greedy'`` (see :func:`greedy_assignment`) or ``'optimal'``
+        (see :func:`optimal_assignment`)
+    :return: a list of ``(row, column, score)``, by decreasing score
+    """
+    if method == 'greedy':
+        return greedy_assignment(arr)
+    elif method == 'optimal':
+        return optimal_assignment(arr)
+    raise ValueError(f"Unknown assignment method `{method}`. Valid methods are: {ASSIGNMENT_METHODS}")
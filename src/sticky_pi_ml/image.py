@@ -2,14 +2,17 @@ import glob
 import io
 import json
 import os
+import re
 import cv2
 import datetime
 from xml.etree import ElementTree
 import numpy as np
 from ast import literal_eval
 import logging
+import mmap
 import tempfile
 import base64
+import binascii
 import PIL
 import PIL.Image
 import PIL.ExifTags
@@ -152,6 +155,10 @@ class ImageSeriesSVGDir(ImageSeries):
 
 
 class Image(object):
+    _exif_orientation_tag = 0x0112
+    # DateTimeOriginal, then DateTime
+    _exif_datetime_tags = (0x9003, 0x0132)
+
     def __init__(self, path: str, foreign: bool = False):
         self._path = path
         self._filename = os.path.basename(path)
@@ -168,6 +175,7 @@ class Image(object):
         self._annotations = []
         self._metadata = None
         self._shape = None
+        self._header = None
         self._cached_image = None
 
     def __repr__(self):
@@ -253,7 +261,7 @@ class Image(object):
     @property
     def shape(self):
         if self._shape is None:
-            self.read()
+            self._shape = self._read_header()['shape']
         return self._shape
 
     @property
@@ -266,6 +274,9 @@ class Image(object):
 
     @property
     def datetime(self):
+        # foreign images may have their datetime in their EXIF
+        if self._datetime is None and self._header is None:
+            self._read_header()
         return self._datetime
 
     @property
@@ -276,11 +287,8 @@ class Image(object):
     def filename(self):
         return self._filename
 
-    def clear_cache(self, clear_annot_cached_conv=True):
+    def clear_cache(self):
         self._cached_image = None
-        if clear_annot_cached_conv:
-            for a in self._annotations:
-                a.clear_cached_conv()
 
     def read(self, cache=False):
         if self._cached_image is None:
@@ -306,21 +314,53 @@ class Image(object):
             self._metadata = self._decode_metadata()
         return self._metadata
 
+    def _read_header(self):
+        """
+        Parses the file header once, without decoding the pixels.
+
+        :return: a dictionary with the ``shape`` of the decoded image and the raw ``exif`` tags
+        """
+        if self._header is not None:
+            return self._header
+
+        self._header = self._parse_header(self._path)
+        exifs = self._header['exif']
+        if self._datetime is None and exifs:
+            for tag in self._exif_datetime_tags:
+                try:
+                    self._datetime = datetime.datetime.strptime(exifs[tag], '%Y:%m:%d %H:%M:%S')
+                    break
+                except (KeyError, TypeError, ValueError):
+                    pass
+        return self._header
+
+    @classmethod
+    def _parse_header(cls, file):
+        # PIL only reads the markers preceding the image data (SOF, APPn, ...) on open.
+        # Pixels would only be decoded by `load()`
+        with PIL.Image.open(file) as img:
+            width, height = img.size
+            exifs = img._getexif() if hasattr(img, '_getexif') else None
+
+        # opencv applies the EXIF orientation when decoding, which can transpose the image
+        if exifs and exifs.get(cls._exif_orientation_tag) in {5, 6, 7, 8}:
+            width, height = height, width
+        return {'shape': (height, width, 3), 'exif': exifs}
+
     def _decode_metadata(self):
-        with PIL.Image.open(self._path) as img:
-            exifs = img._getexif()
-            # possibly, foreign images have no exif data!
-            if not exifs and self._foreign:
-                return {}
-            out = {
-                PIL.ExifTags.TAGS[k]: v
-                for k, v in exifs.items()
-                if k in PIL.ExifTags.TAGS
-            }
-            # cast to float for compatibility
-            for k, v in out.items():
-                if isinstance(v, PIL.TiffImagePlugin.IFDRational):
-                    out[k] = float(v)
+        exifs = self._read_header()['exif']
+        # possibly, foreign images have no exif data!
+        if not exifs and self._foreign:
+            return {}
+        out = {
+            PIL.ExifTags.TAGS[k]: v
+            for k, v in exifs.items()
+            if k in PIL.ExifTags.TAGS
+        }
+        # cast to float for compatibility
+        for k, v in out.items():
+            if isinstance(v, PIL.TiffImagePlugin.IFDRational):
+                out[k] = float(v)
 
         if not self._foreign:
             try:
@@ -342,7 +382,7 @@ class Image(object):
         tmp_svg = tempfile.mktemp(suffix='.svg')
 
         try:
-            height, width = self.read().shape[0:2]
+            height, width = self.shape[0:2]
             if include_metadata:
                 meta = self.metadata
                 desc = 'desc="' + str(self.metadata) + '"'
@@ -411,19 +451,123 @@ class Image(object):
 
 
 class SVGImage(Image):
+    _svg_namespace = '{http://www.w3.org/2000/svg}'
+    _xlink_href = '{http://www.w3.org/1999/xlink}href'
+    # number of base64 characters decoded to read the header of embedded jpegs (a multiple of 4)
+    _jpeg_header_b64_prefix = 1 << 17
+    _svg_number_regex = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+    # an absolute, straight-line, closed polygon: `M x,y x,y ... Z`, as written by `Annotation.svg_element`
+    _straight_polygon_regex = re.compile(r'\s*M[\d\s,.eE+-]*[Zz]\s*')
+
     def __init__(self, path, foreign: bool = False, skip_annotations=False):
         super().__init__(path, foreign)
         # the shape of the image within the svg document
         # will have to scale the contours  to match the actual dimensions of the embedded image
         self._scale_in_svg = None
+        self._svg_doc = None
+        # where to find the base64 payload of each embedded jpeg
+        self._embedded_jpegs = None
         self._parse_metadata()
         if not skip_annotations:
             self._parse_annotations()
-
+        # the parsed elements are not needed anymore, embedded jpegs are read from `_embedded_jpegs`
+        self._svg_doc = None
+
+    def _parse_svg(self):
+        """
+        Parses the whole SVG document in a single streaming pass.
+        Embedded images are not kept in memory. Instead, we record where their base64 payload lies in the file,
+        and read their jpeg header to get their shape.
+
+        :return: a dictionary with the attributes of the ``images``, the ``path`` elements,
+            the path elements of each group (``groups``) and the attributes of legacy ``sticky`` elements
+        """
+        if self._svg_doc is not None:
+            return self._svg_doc
+
+        images, paths, groups, sticky = [], [], [], []
+        embedded_jpegs = []
+        open_groups = []
+        with open(self._path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+            for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    if elem.tag == self._svg_namespace + 'g':
+                        groups.append([])
+                        open_groups.append(groups[-1])
+                elif elem.tag == self._svg_namespace + 'path':
+                    paths.append(elem)
+                    for g in open_groups:
+                        g.append(elem)
+                elif elem.tag == self._svg_namespace + 'g':
+                    open_groups.pop()
+                elif elem.tag == self._svg_namespace + 'image':
+                    attrib = dict(elem.attrib)
+                    href = attrib.pop(self._xlink_href, ',')
+                    # bounds of the base64 payload within the href, to avoid copying it
+                    start, end = href.index(',') + 1, len(href)
+                    while start < end and href[start] in '\"\'':
+                        start += 1
+                    while end > start and href[end - 1] in '\"\'':
+                        end -= 1
+                    embedded_jpegs.append(self._locate_payload(file_map, href, start, end, embedded_jpegs))
+                    attrib['jpeg_header'] = self._embedded_jpeg_header(href, start, end)
+                    images.append(attrib)
+                    # drops the base64 string
+                    elem.clear()
+                elif elem.tag == self._svg_namespace + 'sticky':
+                    sticky.append(dict(elem.attrib))
+
+        self._embedded_jpegs = embedded_jpegs
+        self._svg_doc = {'images': images, 'paths': paths, 'groups': groups, 'sticky': sticky}
+        return self._svg_doc
+
+    @staticmethod
+    def _locate_payload(file_map, href, start, end, previous):
+        """
+        Finds the span of a base64 payload (``href[start:end]``) in the mapped file,
+        searching after the previous payloads.
+        Payloads that do not appear verbatim in the file (e.g. split by XML-normalised line breaks) are kept as strings.
+        """
+        search_from = previous[-1][1] if previous and isinstance(previous[-1], tuple) else 0
+        span_start = file_map.find(href[start: start + 64].encode(), search_from)
+        span_end = span_start + end - start
+        if span_start < 0 or file_map[span_end:span_end + 1] not in {b'"', b"'"}:
+            return href[start:end]
+        return span_start, span_end
+
+    def _embedded_jpeg_header(self, href, start, end):
+        # the jpeg header (where its shape is) is in the first few kB, so we only decode the start of the payload
+        try:
+            prefix_end = min(end, start + self._jpeg_header_b64_prefix)
+            return self._parse_header(io.BytesIO(binascii.a2b_base64(href[start:prefix_end])))
+        except Exception:
+            return self._parse_header(io.BytesIO(binascii.a2b_base64(href[start:end])))
+
+    def _embedded_jpeg_bytes(self, id=0, decode=True):
+        """
+        Reads an embedded jpeg. When its payload is verbatim in the file, it is decoded straight from a
+        memory-mapped view of the file, without intermediate copies.
+
+        :param id: the index of the embedded image
+        :param decode: whether to decode the base64 payload
+        :return: the jpeg bytes (or the base64 payload if ``decode=False``)
+        """
+        if self._embedded_jpegs is None:
+            self._parse_svg()
+        span = self._embedded_jpegs[id]
+        if not isinstance(span, tuple):
+            return binascii.a2b_base64(span) if decode else span.encode()
+
+        with open(self._path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+            if not decode:
+                return file_map[span[0]:span[1]]
+            with memoryview(file_map) as view:
+                with view[span[0]:span[1]] as payload:
+                    return binascii.a2b_base64(payload)
 
     def _img_buffer(self):
-        encoded_string = base64.b64encode(self.extract_jpeg(as_buffer=True).read())
-        return encoded_string
+        # no need to decode and re-encode the payload
+        return self._embedded_jpeg_bytes(decode=False)
 
     def _style_to_dic(self, p):
         style = p.attrib['style'].split(';')
@@ -434,9 +578,8 @@ class SVGImage(Image):
         return d
 
     def _parse_annotations(self):
-        doc = ElementTree.parse(self._path)
         self._annotations = []
-        paths = doc.findall('.//{http://www.w3.org/2000/svg}path')
+        paths = self._parse_svg()['paths']
         for p in paths:
             style = self._style_to_dic(p)
             contours = self._svg_path_to_contour(p)
@@ -446,42 +589,43 @@ class SVGImage(Image):
                     self._annotations.append(a)
 
     def _parse_metadata(self):
-        doc = ElementTree.parse(self._path)
+        doc = self._parse_svg()
 
-        ims = doc.findall('.//{http://www.w3.org/2000/svg}image')
+        ims = doc['images']
         if len(ims) != 1:
             raise Exception("Cannot extract image from %s" % self._path)
 
-        attrs = ims[0].attrib
+        attrs = ims[0]
         if 'w' in attrs:
-            im_w = ims[0].attrib['w']
+            im_w = attrs['w']
         elif 'width' in attrs:
-            im_w = ims[0].attrib['width']
+            im_w = attrs['width']
         else:
             raise Exception('Embedded image %s does not have width' % self._path)
 
         if 'h' in attrs:
-            im_h = ims[0].attrib['h']
+            im_h = attrs['h']
         elif 'width' in attrs:
-            im_h = ims[0].attrib['height']
+            im_h = attrs['height']
         else:
             raise Exception('Embedded image %s does not have height' % self._path)
 
         svg_im_shape = (int(im_h), int(im_w))
-        jpg_im_shape = self._get_array().shape
+        self._header = attrs['jpeg_header']
+        jpg_im_shape = self._header['shape']
         self._scale_in_svg = np.array(svg_im_shape) / np.array(jpg_im_shape[0:2])
 
         try:
-            str = ims[0].attrib['desc']
+            str = attrs['desc']
             if str == '':
                 raise Exception('Empty desc field')
         except KeyError:
             logging.warning('Cannot find a desc attribute in image. Maybe a legacy SVG')
             try:
-                sticky_data = doc.findall('.//{http://www.w3.org/2000/svg}sticky')
+                sticky_data = doc['sticky']
                 if len(sticky_data) != 1:
                     raise KeyError('One and only one sticky metadata field should exist in svg image')
-                str = sticky_data[0].attrib['metadata']
+                str = sticky_data[0]['metadata']
             except KeyError:
                 logging.warning("No metadata in %s", self._path)
                 self._metadata = {}
@@ -501,6 +645,33 @@ class SVGImage(Image):
             self._metadata['Make'] = None
 
     def _svg_path_to_contour(self, p, n_point_per_segment=2, n_point_per_curve=8):
+        # most paths are simple polygons, which we parse without building svgpathtools objects
+        if self._straight_polygon_regex.fullmatch(p.attrib['d']):
+            out = self._straight_polygon_to_contour(p)
+            if out is not None:
+                return out
+        return self._svgpathtools_path_to_contour(p, n_point_per_segment, n_point_per_curve)
+
+    def _straight_polygon_to_contour(self, p):
+        coords = np.array(self._svg_number_regex.findall(p.attrib['d']), dtype=float)
+        # odd number of coordinates, we let svgpathtools deal with it
+        if len(coords) % 2 != 0:
+            return None
+        points = coords.reshape((-1, 2))
+        if len(points) < 2:
+            return []
+        # like svgpathtools, `Z` only adds a closing segment when the last point is not the first one
+        if np.array_equal(points[-1], points[0]):
+            points = points[:-1]
+        ctr = np.round(np.stack([points[:, 0] / self._scale_in_svg[0],
+                                 points[:, 1] / self._scale_in_svg[1]], axis=1)).astype(int)
+        ctr = ctr.reshape((-1, 1, 2))
+        if ctr.shape[0] > 2:
+            return [ctr]
+        logging.warning("polygon with only %i points in %s: %s" % (ctr.shape[0], self._path, str(p.attrib)))
+        return []
+
+    def _svgpathtools_path_to_contour(self, p, n_point_per_segment=2, n_point_per_curve=8):
         string = p.attrib['d']
         tvals = np.linspace(0, 1, n_point_per_segment)
         tvals_bezier = np.linspace(0, 1, n_point_per_curve)
@@ -557,31 +728,27 @@ class SVGImage(Image):
     def _decode_metadata(self):
         return self._metadata
 
+    def _read_header(self):
+        if self._header is None:
+            self._parse_metadata()
+        return self._header
+
     def _get_array(self):
-        buffer = self.extract_jpeg(as_buffer=True)
-        bytes_as_np_array = np.frombuffer(buffer.read(), dtype=np.uint8)
+        # `frombuffer` shares the memory of the jpeg bytes
+        bytes_as_np_array = np.frombuffer(self._embedded_jpeg_bytes(), dtype=np.uint8)
         img = cv2.imdecode(bytes_as_np_array, cv2.IMREAD_COLOR)
         return img
 
     def extract_jpeg(self, target=None, as_buffer=False):
-        doc = ElementTree.parse(self._path)
-        ims = doc.findall('.//{http://www.w3.org/2000/svg}image')
-        if len(ims) != 1:
-            raise Exception("Cannot extract image from %s" % target)
-        return self._extract_jpeg_id(ims, 0, target, as_buffer)
-
-    def _extract_jpeg_id(self, ims, id=0, target=None, as_buffer=False):
-        utf_str = ims[id].attrib['{http://www.w3.org/1999/xlink}href'].split(',')[1]
-        utf_str = utf_str.strip('\"\'')
+        return self._extract_jpeg_id(0, target, as_buffer)
 
+    def _extract_jpeg_id(self, id=0, target=None, as_buffer=False):
         if as_buffer:
-            buffer = io.BytesIO()
-            buffer.write(base64.b64decode(utf_str))
-            buffer.seek(0)
-            return buffer
+            # initialising a BytesIO with bytes shares them until the buffer is modified
+            return io.BytesIO(self._embedded_jpeg_bytes(id))
 
         with open(target, 'wb') as f:
-            f.write(base64.b64decode(utf_str))
+            f.write(self._embedded_jpeg_bytes(id))
 
 
 class ArrayImage(Image):
@@ -594,12 +761,18 @@ class ArrayImage(Image):
         self._annotations = []
         self._metadata = {}
         self._shape = None
+        self._header = None
         self._cached_image = None
         self._md5 = None
 
     def filename(self):
         raise NotImplementedError
 
+    def _read_header(self):
+        if self._header is None:
+            self._header = {'shape': self._array.shape, 'exif': None}
+        return self._header
+
     def read(self, cache=True):
         self._shape = self._array.shape
         return self._array
@@ -616,12 +789,19 @@ class BufferImage(Image):
         self._annotations = []
         self._metadata = {}
         self._shape = None
+        self._header = None
         self._cached_image = None
         self._md5 = None
 
     def filename(self):
         raise NotImplementedError
 
+    def _read_header(self):
+        if self._header is None:
+            self._buffer.seek(0)
+            self._header = self._parse_header(self._buffer)
+        return self._header
+
     def read(self, cache=True):
         if self._array is not None:
             return self._array
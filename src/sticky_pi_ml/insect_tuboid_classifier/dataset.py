@@ -14,6 +14,7 @@ from sticky_pi_ml.dataset import BaseDataset
 from sticky_pi_ml.utils import detectron_to_pytorch_transform
 from sticky_pi_ml.insect_tuboid_classifier.taxonomy import TaxonomyMapper
 from sticky_pi_ml.tuboid import TiledTuboid
+from sticky_pi_ml.insect_tuboid_classifier.tile_store import TileStore
 
 to_tensor_tr = ToTensor()
 normalize_tr = Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
@@ -23,15 +24,18 @@ class OurTorchDataset(TorchDataset):
     _n_shots_drawn = 6
     default_transform = Compose([to_tensor_tr, normalize_tr])
 
-    def __init__(self, tuboids: List[Dict[str, Union[TiledTuboid, str, int]]], augment=True):
+    def __init__(self, tuboids: List[Dict[str, Union[TiledTuboid, str, int]]], augment=True,
+                 tile_store: TileStore = None):
         """
         TODO fixme
         tuboids = [(name, {images  :  [img_path_1, ..., img_path_n]),
                            metadata: {n_images: N, taxonomy:(type, order, family, genus, species, extra)}}]
 
+        :param tile_store: a store with the decoded tiles of the tuboids. ``None`` to decode tuboid mosaics
         """
         self._tuboids = tuboids
         self._augment = augment
+        self._tile_store = tile_store
         if self._augment:
             self._transforms = Compose([
                 detectron_to_pytorch_transform(transforms.RandomBrightness)(0.5, 1.5),
@@ -51,7 +55,7 @@ class OurTorchDataset(TorchDataset):
     def __getitem__(self, item: int):
         tub = self._tuboids[item]['tuboid']
         # we pick the first shot of a tuboid and another n=self._n_shots -1
-        out = OurTorchDataset.tiled_tuboid_to_dict(tub, self._transforms)
+        out = OurTorchDataset.tiled_tuboid_to_dict(tub, self._transforms, tile_store=self._tile_store)
         return out, self._tuboids[item]['label']
 
     def __len__(self):
@@ -59,7 +63,7 @@ class OurTorchDataset(TorchDataset):
 
     @classmethod
     def tiled_tuboid_to_dict(cls, tuboid: TiledTuboid, im_transforms: Compose = None,
-                             unsqueezed: bool = False) -> Dict[str, Tensor]:
+                             unsqueezed: bool = False, tile_store: TileStore = None) -> Dict[str, Tensor]:
         if im_transforms is None:
             im_transforms = cls.default_transform
 
@@ -68,10 +72,15 @@ class OurTorchDataset(TorchDataset):
 
         scales = []
         arrays = []
-        for t_id in tile_ids_drawn:
-            tile_dict = tuboid.get_tile(t_id)
-            scales.append(torch.Tensor([tile_dict['scale']]))
-            array = im_transforms(tile_dict['array'])
+        if tile_store is not None and tuboid in tile_store:
+            tile_arrays = tile_store.get_tiles(tuboid, tile_ids_drawn)
+        else:
+            # the mosaic is decoded once for all the tiles drawn
+            tile_arrays = [t['array'] for t in tuboid.get_tiles(tile_ids_drawn)]
+
+        for t_id, tile_array in zip(tile_ids_drawn, tile_arrays):
+            scales.append(torch.Tensor([tuboid.get_scale(t_id)]))
+            array = im_transforms(tile_array)
             arrays.append(array)
 
         out = {'array': torch.stack(arrays),
@@ -97,6 +106,9 @@ class Dataset(BaseDataset):
         super().__init__(data_dir, config, cache_dir)
 
         self._taxonomy_mapper = TaxonomyMapper(self._config['LABELS'])
+        if self._config.get('MOSAIC_CACHE_MAX_BYTES') is not None:
+            TiledTuboid.set_mosaic_cache(self._config['MOSAIC_CACHE_MAX_BYTES'])
+        self._tile_store = None
 
     @property
     def n_classes(self):
@@ -137,6 +149,10 @@ class Dataset(BaseDataset):
         self._validation_data.sort(key=lambda x: x['tuboid'].md5)
         logging.info(f"N_validation : {len(self._validation_data)}")
 
+        if self._config.get('TILE_STORE'):
+            self._tile_store = TileStore.build([e['tuboid'] for e in self._training_data + self._validation_data],
+                                               os.path.join(self._cache_dir, 'tile_store'))
+
     def _serialise_imgs_to_dicts(self):
         sqlite_file = os.path.join(self._data_dir, self._annotations_filename)
         if not os.path.isfile(sqlite_file):
@@ -197,4 +213,4 @@ class Dataset(BaseDataset):
     def _get_torch_dataset(self, subset: str = 'train', augment: bool = False) -> torch.utils.data.Dataset:
         assert subset in {'train', 'val'}, 'subset should be either "train" or "val"'
         data = self._training_data if subset == 'train' else self._validation_data
-        return OurTorchDataset(data, augment=augment)
+        return OurTorchDataset(data, augment=augment, tile_store=self._tile_store)
@@ -20,6 +20,9 @@ RESNET_VARIANTS = {
 
 class ResNetPlus(ResNet):
     n_extra_dimension = 1
+    # the maximal number of images per resnet pass (shots of several instances are passed together).
+    # None for a single pass. On few CPU cores, large passes are slower, as activations do not fit in cache
+    max_images_per_pass = None
 
     def __init__(self, block, layers, num_classes=1000, zero_init_residual=False,
                  groups=1, width_per_group=64, replace_stride_with_dilation=None,
@@ -61,6 +64,8 @@ class ResNetPlus(ResNet):
         """
         Batches have size N. Instead of running reset on single images, we compute resnet features over M shots of the
         same instance. Then, we compute an average (median) feature vector per instance.
+        All shots go through resnet as a single batch of N * M images (or batches of ``max_images_per_pass``).
+        If the model was converted with ``model.to(memory_format=torch.channels_last)``, so are the images.
 
         :param inputs: a dictionary of inputs, already arranged in a batch of size N. Keys:
             * ``'array'`` tensor of shape ([N x] M x 224 x 224, 3)
@@ -68,6 +73,28 @@ class ResNetPlus(ResNet):
         :return: a tensor of labels ([N x] 1)
         """
         batch_size, n_shots, h, w, depth = inputs['array'].shape
+        # shots of the same instance are consecutive in the batch
+        x = inputs['array'].reshape((batch_size * n_shots, h, w, depth))
+        s = inputs['scale'].reshape((batch_size * n_shots, 1))
+        if self.conv1.weight.is_contiguous(memory_format=torch.channels_last):
+            x = x.contiguous(memory_format=torch.channels_last)
+        k = self.max_images_per_pass
+        if k is None or k >= len(x):
+            x = self._make_features(x, s)
+        else:
+            x = torch.cat([self._make_features(x[i: i + k], s[i: i + k]) for i in range(0, len(x), k)])
+        # then we compute the medians of the features (per vector element and instance)
+        avg_features = torch.median(x.reshape((batch_size, n_shots, -1)), dim=1)[0]
+        o = self.fc(avg_features)
+        return o
+
+    def _forward_per_shot(self, inputs: Dict) -> torch.Tensor:
+        """
+        The reference implementation of :func:`~sticky_pi_ml.insect_tuboid_classifier.model.ResNetPlus._forward_impl`,
+        with one resnet pass per shot. In eval mode, outputs are the same (up to rounding). In train mode,
+        its batch normalisation statistics are computed over N images, rather than N * M.
+        """
+        batch_size, n_shots, h, w, depth = inputs['array'].shape
 
         instance_features = []
         # over all shots through the batch dimension
@@ -86,7 +113,7 @@ class ResNetPlus(ResNet):
         return self._forward_impl(x)
 
 
-def make_resnet(pretrained: bool, n_classes, progress=True, resnet_variant: str = '50'):
+def make_resnet(pretrained: bool, n_classes, progress=True, resnet_variant: str = '50', channels_last: bool = False):
     try:
         variant = RESNET_VARIANTS[resnet_variant]
     except KeyError:
@@ -108,6 +135,7 @@ def make_resnet(pretrained: bool, n_classes, progress=True, resnet_variant: str
         model.load_state_dict(state_dict)
     # After loading the weights, we ensure that the last layer (FC) outputs match the number of classes
     model.fc = nn.Linear(n_features, n_classes)
-
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
     return model
 
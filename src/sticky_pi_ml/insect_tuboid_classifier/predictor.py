@@ -19,6 +19,8 @@ from sticky_pi_ml.insect_tuboid_classifier.dataset import OurTorchDataset
 class Predictor(BasePredictor):
     # submit to client N at a time predictions
     _client_predict_chunk_size = 64
+    # number of tuboids per forward pass
+    _predict_batch_size = 8
 
     def __init__(self, ml_bundle: MLBundle):
         super().__init__(ml_bundle)
@@ -31,9 +33,15 @@ class Predictor(BasePredictor):
         self._net.eval()
 
     def _make_net(self):
-        return make_resnet(pretrained=False, n_classes=self._ml_bundle.dataset.n_classes)
-
-    def predict_client(self, device, start_datetime, end_datetime, display_prediction=False, output_dir=None):
+        config = self._ml_bundle.config
+        # the defaults are those of the default config, for bundles that predate these keys
+        net = make_resnet(pretrained=False, n_classes=self._ml_bundle.dataset.n_classes,
+                          channels_last=config.get('CHANNELS_LAST', True))
+        net.max_images_per_pass = config.get('MAX_IMAGES_PER_PASS', 8)
+        return net
+
+    def predict_client(self, device, start_datetime, end_datetime, display_prediction=False, output_dir=None,
+                       batch_size: int = None):
         assert issubclass(type(self._ml_bundle), ClientMLBundle), \
             "This method only works for MLBundles linked to a client"
         client = self._ml_bundle.client
@@ -84,46 +92,48 @@ class Predictor(BasePredictor):
             logging.warning('No tuboids to label in %s (all labeled)' % series)
             return
 
-        def _predict_single_client_tuboid(args):
+        if batch_size is None:
+            batch_size = self._predict_batch_size
 
-            r = args[1][1]
+        def _predict_client_tuboids(rows):
             temp_dir = tempfile.mkdtemp()
             try:
-                tuboid_dir = os.path.join(temp_dir, r['tuboid_id'])
-                os.makedirs(tuboid_dir)
-                logging.info(f'Classifying tuboid: {args[0]}/{len(tiled_tuboids_for_series)}: {r["tuboid_id"]}')
-                for f in ['metadata', 'tuboid', 'context']:
-                    if os.path.isfile(r[f]):
-                        shutil.copy(r[f], tuboid_dir)
-                    else:
-                        filename = os.path.basename(r[f]).split('?')[0]
-                        resp = requests.get(r[f]).content
-                        with open(os.path.join(tuboid_dir, filename), 'wb') as file:
-                            file.write(resp)
-
-                tiled_tuboid = TiledTuboid(tuboid_dir)
-                prediction = self.predict(tiled_tuboid)
-                if display_prediction:
-                    self._display_prediction(prediction, tiled_tuboid)
-                if output_dir:
-                    self._make_prediction_image(prediction, tiled_tuboid,output_dir)
+                tiled_tuboids = []
+                for i, r in rows:
+                    tuboid_dir = os.path.join(temp_dir, r['tuboid_id'])
+                    os.makedirs(tuboid_dir)
+                    logging.info(f'Classifying tuboid: {i}/{len(tiled_tuboids_for_series)}: {r["tuboid_id"]}')
+                    for f in ['metadata', 'tuboid', 'context']:
+                        if os.path.isfile(r[f]):
+                            shutil.copy(r[f], tuboid_dir)
+                        else:
+                            filename = os.path.basename(r[f]).split('?')[0]
+                            resp = requests.get(r[f]).content
+                            with open(os.path.join(tuboid_dir, filename), 'wb') as file:
+                                file.write(resp)
+                    tiled_tuboids.append(TiledTuboid(tuboid_dir))
+
+                predictions = self.predict_batch(tiled_tuboids, batch_size)
+                for prediction, tiled_tuboid in zip(predictions, tiled_tuboids):
+                    if display_prediction:
+                        self._display_prediction(prediction, tiled_tuboid)
+                    if output_dir:
+                        self._make_prediction_image(prediction, tiled_tuboid, output_dir)
 
             finally:
                 shutil.rmtree(temp_dir)
 
-            prediction['algo_version'] = self.version
-            prediction['algo_name'] = self.name
-            prediction['tuboid_id'] = r['tuboid_id']
-            logging.info('Prediction: %s' % prediction)
-            client.put_itc_labels([prediction])
-
-        # from multiprocessing.pool import ThreadPool
-        # pool = ThreadPool(1)
-        # pool.map(_predict_single_client_tuboid, enumerate(tiled_tuboids_for_series.iterrows()))
-
-        for i in  enumerate(tiled_tuboids_for_series.iterrows()):
-            _predict_single_client_tuboid(i)
+            for prediction, (_, r) in zip(predictions, rows):
+                prediction['algo_version'] = self.version
+                prediction['algo_name'] = self.name
+                prediction['tuboid_id'] = r['tuboid_id']
+                logging.info('Prediction: %s' % prediction)
+            client.put_itc_labels(predictions)
 
+        # tuboids are downloaded, classified and submitted one batch at a time
+        rows = [(i, r) for i, (_, r) in enumerate(tiled_tuboids_for_series.iterrows())]
+        for i in range(0, len(rows), batch_size):
+            _predict_client_tuboids(rows[i: i + batch_size])
 
     def _make_prediction_image(self, prediction: Dict, tiled_tuboid: TiledTuboid, output_dir):
         import cv2
@@ -154,14 +164,31 @@ class Predictor(BasePredictor):
 
 
     def predict(self, tiled_tuboid: TiledTuboid):
-        data_entry = OurTorchDataset.tiled_tuboid_to_dict(tiled_tuboid, unsqueezed=True)
-        preds = self._net(data_entry)
-        preds = preds.detach().numpy()
-        label = int(np.argmax(preds))
-
-        out = self._taxonomy_mapper.label_to_level_dict(label)
-        pattern = self._taxonomy_mapper.label_to_pattern(label)
-        out.update({'label': label,
-                'pattern': pattern,
-                })
+        return self.predict_batch([tiled_tuboid])[0]
+
+    def predict_batch(self, tiled_tuboids: List[TiledTuboid], batch_size: int = None) -> List[Dict[str, Any]]:
+        """
+        Classifies tuboids, several at a time. Each forward pass stacks the shots of ``batch_size`` tuboids.
+
+        :param tiled_tuboids: the tuboids to classify
+        :param batch_size: the number of tuboids per forward pass. ``None`` for the default
+        :return: one prediction per tuboid, as a dictionary with the taxonomy, the ``'label'`` and the ``'pattern'``
+        """
+        if batch_size is None:
+            batch_size = self._predict_batch_size
+        assert batch_size > 0
+        out = []
+        for i in range(0, len(tiled_tuboids), batch_size):
+            data_entries = [OurTorchDataset.tiled_tuboid_to_dict(t) for t in tiled_tuboids[i: i + batch_size]]
+            batch = {k: torch.stack([d[k] for d in data_entries]) for k in data_entries[0].keys()}
+            with torch.inference_mode():
+                preds = self._net(batch)
+            labels = torch.argmax(preds, dim=1).tolist()
+
+            for label in labels:
+                prediction = self._taxonomy_mapper.label_to_level_dict(label)
+                prediction.update({'label': label,
+                                   'pattern': self._taxonomy_mapper.label_to_pattern(label),
+                                   })
+                out.append(prediction)
         return out
@@ -0,0 +1,100 @@
+import os
+import logging
+import numpy as np
+from typing import List
+
+from sticky_pi_ml.tuboid import TiledTuboid
+
+
+class TileStore(object):
+    _tiles_filename = 'tiles.npy'
+    _index_filename = 'index.npz'
+    _tile_width = 224
+
+    def __init__(self, store_dir: str):
+        """
+        The decoded tiles of many tuboids, in a single memory-mapped ``uint8`` array
+        (``n_tiles x 224 x 224 x 3``), so that training does not decode JPEG mosaics at every epoch.
+        Data loader workers share the pages of the array (they are copied only if a worker writes a tile).
+        Tuboids are identified by their md5. Use :func:`~sticky_pi_ml.insect_tuboid_classifier.tile_store.TileStore.build`
+        to make a store.
+
+        :param store_dir: the directory of the store
+        """
+        self._store_dir = store_dir
+        with np.load(os.path.join(store_dir, self._index_filename), allow_pickle=False) as index:
+            self._rows = {m: (int(f), int(n)) for m, f, n in zip(index['md5'].tolist(), index['first_row'],
+                                                               index['n_tiles'])}
+        # opened lazily, in each process
+        self._tiles = None
+
+    def __getstate__(self):
+        # do not pickle (i.e. copy) the whole array when workers are spawned
+        state = self.__dict__.copy()
+        state['_tiles'] = None
+        return state
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, tuboid: TiledTuboid):
+        return tuboid.md5 in self._rows
+
+    @classmethod
+    def build(cls, tuboids: List[TiledTuboid], store_dir: str) -> 'TileStore':
+        """
+        Makes a store, unless ``store_dir`` already has one with all the tuboids.
+
+        :param tuboids: the tuboids to store
+        :param store_dir: the directory of the store
+        :return: the store
+        """
+        md5s = sorted({t.md5 for t in tuboids})
+        if os.path.isfile(os.path.join(store_dir, cls._index_filename)):
+            store = cls(store_dir)
+            if all(m in store._rows for m in md5s):
+                logging.info('Using tile store %s (%i tuboids)' % (store_dir, len(store)))
+                return store
+            # the index is written last, so a store without one is never used
+            os.remove(os.path.join(store_dir, cls._index_filename))
+        os.makedirs(store_dir, exist_ok=True)
+
+        tuboids = {t.md5: t for t in tuboids}
+        n_tiles = np.array([tuboids[m].n_tiles for m in md5s], dtype=np.int64)
+        first_row = np.cumsum(n_tiles) - n_tiles
+        shape = (int(np.sum(n_tiles)), cls._tile_width, cls._tile_width, 3)
+        logging.info('Building tile store %s: %i tiles of %i tuboids (%.1f GB)' %
+                     (store_dir, shape[0], len(md5s), np.prod(shape) / 1e9))
+
+        # files are renamed when complete, so an interrupted build is not used
+        tiles_file = os.path.join(store_dir, cls._tiles_filename)
+        tiles = np.lib.format.open_memmap(tiles_file + '.part', mode='w+', dtype=np.uint8, shape=shape)
+        try:
+            for i, m in enumerate(md5s):
+                # the mosaic is decoded once for all the tiles of the tuboid
+                for j, tile in enumerate(tuboids[m].iter_tiles()):
+                    tiles[first_row[i] + j] = tile['array']
+            tiles.flush()
+        finally:
+            del tiles
+        os.replace(tiles_file + '.part', tiles_file)
+        with open(os.path.join(store_dir, cls._index_filename + '.part'), 'wb') as f:
+            np.savez(f, md5=np.array(md5s, dtype=np.str_), first_row=first_row, n_tiles=n_tiles)
+        os.replace(os.path.join(store_dir, cls._index_filename + '.part'),
+                   os.path.join(store_dir, cls._index_filename))
+        return cls(store_dir)
+
+    def get_tiles(self, tuboid: TiledTuboid, items: List[int]) -> List[np.ndarray]:
+        """
+        :param tuboid: a tuboid in the store
+        :param items: the indices of the tiles
+        :return: the tiles, as (copy-on-write) views of the store
+        """
+        if self._tiles is None:
+            self._tiles = np.load(os.path.join(self._store_dir, self._tiles_filename), mmap_mode='c')
+        first_row, n_tiles = self._rows[tuboid.md5]
+        out = []
+        for i in items:
+            assert i < n_tiles
+            out.append(self._tiles[first_row + i])
+        return out
@@ -82,6 +82,10 @@ class BaseMLBundle(ABC):
     def name(self) -> str:
         return self._name
 
+    @property
+    def root_dir(self) -> str:
+        return self._root_dir
+
     @property
     def config(self) -> dict:
         return self._config
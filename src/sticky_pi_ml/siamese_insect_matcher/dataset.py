@@ -19,7 +19,6 @@ import random
 from sticky_pi_ml.dataset import BaseDataset
 from sticky_pi_ml.annotations import Annotation
 from sticky_pi_ml.siamese_insect_matcher.siam_svg import SiamSVG
-from sticky_pi_ml.siamese_insect_matcher.model import SiameseNet
 from sticky_pi_ml.utils import pad_to_square, detectron_to_pytorch_transform, iou, md5
 
 to_tensor_tr = ToTensor()
@@ -32,10 +31,7 @@ class DataEntry(object):
     def __init__(self, a0: Annotation,
                  a1: Annotation,
                  im1: np.ndarray, n_pairs: int,
-                 data_transforms=None, dist_t_transforms=None,
-                 # a hash of the net used and to cache the result of convolution,
-                 # when matching all against all, we really don';t need to comput the full convolution for each layer!
-                 net_for_cache: SiameseNet = None):
+                 data_transforms=None, dist_t_transforms=None):
         """
         A class to compute and store the data for the siamese insect matcher. 
          
@@ -45,37 +41,20 @@ class DataEntry(object):
         :param n_pairs: the number of annotation pairs 
         :param data_transforms: the transforms to apply to the data for augmentation
         :param dist_t_transforms: the transforms to apply to the distance and delta time between annotations -- for augmentation
-        :param net_for_cache: the network used to compute convolutions on the images in a0 and a1. this is used to cache
-            intermediary results
         """
 
         if data_transforms is None:
             data_transforms = self._default_transform
 
-        try:
-            self._c0 = a0.cached_conv[net_for_cache]
-            self._x0 = None
-        except KeyError:
-            self._x0 = DataEntry.make_array_for_annot(a0)
-            self._x0 = data_transforms[0](self._x0)
-            self._c0 = None
-
-        try:
-            self._c1 = a1.cached_conv[net_for_cache]
-            self._x1 = None
-        except KeyError:
-            self._x1 = DataEntry.make_array_for_annot(a1)
-            self._x1 = data_transforms[1](self._x1)
-            self._c1 = None
-
-        try:
-            self._c1_0 = a0.cached_conv[(net_for_cache, a1.datetime)]
-            self._x1_a0 = None
-        except KeyError:
-            # view of a0 in im1 => info about whether insect has moved! (if so, no insect in im0 * a1)
-            self._x1_a0 = DataEntry.make_array_for_annot(a0, source_array=im1)
-            self._x1_a0 = data_transforms[0](self._x1_a0)
-            self._c1_0 = None
+        self._x0 = DataEntry.make_array_for_annot(a0)
+        self._x0 = data_transforms[0](self._x0)
+
+        self._x1 = DataEntry.make_array_for_annot(a1)
+        self._x1 = data_transforms[1](self._x1)
+
+        # view of a0 in im1 => info about whether insect has moved! (if so, no insect in im0 * a1)
+        self._x1_a0 = DataEntry.make_array_for_annot(a0, source_array=im1)
+        self._x1_a0 = data_transforms[0](self._x1_a0)
 
         dist = abs(a0.center - a1.center)
         if dist_t_transforms is not None:
@@ -105,9 +84,6 @@ class DataEntry(object):
         out = {'x0': self._x0,
                'x1': self._x1,
                'x1_a0': self._x1_a0,
-               'c0': self._c0,
-               'c1': self._c1,
-               'c1_0': self._c1_0,
                'log_d': self._log_dist,
                'ar': self._ar,
                'area_0': self._area_0,
@@ -117,7 +93,7 @@ class DataEntry(object):
         if add_dim:
             with torch.no_grad():
                 for k in out.keys():
-                    if out[k] is not None and k not in {'c0', 'c1', 'c1_0'}:
+                    if out[k] is not None:
                         out[k].unsqueeze_(0)
         todel = [k for k in out.keys() if out[k] is None]
         for t in todel:
@@ -226,6 +202,13 @@ class Dataset(BaseDataset):
         logging.info(f"Training set:   {len(self._training_data)} pairs")
         logging.info(f"Validation set: {len(self._validation_data)} pairs")
 
+    def validation_siam_svgs(self) -> List[SiamSVG]:
+        """
+        :return: the annotated image pairs of the validation set, with all their annotations
+        """
+        return [SiamSVG(p) for p in sorted(glob.glob(os.path.join(self._data_dir, '*.svg')))
+                if md5(p) > self._md5_max_training]
+
     def _serialise_imgs_to_dicts(self, input_img_list: List[str]):
 
         mem = joblib.Memory(location=self._cache_dir, verbose=False)
@@ -0,0 +1,159 @@
+import logging
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from sticky_pi_ml.annotations import Annotation
+
+
+class EmbeddingStore(object):
+    _initial_capacity = 1024
+
+    def __init__(self, dim: int = 1024, max_bytes: int = None, dtype=np.float32):
+        """
+        A table of the convolution embeddings of annotations, as rows of a single array.
+        An embedding is identified by ``(image, annotation index, view)``, where ``image`` is the filename of the
+        parent image of the annotation, and ``view`` the filename of the image the annotation was cropped from,
+        or ``None`` for the parent image itself (e.g. a0 cropped in the next image is a different embedding).
+        When the table is full, the rows of the least recently used embeddings are reused.
+
+        :param dim: the dimension of the embeddings
+        :param max_bytes: the maximal size of the table, in bytes. ``None`` for no limit
+        :param dtype: the type of the stored embeddings
+        """
+        self._dim = dim
+        self._dtype = np.dtype(dtype)
+        self._max_rows = None if max_bytes is None else max(1, max_bytes // (dim * self._dtype.itemsize))
+        self._vectors = np.empty((0, dim), dtype=self._dtype)
+        # key -> row, from the least to the most recently used
+        self._rows = OrderedDict()
+        self._free_rows = []
+        # image filename -> (annotation list, {id(annotation): index}), for the images that have rows.
+        # Holding the list keeps its annotations alive, so their ids are not reused
+        self._annotation_indices = {}
+        # image filename -> number of rows
+        self._image_rows = Counter()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ', '.join('%s=%i' % kv for kv in self.stats.items()))
+
+    @property
+    def nbytes(self) -> int:
+        return self._vectors.nbytes
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'embeddings': len(self._rows),
+                'bytes': self.nbytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'images': len(self._image_rows)}
+
+    def key(self, annotation: Annotation, view: str = None) -> Tuple[str, int, str]:
+        """
+        :param annotation: an annotation, with a parent image
+        :param view: the filename of the image the annotation is cropped from. ``None`` for its parent image
+        :return: the key of the embedding
+        """
+        image = annotation.parent_image
+        annotations, indices = self._annotation_indices.get(image.filename, (None, None))
+        # the image may have been re-instantiated, with new annotation objects
+        if annotations is not image.annotations or id(annotation) not in indices:
+            annotations = image.annotations
+            indices = {id(a): i for i, a in enumerate(annotations)}
+            self._annotation_indices[image.filename] = annotations, indices
+        return image.filename, indices[id(annotation)], view
+
+    def get_or_compute(self, keys: List[Tuple[str, int, str]],
+                       compute: Callable[[List[int]], np.ndarray]) -> np.ndarray:
+        """
+        :param keys: the keys of the embeddings, as made by :meth:`key`
+        :param compute: a function that takes the positions, in ``keys``, of the missing embeddings,
+            and returns them as an array (one row per position)
+        :return: the embeddings, as a ``len(keys) x dim`` array
+        """
+        out = np.empty((len(keys), self._dim), dtype=self._dtype)
+        missing = []
+        for k, key in enumerate(keys):
+            row = self._rows.get(key)
+            if row is None:
+                missing.append(k)
+            else:
+                self._rows.move_to_end(key)
+                out[k] = self._vectors[row]
+        self._hits += len(keys) - len(missing)
+        self._misses += len(missing)
+        if len(missing) == 0:
+            return out
+
+        computed = compute(missing)
+        out[missing] = computed
+        for k in missing:
+            # the same key can be requested twice
+            if keys[k] not in self._rows:
+                # allocating may grow the table, so the row is allocated first
+                row = self._allocate_row(keys[k])
+                self._vectors[row] = out[k]
+        return out
+
+    def _allocate_row(self, key: Tuple[str, int, str]) -> int:
+        if len(self._free_rows) == 0:
+            n_rows = len(self._vectors)
+            if self._max_rows is None or n_rows < self._max_rows:
+                new_n_rows = max(self._initial_capacity, 2 * n_rows)
+                if self._max_rows is not None:
+                    new_n_rows = min(new_n_rows, self._max_rows)
+                vectors = np.empty((new_n_rows, self._dim), dtype=self._dtype)
+                vectors[:n_rows] = self._vectors
+                self._vectors = vectors
+                self._free_rows = list(range(new_n_rows - 1, n_rows - 1, -1))
+            else:
+                old_key, row = self._rows.popitem(last=False)
+                self._evictions += 1
+                self._release_image(old_key[0])
+                self._free_rows.append(row)
+        row = self._free_rows.pop()
+        self._rows[key] = row
+        self._image_rows[key[0]] += 1
+        return row
+
+    def _release_image(self, filename: str):
+        self._image_rows[filename] -= 1
+        # the annotation indices of an image are dropped with its last row
+        if self._image_rows[filename] == 0:
+            del self._image_rows[filename]
+            self._annotation_indices.pop(filename, None)
+
+    def drop_image(self, filename: str):
+        """
+        Removes the embeddings of the annotations of an image, and those of annotations cropped from it,
+        e.g. when the image leaves the time window. Their rows are reused before the table grows.
+
+        :param filename: the filename of the image
+        """
+        dropped = [key for key in self._rows if key[0] == filename or key[2] == filename]
+        for key in dropped:
+            self._free_rows.append(self._rows.pop(key))
+            self._release_image(key[0])
+        # the image may have indices, but no row left
+        self._annotation_indices.pop(filename, None)
+
+    def clear(self):
+        """
+        Removes all embeddings and releases the memory of the table.
+        """
+        if len(self._rows) > 0:
+            logging.info('Clearing embeddings: %s' % self)
+        self._vectors = np.empty((0, self._dim), dtype=self._dtype)
+        self._rows.clear()
+        self._free_rows = []
+        self._annotation_indices = {}
+        self._image_rows.clear()
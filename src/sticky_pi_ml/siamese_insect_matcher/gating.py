@@ -0,0 +1,113 @@
+import json
+import logging
+from math import log10
+from typing import List, Tuple, Dict
+
+import numpy as np
+
+from sticky_pi_ml.annotations import Annotation
+from sticky_pi_ml.utils import BBoxGrid
+
+
+class CandidateGate(object):
+    def __init__(self, max_distance: float, max_log_area_ratio: float):
+        """
+        A spatial gate applied before the siamese network, to only score annotation pairs that could plausibly
+        be the same insect. Pairs are candidates when their centers are within ``max_distance`` pixels and
+        their areas within a factor ``10 ** max_log_area_ratio``.
+        Nearby centers are found with a grid, so not all pairs are tested.
+
+        :param max_distance: the maximal distance between the centers of the two annotations, in pixels
+        :param max_log_area_ratio: the maximal absolute value of ``log10(area_1 / area_0)``
+        """
+        self._max_distance = max_distance
+        self._max_log_area_ratio = max_log_area_ratio
+
+    def __repr__(self):
+        return "%s(max_distance=%f, max_log_area_ratio=%f)" % (self.__class__.__name__,
+                                                                 self._max_distance, self._max_log_area_ratio)
+
+    @classmethod
+    def fit(cls, positive_pairs: List[Tuple[Annotation, Annotation]], quantile: float = 0.999, margin: float = 1.25):
+        """
+        Learns the gate envelope from matching annotation pairs (e.g. the positives of the training set).
+
+        :param positive_pairs: a list of ``(a0, a1)`` annotations of the same insect in two frames
+        :param quantile: the quantile of distance and area ratio, in the positive pairs, used as the envelope
+        :param margin: a factor by which the envelope is widened
+        :return: a fitted gate
+        """
+        assert len(positive_pairs) > 0, "Cannot fit a gate without positive pairs"
+        distances = [abs(a0.center - a1.center) for a0, a1 in positive_pairs]
+        log_area_ratios = [abs(log10(a1.area) - log10(a0.area)) for a0, a1 in positive_pairs]
+        return cls(float(np.quantile(distances, quantile) * margin),
+                   float(np.quantile(log_area_ratios, quantile) * margin))
+
+    def to_dict(self) -> Dict[str, float]:
+        return {'max_distance': self._max_distance,
+                'max_log_area_ratio': self._max_log_area_ratio}
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, 'r') as f:
+            return cls(**json.load(f))
+
+    def candidate_mask(self, an0: List[Annotation], an1: List[Annotation]) -> np.ndarray:
+        """
+        :param an0: the annotations of the first image
+        :param an1: the annotations of the second image
+        :return: a boolean ``len(an0) x len(an1)`` matrix, true for the pairs that should be scored
+        """
+        mask = np.zeros((len(an0), len(an1)), dtype=bool)
+        if len(an0) == 0 or len(an1) == 0:
+            return mask
+
+        grid = BBoxGrid(cell_size=max(1, int(self._max_distance)))
+        for a1 in an1:
+            c = a1.center
+            grid.insert((c.real, c.imag, c.real, c.imag))
+
+        log_area_1 = np.array([log10(a.area) for a in an1])
+        centers_1 = np.array([a.center for a in an1])
+        r = self._max_distance
+        for i, a0 in enumerate(an0):
+            c = a0.center
+            js = np.array(grid.query((c.real - r, c.imag - r, c.real + r, c.imag + r)), dtype=int)
+            if len(js) == 0:
+                continue
+            close = np.abs(centers_1[js] - c) <= r
+            similar = np.abs(log_area_1[js] - log10(a0.area)) <= self._max_log_area_ratio
+            mask[i, js[close & similar]] = True
+        return mask
+
+    def evaluate(self, frames: List[Tuple[List[Annotation], List[Annotation], List[Tuple[int, int]]]]) \
+            -> Dict[str, float]:
+        """
+        Measures how many pairs the gate prunes, and how many true matches it loses, on annotated image pairs
+        (e.g. the ``frame_annotations`` of validation ``SiamSVG`` files, with their ``annotation_pairs``).
+        The pruning rate is over all the pairs of annotations between the two frames, and the recall over the matches.
+
+        :param frames: for each pair of images, the annotations of the first and of the second image, and the
+            matching annotations, as ``(index in the first list, index in the second list)``
+        :return: a dictionary with the ``pruning_rate``, the ``recall_loss`` and the number of pairs considered
+        """
+        n_pairs, n_pruned, n_positives, n_lost = 0, 0, 0, 0
+        for an0, an1, positives in frames:
+            mask = self.candidate_mask(an0, an1)
+            n_pairs += mask.size
+            n_pruned += mask.size - np.count_nonzero(mask)
+            n_positives += len(positives)
+            n_lost += sum(1 for i, j in positives if not mask[i, j])
+
+        out = {'n_pairs': n_pairs,
+               'n_positives': n_positives,
+               'pruning_rate': n_pruned / n_pairs if n_pairs else float('nan'),
+               'recall_loss': n_lost / n_positives if n_positives else float('nan')}
+        logging.info("Candidate gate %s: pruned %i/%i pairs (%.2f%%), lost %i/%i positives (%.2f%%)" %
+                     (self, n_pruned, n_pairs, 100 * out['pruning_rate'], n_lost, n_positives,
+                      100 * out['recall_loss']))
+        return out
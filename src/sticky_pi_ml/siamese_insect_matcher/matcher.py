@@ -1,25 +1,144 @@
 import os
+import datetime
 import pandas as pd
 import tempfile
 import shutil
 import logging
-from functools import lru_cache
+import heapq
+import collections
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
-import networkx as nx
-from typing import List
+import torch
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from typing import List, Tuple
 
 from sticky_pi_ml.siamese_insect_matcher.predictor import Predictor
 from sticky_pi_ml.siamese_insect_matcher.ml_bundle import MLBundle
 from sticky_pi_ml.tuboid import Tuboid, TiledTuboid
-from sticky_pi_ml.image import ImageSeries
+from sticky_pi_ml.image import ImageSeries, Image
+from sticky_pi_ml.assignment import assign
+
+# the predictor of a drafting worker (one per process, or per thread)
+_draft_worker = threading.local()
+
+
+def _init_draft_worker(ml_bundle: MLBundle, PredictorClass, n_threads: int = None):
+    if n_threads is not None:
+        # we cap intra-op threads so that workers do not oversubscribe the cores
+        torch.set_num_threads(n_threads)
+    _draft_worker.predictor = PredictorClass(ml_bundle)
+
+
+def _draft_frames(images: List[Image], predictor: Predictor = None) -> List[List[Tuple[int, int, float]]]:
+    """
+    Matches consecutive images, in order.
+
+    :param images: a contiguous chunk of a sorted image series
+    :param predictor: the predictor to use. ``None`` for the one of the current drafting worker
+    :return: for each pair of consecutive images, the matches as ``(annotation index in the first image,
+        annotation index in the second image, score)``
+    """
+    worker = predictor is None
+    if worker:
+        predictor = _draft_worker.predictor
+    out = []
+    s0 = images[0]
+    for s1 in images[1:]:
+        arr = predictor.match_all_annots(s0.annotations, s1.annotations)
+        out.append(assign(arr, predictor.assignment_method))
+        # optimisation: the first image had been cached so that
+        # matching / extraction of the sub-image can be faster. For now, we clear the cache
+        s0.clear_cache()
+        predictor.embeddings.drop_image(s0.filename)
+        s0 = s1
+    s0.clear_cache()
+    if worker:
+        # workers outlive the series
+        predictor.embeddings.clear()
+    return out
+
+
+def _ordered_components(n_nodes: int, u: np.ndarray, v: np.ndarray, rank: np.ndarray) -> List[np.ndarray]:
+    """
+    Finds the connected components of a graph given as arrays of edges, ignoring their direction.
+    Components are sorted by the rank of their first node, and nodes by rank, which is the order of
+    ``networkx.weakly_connected_components`` when nodes are added to the graph by increasing rank.
+
+    :param n_nodes: the number of nodes
+    :param u: the first node of each edge
+    :param v: the second node of each edge
+    :param rank: the rank of each node. Nodes ranked ``n_nodes`` or more are not in the graph, unless connected
+    :return: the nodes of each component
+    """
+    graph = coo_matrix((np.ones(len(u), dtype=np.int8), (u, v)), shape=(n_nodes, n_nodes))
+    n_components, labels = connected_components(graph, directed=False)
+    first_rank = np.full(n_components, n_nodes, dtype=np.int64)
+    np.minimum.at(first_rank, labels, rank)
+    # components are grouped, in order, and nodes sorted by rank within components
+    position = np.empty(n_components, dtype=np.int64)
+    position[np.argsort(first_rank, kind='stable')] = np.arange(n_components)
+    nodes = np.lexsort((rank, position[labels]))
+    sizes = np.bincount(position[labels], minlength=n_components)
+    components = np.split(nodes, np.cumsum(sizes)[:-1])
+    return [c for c, r in zip(components, np.sort(first_rank)) if r < n_nodes]
+
+
+def _draft_components(n_annotations: List[int], all_edges: List[List[Tuple[int, int, float]]]) -> List[np.ndarray]:
+    """
+    Groups the annotations of consecutive frames linked by matches.
+
+    :param n_annotations: the number of annotations in each frame
+    :param all_edges: for each pair of consecutive frames, the matches as ``(annotation index in the first frame,
+        annotation index in the second frame, score)``
+    :return: the annotations of each group, as indices in the concatenated annotations of all frames
+    """
+    offsets = np.cumsum([0] + list(n_annotations))
+    n_nodes = offsets[-1]
+    u, v = [], []
+    # nodes are ranked as they would be added to a graph, frame pair by frame pair: first through edges,
+    # then all the nodes of the two frames
+    sequence = []
+    for i, edges in enumerate(all_edges):
+        pairs = np.array([(j0, j1) for j0, j1, _ in edges], dtype=np.int64).reshape(-1, 2)
+        u.append(offsets[i] + pairs[:, 0])
+        v.append(offsets[i + 1] + pairs[:, 1])
+        sequence.append(np.stack((u[-1], v[-1]), axis=1).ravel())
+        sequence.append(np.arange(offsets[i], offsets[i + 2]))
+    u = np.concatenate(u) if u else np.zeros(0, dtype=np.int64)
+    v = np.concatenate(v) if v else np.zeros(0, dtype=np.int64)
+    rank = np.full(n_nodes, n_nodes, dtype=np.int64)
+    if sequence:
+        sequence = np.concatenate(sequence)
+        first_index = np.unique(sequence, return_index=True)[1]
+        rank[sequence[np.sort(first_index)]] = np.arange(len(first_index))
+    return _ordered_components(n_nodes, u, v, rank)
 
 
 class Matcher(object):
     _tub_min_length = 3
-
-    def __init__(self, ml_bundle: MLBundle, PredictorClass=Predictor):
+    _draft_backends = {'process', 'thread'}
+    # number of chunks of frames per drafting worker, to balance the load
+    _draft_chunks_per_worker = 4
+
+    def __init__(self, ml_bundle: MLBundle, PredictorClass=Predictor, n_workers: int = 1,
+                 draft_backend: str = 'process'):
+        """
+        :param ml_bundle: the ML bundle
+        :param PredictorClass: the class of the predictor
+        :param n_workers: the number of workers matching consecutive frames in parallel, in the drafting stage.
+            Each has its own predictor. The other stages are sequential
+        :param draft_backend: the type of drafting workers, ``'process'`` or ``'thread'``
+        """
+        assert draft_backend in self._draft_backends, \
+            "Unknown backend `%s`. Valid backends are: %s" % (draft_backend, self._draft_backends)
         self._predictor = PredictorClass(ml_bundle)
+        self._PredictorClass = PredictorClass
         self._ml_bundle = ml_bundle
+        self._n_workers = n_workers
+        self._draft_backend = draft_backend
 
     def match_client(self, annotated_images_series: ImageSeries, video_dir: str = None):
 
@@ -98,35 +217,52 @@ class Matcher(object):
         return tuboids
 
     def _draft_graph(self, annotated_images: ImageSeries) -> List[Tuboid]:
-        dg = nx.DiGraph()
         annotated_images.sort(key=lambda x: x.datetime)
-        s0, s1 = annotated_images[0:2]
-        for i, _ in enumerate(annotated_images[1:-1]):
-            logging.info('Drafting, %i/%i; %i edges in graph' % (i + 1, len(annotated_images) - 2, len(dg.edges)))
-            s1 = annotated_images[i + 1]
-            edges, nodes = self._predictor.match_two_images(s0, s1)
-
-            # add the resulting nodes and edges to the overall graph
-            # we define these primary edges as not stitched (as opposed to edges that span multiple frames)
-            dg.add_weighted_edges_from(edges, stitched=False)
-            # only add nodes that do not exist
-            for k, v in nodes.items():
-                if k not in dg.nodes:
-                    dg.add_node(k)
-                dg.nodes[k].update({'annotation': v})
-            # optimisation: the first image had been cached so that
-            # matching / extraction of the sub-image can be faster. For now, we clear the cache
-            s0.clear_cache()
-            s0 = s1
-
-        s1.clear_cache()
+        # the frames matched pairwise, as (0, 1), (1, 2) ... The last image is not included
+        frames = annotated_images[:-1]
+        n_pairs = len(frames) - 1
+
+        if self._n_workers > 1 and n_pairs > 1:
+            all_edges = self._draft_frames_parallel(frames)
+        else:
+            all_edges = _draft_frames(frames, self._predictor)
 
+        # the graph is assembled in the order of the frames, so the result does not depend on the number of workers
+        annotations = [a for im in frames for a in im.annotations]
         tuboids = []
-        for sub_graph in nx.weakly_connected_components(dg):
-            annotations = [nd[1]['annotation'] for nd in dg.subgraph(sub_graph).nodes(data=True)]
-            tuboids.append(Tuboid(annotations, self._ml_bundle.version, parent_series=annotated_images))
+        for nodes in _draft_components([len(im.annotations) for im in frames], all_edges):
+            tuboids.append(Tuboid([annotations[k] for k in nodes], self._ml_bundle.version,
+                                  parent_series=annotated_images))
         return tuboids
 
+    def _draft_frames_parallel(self, frames: List[Image]) -> List[List[Tuple[int, int, float]]]:
+        n_pairs = len(frames) - 1
+        n_chunks = min(n_pairs, self._n_workers * self._draft_chunks_per_worker)
+        bounds = np.linspace(0, n_pairs, n_chunks + 1).round().astype(int)
+        # consecutive chunks share their boundary frame
+        chunks = [frames[b0: b1 + 1] for b0, b1 in zip(bounds[:-1], bounds[1:])]
+        logging.info('Drafting %i frame pairs in %i chunks, with %i %s workers' %
+                     (n_pairs, n_chunks, self._n_workers, self._draft_backend))
+
+        if self._draft_backend == 'thread':
+            pool = ThreadPool(self._n_workers, _init_draft_worker, (self._ml_bundle, self._PredictorClass))
+        else:
+            n_threads = max(1, multiprocessing.cpu_count() // self._n_workers)
+            pool = multiprocessing.Pool(self._n_workers, _init_draft_worker,
+                                        (self._ml_bundle, self._PredictorClass, n_threads))
+        try:
+            all_edges = []
+            for i, edges in enumerate(pool.imap(_draft_frames, chunks)):
+                logging.info('Drafted chunk %i/%i' % (i + 1, n_chunks))
+                all_edges.extend(edges)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return all_edges
+
     def _stitch_sub_graphs(self, tuboids: List[Tuboid], annotated_images_series: ImageSeries) -> List[Tuboid]:
         ntub = len(tuboids)
         if ntub < 2:
@@ -139,17 +275,17 @@ class Matcher(object):
                 arr[i, j] = score
             # fixme. release parent image for annot i here? that would free memory?
 
-        edges = []
-        while np.sum(arr) > 0.0:
-            i, j = np.unravel_index(arr.argmax(), arr.shape)
-            edges.append((i, j, arr[i, j]))
-            arr[i, :] = 0
-            arr[:, j] = 0
+        edges = assign(arr, self._predictor.assignment_method)
 
-        dg = nx.DiGraph()
-        dg.add_weighted_edges_from(edges)
+        # tuboids are ranked by first appearance in the edges, from the best score
+        u = np.array([i for i, _, _ in edges], dtype=np.int64)
+        v = np.array([j for _, j, _ in edges], dtype=np.int64)
+        rank = np.full(ntub, ntub, dtype=np.int64)
+        uv = np.stack((u, v), axis=1).ravel()
+        first_index = np.unique(uv, return_index=True)[1]
+        rank[uv[np.sort(first_index)]] = np.arange(len(first_index))
 
-        for sdg in nx.weakly_connected_components(dg):
+        for sdg in _ordered_components(ntub, u, v, rank):
             annots_to_merge = []
             for tb in sdg:
                 annots_to_merge.extend(tuboids[tb])
@@ -167,39 +303,50 @@ class Matcher(object):
     # * they have no coincident reads
     # Typically, conjoint tuboids are the same instance, but falsely clustered as multiple ones.
     # the goal is to iteratively merge conjoint tuboids
-    def _merge_conjoint_tuboids(self, tuboids, annotated_images_series: ImageSeries, iteration=0):
-        ntub = len(tuboids)
-        if ntub < 2:
+    def _merge_conjoint_tuboids(self, tuboids, annotated_images_series: ImageSeries):
+        """
+        Iteratively merges the best matching pair of conjoint tuboids, until none is left.
+        Pair scores are kept in a priority queue, so after each merge, only the pairs involving the new tuboid are
+        scored. Tuboids are ranked by creation order (i.e. their position in the list, the merged ones being appended)
+        so that ties are resolved as the ``argmax`` of the full score matrix would.
+        """
+        if len(tuboids) < 2:
             return tuboids
-        logging.info('Merging conjoint tuboids. Iteration %i' % iteration)
-        arr = np.zeros((ntub, ntub), dtype=np.float)
-        for i in range(ntub):
-            tb0 = tuboids[i]
-            for j in range(i + 1, ntub):
-                tb1 = tuboids[j]
-                if self._is_tuboid_pair_conjoint(tb0, tb1):
-                    match = self._predictor.match_two_tuboids(tb0, tb1)
-                    if match:
-                        arr[i, j] = match
-        logging.info('n tuboid matches: %i' % np.sum(arr > 0))
-        if np.sum(arr) == 0:
-            return tuboids
-
-        i, j = np.unravel_index(arr.argmax(), arr.shape)
 
-        assert j > i
-        tb1 = tuboids.pop(j)
-        tb0 = tuboids.pop(i)
+        # rank -> tuboid. dicts keep insertion order, which is also the rank order
+        alive = {}
+        heap = []
 
-        merged_tuboid = Tuboid(tb1 + tb0, self._ml_bundle.version, parent_series=annotated_images_series)
-        tuboids.append(merged_tuboid)
-
-        # we recurse as still need to merge some tuboids
-        tuboids = self._merge_conjoint_tuboids(tuboids, annotated_images_series, iteration=iteration + 1)
-        return tuboids
+        def push_pairs(rank, tb):
+            for other_rank, other in alive.items():
+                if self._is_tuboid_pair_conjoint(other, tb):
+                    match = self._predictor.match_two_tuboids(other, tb)
+                    if match:
+                        heapq.heappush(heap, (-match, other_rank, rank))
+            alive[rank] = tb
+
+        for rank, tb in enumerate(tuboids):
+            push_pairs(rank, tb)
+        logging.info('n tuboid matches: %i' % len(heap))
+
+        next_rank = len(tuboids)
+        n_merges = 0
+        while heap:
+            _, i, j = heapq.heappop(heap)
+            # lazy deletion: pairs of already merged tuboids are obsolete
+            if i not in alive or j not in alive:
+                continue
+            tb0 = alive.pop(i)
+            tb1 = alive.pop(j)
+            merged_tuboid = Tuboid(tb1 + tb0, self._ml_bundle.version, parent_series=annotated_images_series)
+            push_pairs(next_rank, merged_tuboid)
+            next_rank += 1
+            n_merges += 1
+        logging.info('Merged %i pairs of conjoint tuboids' % n_merges)
+        return list(alive.values())
 
-    @lru_cache(maxsize=None)
-    def _is_tuboid_pair_conjoint(self, tb0, tb1):
+    @staticmethod
+    def _is_tuboid_pair_conjoint(tb0, tb1):
         if len(tb0) + len(tb1) < 3:
             return False
 
@@ -207,17 +354,18 @@ class Matcher(object):
                 tb1.tail_datetime > tb0.head_datetime > tb1.head_datetime):
             return False
 
-        # todo optimise. lists are presorted!
-        for t0 in tb0:
-            for t1 in tb1:
-                if t1.datetime == t0.datetime:
-                    return False
-        return True
+        # timestamps are sorted, so we look up each read of tb0 in tb1
+        ts0, ts1 = tb0.timestamps, tb1.timestamps
+        idx = np.minimum(np.searchsorted(ts1, ts0), len(ts1) - 1)
+        return not np.any(ts1[idx] == ts0)
 
     def _clean_up(self, annotated_images_series: ImageSeries):
         logging.info('deleting img cache!')
         for im in annotated_images_series:
             im.clear_cache()
+        self._predictor.embeddings.clear()
+        logging.info('Tuboid cache: %s' % self._predictor.tuboid_cache)
+        self._predictor.tuboid_cache.clear(annotated_images_series.name)
 
     @staticmethod
     def make_video(tuboids, out, annotated_images_series: ImageSeries, scale=(1600, 1200), fps=4, show=False):
@@ -257,3 +405,140 @@ class Matcher(object):
         finally:
             if vw is not None:
                 vw.release()
+
+
+class OnlineMatcher(object):
+    def __init__(self, ml_bundle: MLBundle, series: ImageSeries, PredictorClass=Predictor):
+        """
+        Tracks insects in a series, one annotated image at a time (e.g. as they arrive from the API), instead of
+        the batch passes of :class:`Matcher`. The same three stages are done incrementally:
+
+        * drafting -- each image is matched to the previous one, extending the open tracks;
+        * stitching -- annotations left unmatched are matched to the tails of the tracks that were not extended;
+        * merging -- a track is closed once its tail is older than ``MAX_DELTA_T_TO_MATCH``,
+          as it can no longer be matched. It is then merged into its best conjoint track, if any, or emitted.
+
+        Only the images of this time window and the open tracks are kept, so memory does not grow with the length
+        of the series. Merges are decided when tracks close rather than globally, so the tuboids can differ slightly
+        from those of :meth:`Matcher.match`.
+
+        :param ml_bundle: the ML bundle
+        :param series: the series the images belong to. It is the ``parent_series`` of the tuboids, and images
+            are not added to it
+        :param PredictorClass: the class of the predictor
+        """
+        self._predictor = PredictorClass(ml_bundle)
+        self._ml_bundle = ml_bundle
+        self._series = series
+        self._max_delta_t = datetime.timedelta(seconds=ml_bundle.config['MAX_DELTA_T_TO_MATCH'])
+        # the images within the time window, from the oldest
+        self._window = collections.deque()
+        # track id -> annotations, by datetime
+        self._tracks = {}
+        # track id -> tuboid of the track, until the track changes. So that the uid of a tuboid (which keys the
+        # cache of the predictor) is the same for as long as its annotations
+        self._track_tuboids = {}
+        # annotation index in the last image -> track id
+        self._last_image_tracks = {}
+        self._n_tracks = 0
+        self._n_emitted = 0
+
+    @property
+    def n_open_tracks(self) -> int:
+        return len(self._tracks)
+
+    def add_image(self, image: Image) -> List[Tuboid]:
+        """
+        :param image: the next annotated image of the series. Images must be added in chronological order
+        :return: the tuboids finalised by this image
+        """
+        previous = self._window[-1] if len(self._window) > 0 else None
+        if previous is not None:
+            assert image.datetime > previous.datetime, "Images must be added in chronological order"
+        self._window.append(image)
+        annotations = image.annotations
+
+        image_tracks = {}
+        if previous is not None:
+            arr = self._predictor.match_all_annots(previous.annotations, annotations)
+            previous.clear_cache()
+            for i, j, _ in assign(arr, self._predictor.assignment_method):
+                image_tracks[j] = self._last_image_tracks[i]
+        image_tracks.update(self._stitch(annotations, image_tracks))
+
+        for j, a in enumerate(annotations):
+            if j not in image_tracks:
+                image_tracks[j] = self._n_tracks
+                self._tracks[self._n_tracks] = []
+                self._n_tracks += 1
+            self._tracks[image_tracks[j]].append(a)
+            self._track_tuboids.pop(image_tracks[j], None)
+        self._last_image_tracks = image_tracks
+
+        while image.datetime - self._window[0].datetime > self._max_delta_t:
+            old_image = self._window.popleft()
+            old_image.clear_cache()
+            self._predictor.embeddings.drop_image(old_image.filename)
+        closed = [k for k, track in self._tracks.items()
+                  if image.datetime - track[-1].datetime > self._max_delta_t]
+        return self._close(closed)
+
+    def flush(self) -> List[Tuboid]:
+        """
+        Closes all the tracks, e.g. at the end of the series.
+
+        :return: the remaining tuboids
+        """
+        out = self._close(list(self._tracks.keys()))
+        for im in self._window:
+            im.clear_cache()
+        self._window.clear()
+        self._last_image_tracks = {}
+        self._track_tuboids = {}
+        self._predictor.embeddings.clear()
+        self._predictor.tuboid_cache.clear(self._series.name)
+        return out
+
+    def _stitch(self, annotations, image_tracks):
+        # the open tracks that were not extended, and the unmatched annotations
+        extended = set(image_tracks.values())
+        tracks = [k for k in self._tracks.keys() if k not in extended]
+        unmatched = [j for j in range(len(annotations)) if j not in image_tracks]
+        if len(tracks) == 0 or len(unmatched) == 0:
+            return {}
+
+        arr = np.zeros((len(tracks), len(unmatched)), dtype=np.float)
+        for i, k in enumerate(tracks):
+            for j, u in enumerate(unmatched):
+                arr[i, j] = self._predictor.match_two_annots(self._tracks[k][-1], annotations[u])
+        return {unmatched[j]: tracks[i] for i, j, _ in assign(arr, self._predictor.assignment_method)}
+
+    def _track_tuboid(self, k: int) -> Tuboid:
+        tuboid = self._track_tuboids.get(k)
+        if tuboid is None:
+            tuboid = Tuboid(self._tracks[k], self._ml_bundle.version, parent_series=self._series)
+            self._track_tuboids[k] = tuboid
+        return tuboid
+
+    def _close(self, closed: List[int]) -> List[Tuboid]:
+        out = []
+        for k in closed:
+            tuboid = self._track_tuboid(k)
+            del self._tracks[k]
+            del self._track_tuboids[k]
+            # the best conjoint track, among all the remaining ones (open or about to be closed)
+            best, best_score = None, 0
+            for other_k in self._tracks.keys():
+                other = self._track_tuboid(other_k)
+                if Matcher._is_tuboid_pair_conjoint(other, tuboid):
+                    score = self._predictor.match_two_tuboids(other, tuboid)
+                    if score > best_score:
+                        best, best_score = other_k, score
+            if best is not None:
+                self._tracks[best] = sorted(self._tracks[best] + list(tuboid), key=lambda a: a.datetime)
+                self._track_tuboids.pop(best, None)
+            elif len(tuboid) > Matcher._tub_min_length:
+                tuboid.set_id(self._n_emitted)
+                self._n_emitted += 1
+                out.append(tuboid)
+        return out
@@ -1,11 +1,17 @@
 from sticky_pi_ml.ml_bundle import BaseMLBundle
 from sticky_pi_ml.siamese_insect_matcher.dataset import Dataset
+import os
 import yaml
 
 
 class MLBundle(BaseMLBundle):
     _name = 'siamese-insect-matcher'
     _DatasetClass = Dataset
+    _gating_filename = 'gating.json'
+
+    @property
+    def gating_file(self):
+        return os.path.join(self._output_dir, self._gating_filename)
 
     def _configure(self, config_file, device):
         with open(config_file, 'r') as file:
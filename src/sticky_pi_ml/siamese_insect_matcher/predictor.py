@@ -1,7 +1,8 @@
+import os
 import numpy as np
 import torch
 import logging
-from functools import lru_cache
+from math import log10
 from typing import Dict, Tuple, List, Any
 
 from sticky_pi_ml.predictor import BasePredictor
@@ -10,20 +11,60 @@ from sticky_pi_ml.image import Image
 from sticky_pi_ml.siamese_insect_matcher.ml_bundle import MLBundle
 from sticky_pi_ml.annotations import Annotation
 
-from sticky_pi_ml.siamese_insect_matcher.dataset import Dataset, DataEntry
+from sticky_pi_ml.siamese_insect_matcher.dataset import Dataset, DataEntry, to_tensor_tr
+from sticky_pi_ml.siamese_insect_matcher.gating import CandidateGate
+from sticky_pi_ml.siamese_insect_matcher.embeddings import EmbeddingStore
+from sticky_pi_ml.assignment import assign
+from sticky_pi_ml.utils import BoundedCache
 
 
 class Predictor(BasePredictor):
 
     _model_class = SiameseNet
+    # number of annotation crops per forward pass of the convolution branch
+    _conv_batch_size = 64
+    # number of annotation pairs scored per forward pass of the fully connected layers
+    _pair_batch_size = 8192
 
     def __init__(self, ml_bundle: MLBundle):
         super().__init__(ml_bundle)
         self._max_delta_t = ml_bundle.config['MAX_DELTA_T_TO_MATCH']
+        self._assignment_method = ml_bundle.config.get('ASSIGNMENT_METHOD', 'greedy')
         self._net = self._model_class()
         weights = self._ml_bundle.weight_file
         self._net.load_state_dict(torch.load(weights))
         self._net.eval()
+        self._gate = None
+        if ml_bundle.config.get('GATING_QUANTILE') is not None:
+            if os.path.isfile(ml_bundle.gating_file):
+                self._gate = CandidateGate.load(ml_bundle.gating_file)
+            else:
+                logging.warning('No candidate gate in %s. Scoring all annotation pairs' % ml_bundle.gating_file)
+        self._embeddings = EmbeddingStore(max_bytes=ml_bundle.config.get('EMBEDDING_STORE_MAX_BYTES'))
+        self._tuboid_cache = BoundedCache(max_entries=ml_bundle.config.get('TUBOID_CACHE_MAX_ENTRIES'),
+                                          max_bytes=ml_bundle.config.get('TUBOID_CACHE_MAX_BYTES'))
+
+    @property
+    def gate(self) -> CandidateGate:
+        return self._gate
+
+    @property
+    def assignment_method(self) -> str:
+        return self._assignment_method
+
+    @property
+    def embeddings(self) -> EmbeddingStore:
+        """
+        The convolution embeddings of the annotations matched so far.
+        """
+        return self._embeddings
+
+    @property
+    def tuboid_cache(self) -> BoundedCache:
+        """
+        The cache of tuboid pair scores, scoped by image series name.
+        """
+        return self._tuboid_cache
 
     def match_two_images(self, im0: Image, im1: Image) -> Tuple[List[Tuple[str, str, float]], Dict[str, Any]]:
         an0 = im0.annotations
@@ -37,87 +78,158 @@ class Predictor(BasePredictor):
             node_1 = '%s|%i' % (a1.parent_image.filename, n)
             nodes[node_1] = a1
 
-        arr = np.zeros((len(an0), len(an1)), dtype=np.float)
-
-        for m, a0 in enumerate(an0):
-            for n, a1 in enumerate(an1):
-                score = self.match_two_annots(a0, a1, n_pairs=len(an0))
-                arr[m, n] = score
-            a0.parent_image.clear_cache(clear_annot_cached_conv=False)
+        arr = self.match_all_annots(an0, an1)
+        if len(an0) > 0:
+            an0[0].parent_image.clear_cache()
 
         edges = []
-        while np.sum(arr) > 0:
-            i, j = np.unravel_index(arr.argmax(), arr.shape)
+        for i, j, score in assign(arr, self._assignment_method):
             node_0 = '%s|%i' % (im0.filename, i)
             node_1 = '%s|%i' % (im1.filename, j)
-            edges.append((node_0, node_1, arr[i, j]))
-            arr[i, :] = 0
-            arr[:, j] = 0
+            edges.append((node_0, node_1, score))
         return edges, nodes
 
-    def match_two_annots(self, a0: Annotation,
-                         a1: Annotation,
-                         n_pairs=None,
-                         score_threshold=0.50,
-                         cache_conv_a0=True,
-                         cache_conv_a1=True,
-                         cache_conv_a0_im1=True):
+    def match_all_annots(self, an0: List[Annotation], an1: List[Annotation], score_threshold=0.50) -> np.ndarray:
+        """
+        Scores all pairs of annotations between two images, equivalent to calling
+        :meth:`match_two_annots` on every pair, but convolutions and the fully connected layers run in batches.
+        Convolution results are kept in the embedding store, the same way as :meth:`match_two_annots`.
+        When the ML bundle has a candidate gate, pairs outside its envelope are not scored (their score is zero).
+
+        :param an0: the annotations of the first image
+        :param an1: the annotations of the second image
+        :param score_threshold: scores below this threshold are set to zero
+        :return: a ``len(an0) x len(an1)`` score matrix
+        """
+        arr = np.zeros((len(an0), len(an1)), dtype=np.float)
+        if len(an0) == 0 or len(an1) == 0:
+            return arr
+
+        # all annotations of an image share the same datetime
+        delta_t = (an1[0].datetime - an0[0].datetime).total_seconds()
+        if delta_t <= 0 or delta_t > self._max_delta_t:
+            return arr
 
-        arr1 = a1.parent_image.read(cache=True)
+        # only the candidate pairs are scored, the others have a null score
+        if self._gate is None:
+            mask = np.ones(arr.shape, dtype=bool)
+        else:
+            mask = self._gate.candidate_mask(an0, an1)
+        ii, jj = np.nonzero(mask)
+        if len(ii) == 0:
+            return arr
 
+        with torch.no_grad():
+            arr[ii, jj] = self._score_pairs(an0, an1, ii, jj, delta_t)
+        arr[arr < score_threshold] = 0.0
+        return arr
+
+    def _score_pairs(self, an0: List[Annotation], an1: List[Annotation], ii: np.ndarray, jj: np.ndarray,
+                     delta_t: float) -> np.ndarray:
+        # the same features as `DataEntry`, for all pairs at once
+        log_area_0 = np.array([log10(a.area) for a in an0])
+        log_area_1 = np.array([log10(a.area) for a in an1])
+        centers_0 = np.array([a.center for a in an0])
+        centers_1 = np.array([a.center for a in an1])
+
+        # we only compute the convolutions of annotations involved in at least one pair
+        rows, row_pos = np.unique(ii, return_inverse=True)
+        cols, col_pos = np.unique(jj, return_inverse=True)
+        sub_an0 = [an0[i] for i in rows]
+        sub_an1 = [an1[j] for j in cols]
+
+        c0 = self._conv_embeddings(sub_an0)
+        c1 = self._conv_embeddings(sub_an1)
+        # view of a0 in im1
+        c1_0 = self._conv_embeddings(sub_an0, view_image=an1[0].parent_image)
+        d0_1a0 = self._net.siam_out(torch.abs(c0 - c1_0))
+
+        out = np.zeros(len(ii), dtype=np.float)
+        for start in range(0, len(ii), self._pair_batch_size):
+            batch = slice(start, start + self._pair_batch_size)
+            i, j = ii[batch], jj[batch]
+            ri = torch.from_numpy(row_pos[batch])
+            cj = torch.from_numpy(col_pos[batch])
+            d0_1 = self._net.siam_out(torch.abs(c0[ri] - c1[cj]))
+            data = {'ar': torch.from_numpy(np.abs(log_area_1[j] - log_area_0[i])),
+                    'log_d': torch.from_numpy(np.log10(np.abs(centers_0[i] - centers_1[j]) + 1)),
+                    'area_0': torch.from_numpy(log_area_0[i]),
+                    't': torch.full((len(i),), log10(delta_t + 1), dtype=torch.float64)}
+            out[batch] = self._net._fc(data, d0_1, d0_1a0[ri]).flatten().numpy()
+        return out
+
+    def _conv_embeddings(self, annotations: List[Annotation], view_image: Image = None) -> torch.Tensor:
+        """
+        :param annotations: annotations
+        :param view_image: the image to crop the annotations from. ``None`` for their parent image
+        :return: the output of the convolution branch for each annotation, from the embedding store when possible
+        """
+        view = None if view_image is None else view_image.filename
+
+        def compute(missing):
+            source_array = None if view_image is None else view_image.read(cache=True)
+            out = []
+            for start in range(0, len(missing), self._conv_batch_size):
+                batch = missing[start: start + self._conv_batch_size]
+                x = torch.stack([to_tensor_tr(DataEntry.make_array_for_annot(annotations[k],
+                                                                             source_array=source_array))
+                                 for k in batch])
+                out.append(self._net._conv_branch(x).numpy())
+            return np.concatenate(out)
+
+        keys = [self._embeddings.key(a, view) for a in annotations]
+        return torch.from_numpy(self._embeddings.get_or_compute(keys, compute))
+
+    def match_two_annots(self, a0: Annotation, a1: Annotation, score_threshold=0.50) -> float:
         delta_t = (a1.datetime - a0.datetime).total_seconds()
         if delta_t <= 0 or delta_t > self._max_delta_t:
             return 0.0
         with torch.no_grad():
-            d = DataEntry(a0, a1, arr1, n_pairs, net_for_cache=self._net)
-            score, conv0, conv1, conv0_1 = self._net(d.as_dict(add_dim=True))
-            if cache_conv_a0 and self._net not in a0.cached_conv:
-                a0.set_cached_conv(self._net, conv0)
-            if cache_conv_a0_im1 and (self._net, a1.datetime) not in a0.cached_conv:
-                a0.set_cached_conv((self._net, a1.datetime), conv0_1)
-
-            if cache_conv_a1 and self._net not in a1.cached_conv:
-                a1.set_cached_conv(self._net, conv1)
-
-            score = score.item()
+            score = self._score_pairs([a0], [a1], np.zeros(1, dtype=int), np.zeros(1, dtype=int), delta_t)[0]
 
         if score < score_threshold:
             score = 0.0
         return score
 
-    @lru_cache(maxsize=None)
     def match_two_tuboids(self, tub0, tub1, score_threshold=0.25):
+        scope = tub0.parent_series.name if tub0.parent_series is not None else None
+        key = tub0.uid, tub1.uid, score_threshold
+        score = self._tuboid_cache.get(key, scope)
+        if score is None:
+            score = self._match_two_tuboids(tub0, tub1, score_threshold)
+            self._tuboid_cache.put(key, score, scope)
+        return score
 
+    def _match_two_tuboids(self, tub0, tub1, score_threshold):
         # tub0 is the shortest
         if len(tub0) > len(tub1):
             tub0, tub1 = tub1, tub0
 
+        # for each read of tub0, the closest previous and next reads in tub1 (excluding its last read).
+        # timestamps are sorted, and the first of equal timestamps is used
+        ts0 = tub0.timestamps
+        ts1 = tub1.timestamps[:-1]
         scores = []
-        for i, _ in enumerate(tub0):
-            min_dt_idx_value_prev = None
-            min_dt_idx_value_next = None
-            t0 = tub0[i].datetime
-            for j, _ in enumerate(tub1[:-1]):
-                t1 = tub1[j].datetime
-                current = (t1 - t0).total_seconds()
-
-                if current < 0 and (min_dt_idx_value_prev is None or abs(current) < min_dt_idx_value_prev[1]):
-                    min_dt_idx_value_prev = j, abs(current)
-                if current > 0 and (min_dt_idx_value_next is None or abs(current) < min_dt_idx_value_next[1]):
-                    min_dt_idx_value_next = j, abs(current)
-
-            if min_dt_idx_value_next:
-                if t0 < t1:
-                    tub_a, tub_b = tub0[i], tub1[min_dt_idx_value_next[0]]
-                else:
-                    tub_b, tub_a = tub0[i], tub1[min_dt_idx_value_next[0]]
-                scores.append(self.match_two_annots(tub_a, tub_b))
-            if min_dt_idx_value_prev:
-                if t0 < t1:
-                    tub_a, tub_b = tub0[i], tub1[min_dt_idx_value_prev[0]]
-                else:
-                    tub_b, tub_a = tub0[i], tub1[min_dt_idx_value_prev[0]]
-                scores.append(self.match_two_annots(tub_a, tub_b))
+        if len(ts1) > 0:
+            next_idx = np.searchsorted(ts1, ts0, side='right')
+            prev_end = np.searchsorted(ts1, ts0, side='left')
+            prev_idx = np.searchsorted(ts1, ts1[np.maximum(prev_end - 1, 0)], side='left')
+            # the order of the annotations is given by the last candidate read of tub1
+            forward = ts0 < ts1[-1]
+
+            for i, (n, p_end, p, f) in enumerate(zip(next_idx.tolist(), prev_end.tolist(), prev_idx.tolist(),
+                                                     forward.tolist())):
+                candidates = []
+                if n < len(ts1):
+                    candidates.append(n)
+                if p_end > 0:
+                    candidates.append(p)
+                for j in candidates:
+                    if f:
+                        tub_a, tub_b = tub0[i], tub1[j]
+                    else:
+                        tub_b, tub_a = tub0[i], tub1[j]
+                    scores.append(self.match_two_annots(tub_a, tub_b))
 
         assert len(scores) > 0
         score = np.mean(scores)
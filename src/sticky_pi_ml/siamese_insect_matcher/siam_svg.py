@@ -3,13 +3,12 @@ import datetime
 import cv2
 import numpy as np
 import io
-from xml.etree import ElementTree
 from sticky_pi_ml.image import SVGImage, BufferImage, Image
 from sticky_pi_ml.annotations import Annotation
 from sticky_pi_ml.utils import iou, iou_match_pairs
 from shapely.geometry import Polygon
+from typing import List, Tuple
 import tempfile
-import base64
 import os
 import shutil
 
@@ -33,9 +32,13 @@ class SiamSVG(SVGImage):
         self._im0 = None
         self._im1 = None
         self._annotation_pairs = []
+        self._unmatched_annotations = ([], [])
         self._path = path
+        self._svg_doc = None
+        self._embedded_jpegs = None
         self._get_images()
         self._parse_annots()
+        self._svg_doc = None
 
     def __repr__(self):
         return os.path.basename(self._path)
@@ -157,13 +160,35 @@ class SiamSVG(SVGImage):
     def annotation_pairs(self):
         return self._annotation_pairs
 
+    @property
+    def frame_annotations(self) -> Tuple[List[Annotation], List[Annotation]]:
+        """
+        All the annotations of the first and of the second image. The first ``len(annotation_pairs)`` of each list
+        are the pairs, in order, the others are the annotations that were not matched.
+        """
+        return ([a0 for a0, _ in self._annotation_pairs] + self._unmatched_annotations[0],
+                [a1 for _, a1 in self._annotation_pairs] + self._unmatched_annotations[1])
+
     def _parse_annots(self):
-        doc = ElementTree.parse(self._path)
-        groups = doc.findall('.//{http://www.w3.org/2000/svg}g')
-        for g in groups:
-            p = g.findall('.//{http://www.w3.org/2000/svg}path')
+        doc = self._parse_svg()
+        groups = doc['groups']
+        grouped = {id(p) for g in groups for p in g}
+        for p in doc['paths']:
+            if id(p) in grouped:
+                continue
+            style = self._style_to_dic(p)
+            for c in self._svg_path_to_contour(p):
+                if c is None:
+                    continue
+                _, y, _, _ = cv2.boundingRect(c)
+                # the second image is below the first one
+                frame = 0 if y < self._offset1[1] else 1
+                im, offset = (self._im0, self._offset0) if frame == 0 else (self._im1, self._offset1)
+                self._unmatched_annotations[frame].append(Annotation(c - offset, style['stroke'], parent_image=im))
+
+        for i, p in enumerate(groups):
             if len(p) != 2:
-                raise Exception("Not two paths in group %s in file %s" % (g.attrib['id'], self._path))
+                raise Exception("Not two paths in group %i in file %s" % (i, self._path))
 
             p0, p1 = p
             c0, c1 = self._svg_path_to_contour(p0), self._svg_path_to_contour(p1)
@@ -192,40 +217,40 @@ class SiamSVG(SVGImage):
 
     def _get_images(self):
 
-        doc = ElementTree.parse(self._path)
-        ims = doc.findall('.//{http://www.w3.org/2000/svg}image')
+        ims = self._parse_svg()['images']
 
         if len(ims) != 2:
             raise Exception("Cannot extract images from %s" % self._path)
 
-        attrs = ims[0].attrib
+        attrs = ims[0]
         if 'w' in attrs:
-            im_w = ims[0].attrib['w']
+            im_w = attrs['w']
         elif 'width' in attrs:
-            im_w = ims[0].attrib['width']
+            im_w = attrs['width']
         else:
             raise Exception('Embedded image %s does not have width' % (self._path))
 
         if 'h' in attrs:
-            im_h = ims[0].attrib['h']
+            im_h = attrs['h']
         elif 'width' in attrs:
-            im_h = ims[0].attrib['height']
+            im_h = attrs['height']
         else:
             raise Exception('Embedded image %s does not have height' % (self._path))
 
         svg_im_shape = (int(im_h), int(im_w))
 
-        a0, b0 = self._get_one_image(ims[0])
-        a1, b1 = self._get_one_image(ims[1])
+        # shapes come from the jpeg headers, pixels are decoded lazily by the BufferImages
+        a0, b0 = ims[0]['jpeg_header'], self._get_buffer(0)
+        a1, b1 = ims[1]['jpeg_header'], self._get_buffer(1)
 
-        if ims[1].attrib['y'] < ims[0].attrib['y']:
+        if ims[1]['y'] < ims[0]['y']:
             a1, a0 = a0, a1
             b1, b0 = b0, b1
 
-        jpg_im_shape = a0.shape
+        jpg_im_shape = a0['shape']
         self._scale_in_svg = np.array(svg_im_shape) / np.array(jpg_im_shape[0:2])
         self._offset0 = (0, 0)
-        self._offset1 = (0, a1.shape[0])
+        self._offset1 = (0, a1['shape'][0])
         device, dtstr0, dtstr1, _ = os.path.basename(self._path).split('.')
         dt0 = datetime.datetime.strptime(dtstr0, '%Y-%m-%d_%H-%M-%S')
         dt1 = datetime.datetime.strptime(dtstr1, '%Y-%m-%d_%H-%M-%S')
@@ -237,23 +262,11 @@ class SiamSVG(SVGImage):
         self._metadata = None
 
     def extract_jpeg(self, target=None, as_buffer=False, id=0):
-        doc = ElementTree.parse(self._path)
-        ims = doc.findall('.//{http://www.w3.org/2000/svg}image')
-        if len(ims) != 2:
+        if self._embedded_jpegs is None:
+            self._parse_svg()
+        if len(self._embedded_jpegs) != 2:
             raise Exception("Unexpected number of images in %s" % self._path)
-        return self._extract_jpeg_id(ims, id, target, as_buffer)
-
-    def _get_buffer(self, im):
-        utf_str = im.attrib['{http://www.w3.org/1999/xlink}href'].split(',')[1]
-        utf_str = utf_str.strip('\"\'')
-
-        buffer = io.BytesIO()
-        buffer.write(base64.b64decode(utf_str))
-        buffer.seek(0)
-        return buffer
-
-    def _get_one_image(self, im):
-        buffer = self._get_buffer(im)
-        bytes_as_np_array = np.frombuffer(buffer.read(), dtype=np.uint8)
-        img = cv2.imdecode(bytes_as_np_array, cv2.IMREAD_COLOR)
-        return img, buffer
+        return self._extract_jpeg_id(id, target, as_buffer)
+
+    def _get_buffer(self, id):
+        return io.BytesIO(self._embedded_jpeg_bytes(id))
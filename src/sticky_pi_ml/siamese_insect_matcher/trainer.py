@@ -9,6 +9,7 @@ from sticky_pi_ml.trainer import BaseTrainer
 from sticky_pi_ml.siamese_insect_matcher.ml_bundle import MLBundle
 from sticky_pi_ml.siamese_insect_matcher.model import SiameseNet
 from sticky_pi_ml.siamese_insect_matcher.predictor import Predictor
+from sticky_pi_ml.siamese_insect_matcher.gating import CandidateGate
 
 
 class Trainer(BaseTrainer):
@@ -116,6 +117,36 @@ class Trainer(BaseTrainer):
         self.train_step(train_loader, val_loader,  self._config['DIST_AR_BASE_LR'], self._config['DIST_AR_ROUNDS'], 'Dist AR')
         self._net.set_step_train_fine_tune()
         self.train_step(train_loader, val_loader,  self._config['FINAL_BASE_LR'],  self._config['FINAL_ROUNDS'], 'FULL')
+        if self._config.get('GATING_QUANTILE') is not None:
+            self.fit_gating()
+
+    @staticmethod
+    def _positive_pairs_per_image(data):
+        out = {}
+        for d in data:
+            if d['label'] == 1:
+                out.setdefault(d['md5'], []).append((d['data']['a0'], d['data']['a1']))
+        return list(out.values())
+
+    def _validation_frames(self):
+        out = []
+        for ssvg in self._ml_bundle.dataset.validation_siam_svgs():
+            an0, an1 = ssvg.frame_annotations
+            # the pairs come first in the annotations of the two frames
+            out.append((an0, an1, [(k, k) for k in range(len(ssvg.annotation_pairs))]))
+        return out
+
+    def fit_gating(self) -> CandidateGate:
+        """
+        Learns the candidate gate of the predictor from the positive pairs of the training set,
+        saves it in the ML bundle, and reports its pruning rate and recall loss on the validation set.
+        """
+        positive_pairs = [p for pairs in self._positive_pairs_per_image(self._ml_bundle.dataset.training_data)
+                          for p in pairs]
+        gate = CandidateGate.fit(positive_pairs, self._config['GATING_QUANTILE'], self._config['GATING_MARGIN'])
+        gate.save(self._ml_bundle.gating_file)
+        gate.evaluate(self._validation_frames())
+        return gate
 
     def validate(self, predictor: Predictor, out_dir: str = None):
 
@@ -154,3 +185,8 @@ class Trainer(BaseTrainer):
 
         with open(os.path.join(out_dir, 'results.json'), 'w') as file:
             file.write(json.dumps(out))
+
+        if predictor.gate is not None:
+            gating = predictor.gate.evaluate(self._validation_frames())
+            with open(os.path.join(out_dir, 'gating.json'), 'w') as file:
+                file.write(json.dumps(gating))
@@ -0,0 +1,44 @@
+import itertools
+import unittest
+import numpy as np
+from sticky_pi_ml.assignment import assign
+
+
+def argmax_loop(arr):
+    # the reference greedy implementation
+    arr = np.copy(arr)
+    out = []
+    while np.sum(arr) > 0:
+        i, j = np.unravel_index(arr.argmax(), arr.shape)
+        out.append((i, j, arr[i, j]))
+        arr[i, :] = 0
+        arr[:, j] = 0
+    return out
+
+
+class TestAssignment(unittest.TestCase):
+    def test_greedy(self):
+        rng = np.random.RandomState(1)
+        for _ in range(50):
+            shape = rng.randint(1, 20, 2)
+            # few distinct values, so we have ties
+            arr = rng.randint(0, 4, shape).astype(float)
+            self.assertEqual(assign(arr, 'greedy'), argmax_loop(arr))
+
+    def test_optimal(self):
+        rng = np.random.RandomState(2)
+        for _ in range(50):
+            arr = rng.random_sample((5, 4)) * (rng.random_sample((5, 4)) > 0.5)
+            best = max(sum(arr[i, j] for i, j in zip(rows, range(4)))
+                       for rows in itertools.permutations(range(5), 4))
+            matches = assign(arr, 'optimal')
+            self.assertAlmostEqual(sum(s for _, _, s in matches), best)
+            self.assertEqual(len({i for i, _, _ in matches}), len(matches))
+            self.assertEqual(len({j for _, j, _ in matches}), len(matches))
+            self.assertTrue(all(s > 0 for _, _, s in matches))
+            self.assertGreaterEqual(sum(s for _, _, s in matches) + 1e-9,
+                                    sum(s for _, _, s in assign(arr, 'greedy')))
+
+    def test_invalid_method(self):
+        with self.assertRaises(ValueError):
+            assign(np.ones((2, 2)), 'unknown')
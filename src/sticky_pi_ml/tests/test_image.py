@@ -85,9 +85,37 @@ class TestImage(unittest.TestCase):
         array = im.read()
         self.assertEqual(array.shape, self._image_shape)
 
+    def test_header(self):
+        full_path = os.path.join(os.path.dirname(__file__), self._test_image)
+        im = Image(full_path)
+        # shape and metadata come from the header, without decoding pixels
+        self.assertEqual(im.shape, self._image_shape)
+        self.assertIsInstance(im.metadata['Make'], dict)
+        self.assertIsNone(im._cached_image)
+        self.assertEqual(im.read().shape, im.shape)
+
     def test_to_svg(self):
         self._to_svg(self._test_image)
 
+    def test_svg_path_fast_path(self):
+        tmp_dir = tempfile.mkdtemp(prefix='sticky_pi_test_')
+        try:
+            source = sorted(glob.glob(os.path.join(self._bundle_dir, 'data', '*.svg')))[0]
+            target = os.path.join(tmp_dir, os.path.basename(source))
+            SVGImage(source, foreign=True).to_svg(target)
+            im = SVGImage(target, foreign=True, skip_annotations=True)
+            paths = im._parse_svg()['paths']
+            self.assertTrue(len(paths) > 0)
+            for p in paths:
+                self.assertTrue(im._straight_polygon_regex.fullmatch(p.attrib['d']))
+                fast = im._svg_path_to_contour(p)
+                slow = im._svgpathtools_path_to_contour(p)
+                self.assertEqual(len(fast), len(slow))
+                for f, s in zip(fast, slow):
+                    self.assertTrue(np.array_equal(f, s))
+        finally:
+            shutil.rmtree(tmp_dir)
+
 
     # def test_json_image(self):
     #     im = self._test_svg_images[2]
@@ -14,8 +14,9 @@ logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s [%(filename)s:
                     datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
 import torch
 class MockCNN(object):
-    def __call__(self, *args, **kwargs):
-        return torch.Tensor([1.0, 9, 9])
+    def __call__(self, inputs, *args, **kwargs):
+        # one row per tuboid of the batch
+        return torch.Tensor([[1.0, 9, 9]] * len(inputs['array']))
 
     def eval(self):
         pass
@@ -29,6 +30,18 @@ class MockPredictor(Predictor):
         return MockCNN()
 
 
+class ScaleCNN(MockCNN):
+    def __call__(self, inputs, *args, **kwargs):
+        # the class of a tuboid is the closest to its mean scale, so each tuboid has its own prediction
+        scale = inputs['scale'].mean(dim=(1, 2))
+        return -torch.abs(scale[:, None] - torch.Tensor([2.0, 3.5, 5.0]))
+
+
+class ScalePredictor(Predictor):
+    def _make_net(self):
+        return ScaleCNN()
+
+
 
 test_dir = os.path.dirname(__file__)
 
@@ -111,3 +124,71 @@ class TestITC(unittest.TestCase):
         finally:
             shutil.rmtree(client_temp_dir)
             shutil.rmtree(todel)
+
+    def test_tile_store(self):
+        from sticky_pi_ml.tuboid import TiledTuboid
+        from sticky_pi_ml.insect_tuboid_classifier.tile_store import TileStore
+        from sticky_pi_ml.insect_tuboid_classifier.dataset import OurTorchDataset
+
+        todel = tempfile.mkdtemp(prefix='sticky_pi_test_')
+        try:
+            tuboids = [TiledTuboid(os.path.dirname(m)) for m in
+                       sorted(glob.glob(os.path.join(self._tiled_tuboid_dir, '**', 'metadata.txt'), recursive=True))]
+            store = TileStore.build(tuboids, os.path.join(todel, 'tile_store'))
+            # all tuboids are already in the store
+            self.assertEqual(len(TileStore.build(tuboids[:2], os.path.join(todel, 'tile_store'))), len(tuboids))
+            for t in tuboids:
+                items = list(range(t.n_tiles))
+                for a, b in zip(store.get_tiles(t, items), t.get_tiles(items)):
+                    self.assertTrue(np.array_equal(a, b['array']))
+
+            data = [{'tuboid': t, 'label': 0} for t in tuboids]
+            for d in (OurTorchDataset(data, augment=False), OurTorchDataset(data, augment=False, tile_store=store)):
+                np.random.seed(1)
+                out = [d[i][0]['array'] for i in range(len(d))]
+                if d._tile_store is None:
+                    expected = out
+            for a, b in zip(expected, out):
+                self.assertTrue(torch.equal(a, b))
+        finally:
+            shutil.rmtree(todel)
+
+    def test_predict_batch(self):
+        from sticky_pi_ml.tuboid import TiledTuboid
+
+        todel = tempfile.mkdtemp(prefix='sticky_pi_test_')
+        try:
+            bundle_dir = os.path.join(todel, 'insect-tuboid-classifier')
+            shutil.copytree(os.path.join(self._bundle_dir, 'config'), os.path.join(bundle_dir, 'config'))
+            bndl = MLBundle(bundle_dir)
+            os.makedirs(os.path.dirname(bndl.weight_file), exist_ok=True)
+            torch.save({}, bndl.weight_file)
+            pred = ScalePredictor(bndl)
+
+            tuboids = [TiledTuboid(os.path.dirname(m)) for m in
+                       sorted(glob.glob(os.path.join(self._tiled_tuboid_dir, '**', 'metadata.txt'), recursive=True))]
+            # tiles are drawn at random, in the same order in both cases
+            np.random.seed(1)
+            expected = [pred.predict(t) for t in tuboids]
+            self.assertGreater(len({e['label'] for e in expected}), 1)
+            for batch_size in (len(tuboids) - 2, len(tuboids), len(tuboids) + 2):
+                np.random.seed(1)
+                self.assertEqual(pred.predict_batch(tuboids, batch_size), expected)
+        finally:
+            shutil.rmtree(todel)
+
+    def test_fused_forward(self):
+        from sticky_pi_ml.insect_tuboid_classifier.model import make_resnet
+        torch.manual_seed(1)
+        model = make_resnet(pretrained=False, n_classes=3).eval()
+        model_cl = make_resnet(pretrained=False, n_classes=3, channels_last=True).eval()
+        model_cl.load_state_dict(model.state_dict())
+        inputs = {'array': torch.randn(2, 6, 3, 224, 224),
+                  'scale': torch.rand(2, 6, 1)}
+        with torch.no_grad():
+            expected = model._forward_per_shot(inputs)
+            for m, max_images_per_pass in ((model, None), (model_cl, None), (model_cl, 5)):
+                m.max_images_per_pass = max_images_per_pass
+                out = m(inputs)
+                self.assertEqual(out.shape, (2, 3))
+                self.assertTrue(torch.allclose(out, expected, atol=1e-4))
@@ -35,6 +35,13 @@ class TestSiamSVG(unittest.TestCase):
                                                       prematch=True)
 
             reread_siam = SiamSVG(hand_made_siam)
+            an0, an1 = reread_siam.frame_annotations
+            self.assertEqual(len(an0), len(self._test_reg_images[0].annotations))
+            self.assertEqual(len(an1), len(self._test_reg_images[1].annotations))
+            # the pairs come first
+            for k, (a0, a1) in enumerate(reread_siam.annotation_pairs):
+                self.assertIs(an0[k], a0)
+                self.assertIs(an1[k], a1)
 
             self.assertEqual(reread_siam.extract_jpeg(as_buffer=True, id=0).read(),
                              self._test_reg_images[0].extract_jpeg(as_buffer=True).read())
@@ -48,6 +48,287 @@ class TestSIM(unittest.TestCase):
                                                                            "0a5bb6f4*.svg")))]
 
 
+    def test_candidate_gate(self):
+        from sticky_pi_ml.annotations import Annotation
+        from sticky_pi_ml.siamese_insect_matcher.gating import CandidateGate
+
+        def square(x, y, w):
+            return Annotation(np.array([[[x, y]], [[x + w, y]], [[x + w, y + w]], [[x, y + w]]]), '#ff0000')
+
+        an0 = [square(100, 100, 10), square(500, 500, 20), square(1000, 100, 10)]
+        an1 = [square(103, 101, 10), square(505, 495, 21), square(1000, 110, 40)]
+        gate = CandidateGate.fit([(an0[0], an1[0]), (an0[1], an1[1])], quantile=1, margin=1.5)
+        mask = gate.candidate_mask(an0, an1)
+        # only the two true pairs remain. the third is close, but much larger
+        self.assertTrue(np.array_equal(mask, np.array([[1, 0, 0], [0, 1, 0], [0, 0, 0]], dtype=bool)))
+        # all the pairs between the two frames count for pruning, including those of unmatched annotations
+        stats = gate.evaluate([(an0, an1 + [square(2000, 2000, 10)], [(0, 0), (1, 1), (2, 2)])])
+        self.assertEqual(stats['n_pairs'], 12)
+        self.assertAlmostEqual(stats['pruning_rate'], 10 / 12)
+        self.assertAlmostEqual(stats['recall_loss'], 1 / 3)
+
+    def test_embedding_store(self):
+        from sticky_pi_ml.siamese_insect_matcher.embeddings import EmbeddingStore
+
+        computed = []
+
+        def compute(missing):
+            computed.extend(keys[k] for k in missing)
+            return np.array([[keys[k][1]] * 4 for k in missing], dtype=np.float32)
+
+        # room for two embeddings
+        store = EmbeddingStore(dim=4, max_bytes=32)
+        keys = [('im0', 0, None), ('im0', 1, None)]
+        out = store.get_or_compute(keys, compute)
+        self.assertTrue(np.array_equal(out[:, 0], [0, 1]))
+        self.assertEqual(store.get_or_compute(keys, compute).tolist(), out.tolist())
+        self.assertEqual(len(computed), 2)
+
+        keys = [('im0', 1, 'im1'), ('im0', 1, None)]
+        out = store.get_or_compute(keys, compute)
+        self.assertTrue(np.array_equal(out[:, 0], [1, 1]))
+        # ('im0', 0, None) was the least recently used
+        self.assertEqual(computed, [('im0', 0, None), ('im0', 1, None), ('im0', 1, 'im1')])
+        self.assertEqual(store.stats['evictions'], 1)
+        self.assertEqual(store.nbytes, 32)
+        store.clear()
+        self.assertEqual(len(store), 0)
+
+    def test_embedding_store_evicts_images(self):
+        from sticky_pi_ml.siamese_insect_matcher.embeddings import EmbeddingStore
+
+        im0, im1 = self._test_reg_images[1:3]
+        store = EmbeddingStore(dim=4, max_bytes=32)
+
+        def compute(missing):
+            return np.zeros((len(missing), 4), dtype=np.float32)
+
+        keys = [store.key(a) for a in im0.annotations[:2]]
+        self.assertEqual(keys, [(im0.filename, 0, None), (im0.filename, 1, None)])
+        store.get_or_compute(keys, compute)
+        self.assertEqual(store.stats['images'], 1)
+        # the rows of im0 are reused, so its annotation indices are dropped
+        store.get_or_compute([store.key(a) for a in im1.annotations[:2]], compute)
+        self.assertEqual(store.stats['images'], 1)
+        self.assertEqual(store.key(im0.annotations[1]), (im0.filename, 1, None))
+
+    def test_embedding_store_drop_image(self):
+        from sticky_pi_ml.siamese_insect_matcher.embeddings import EmbeddingStore
+
+        im0, im1 = self._test_reg_images[1:3]
+        store = EmbeddingStore(dim=4)
+
+        def compute(missing):
+            return np.zeros((len(missing), 4), dtype=np.float32)
+
+        keys0 = [store.key(a) for a in im0.annotations[:2]]
+        keys1 = [store.key(a) for a in im1.annotations[:2]]
+        # a view of an annotation of im1 in im0
+        view = [store.key(im1.annotations[2], view=im0.filename)]
+        store.get_or_compute(keys0 + keys1 + view, compute)
+        self.assertEqual(len(store), 5)
+        nbytes = store.nbytes
+
+        store.drop_image(im0.filename)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.stats['images'], 1)
+        # the rows of im1 are kept, the others are reused
+        store.get_or_compute(keys1, compute)
+        self.assertEqual(store.stats['hits'], 2)
+        store.get_or_compute(keys0, compute)
+        self.assertEqual(store.nbytes, nbytes)
+
+    def test_ordered_components(self):
+        from sticky_pi_ml.siamese_insect_matcher.matcher import _ordered_components
+
+        u = np.array([5, 1, 2, 3])
+        v = np.array([6, 2, 4, 0])
+        # node 8 is isolated, but in the graph. node 7 is isolated, and not in the graph.
+        # node 3 is not in the graph either, but connected to node 0
+        rank = np.array([4, 0, 3, 10, 2, 5, 6, 9, 1])
+        components = _ordered_components(9, u, v, rank)
+        self.assertEqual([c.tolist() for c in components], [[1, 4, 2], [8], [0, 3], [5, 6]])
+        # without edges, each node of the graph is a component
+        components = _ordered_components(9, np.zeros(0, dtype=int), np.zeros(0, dtype=int), rank)
+        self.assertEqual([c.tolist() for c in components], [[1], [8], [4], [2], [0], [5], [6]])
+
+    def test_merge_conjoint_tuboids(self):
+        import datetime
+        from sticky_pi_ml.annotations import Annotation
+        from sticky_pi_ml.image import ArrayImage
+        from sticky_pi_ml.tuboid import Tuboid
+        from sticky_pi_ml.siamese_insect_matcher.matcher import Matcher
+
+        start = datetime.datetime(2020, 7, 1)
+        images = [ArrayImage(np.zeros((10, 10, 3), dtype=np.uint8), '0a5bb6f4', start + datetime.timedelta(hours=h))
+                  for h in range(12)]
+
+        def tuboid(hours):
+            return Tuboid([Annotation(np.array([[[1, 1]], [[3, 1]], [[3, 3]], [[1, 3]]]), '#ff0000',
+                                      parent_image=images[h]) for h in hours], 'test')
+
+        def hours(tubs):
+            return [[a.datetime.hour for a in t] for t in tubs]
+
+        class StubBundle(object):
+            version = 'test'
+
+        class StubPredictor(object):
+            # many pairs have the same score, so the order of the merges depends on tie-breaking
+            def __init__(self, ml_bundle):
+                pass
+
+            def match_two_tuboids(self, tb0, tb1):
+                return 0.25 * (1 + sum(a.datetime.hour for a in tb0 + tb1) % 3)
+
+        class ConstantPredictor(StubPredictor):
+            def match_two_tuboids(self, tb0, tb1):
+                return 1.0
+
+        def reference_merge(tuboids, predictor):
+            # the full score matrix is computed after each merge, and its argmax merged
+            tuboids = list(tuboids)
+            while len(tuboids) > 1:
+                arr = np.zeros((len(tuboids), len(tuboids)))
+                for i in range(len(tuboids)):
+                    for j in range(i + 1, len(tuboids)):
+                        if Matcher._is_tuboid_pair_conjoint(tuboids[i], tuboids[j]):
+                            arr[i, j] = predictor.match_two_tuboids(tuboids[i], tuboids[j])
+                if np.sum(arr) == 0:
+                    break
+                i, j = np.unravel_index(arr.argmax(), arr.shape)
+                tb1 = tuboids.pop(j)
+                tb0 = tuboids.pop(i)
+                tuboids.append(Tuboid(tb1 + tb0, 'test'))
+            return tuboids
+
+        matcher = Matcher(StubBundle(), PredictorClass=ConstantPredictor)
+        tuboids = [tuboid(h) for h in ([0, 3, 6], [1, 4], [8, 10], [9], [2, 5])]
+        merged = matcher._merge_conjoint_tuboids(list(tuboids), None)
+        # the first pair is merged first, and merged tuboids are appended
+        self.assertEqual(hours(merged), [[8, 9, 10], [0, 1, 2, 3, 4, 5, 6]])
+        self.assertEqual(hours(merged), hours(reference_merge(tuboids, ConstantPredictor(None))))
+
+        matcher = Matcher(StubBundle(), PredictorClass=StubPredictor)
+        np.random.seed(1)
+        for _ in range(20):
+            tuboids = [tuboid(sorted(np.random.choice(12, np.random.randint(1, 5), replace=False)))
+                       for _ in range(8)]
+            expected = hours(reference_merge(tuboids, StubPredictor(None)))
+            self.assertEqual(hours(matcher._merge_conjoint_tuboids(list(tuboids), None)), expected)
+
+    def _make_bundle(self, temp_dir):
+        import torch
+        from sticky_pi_ml.siamese_insect_matcher.model import SiameseNet
+
+        # the test bundle has no weights, so we make reproducible ones
+        bundle_dir = os.path.join(temp_dir, 'siamese-insect-matcher')
+        shutil.copytree(self._bundle_dir, bundle_dir)
+        bndl = MLBundle(bundle_dir)
+        torch.manual_seed(0)
+        torch.save(SiameseNet().state_dict(), bndl.weight_file)
+        return bndl
+
+    def _make_series_paths(self, temp_dir, start, n_images):
+        import datetime
+        # two images of the test series, alternated every hour, so that all frames are within the time window
+        paths = []
+        for i in range(n_images):
+            path = os.path.join(temp_dir, '0a5bb6f4.%s.svg' %
+                                (start + datetime.timedelta(hours=i)).strftime('%Y-%m-%d_%H-%M-%S'))
+            shutil.copy(self._test_reg_images[1 + i % 2].path, path)
+            paths.append(path)
+        return paths
+
+    def test_score_pairs(self):
+        import datetime
+        import torch
+        from sticky_pi_ml.siamese_insect_matcher.dataset import DataEntry
+
+        temp_dir = tempfile.mkdtemp(prefix='sticky_pi_test_')
+        try:
+            pred = Predictor(self._make_bundle(temp_dir))
+            im0, im1 = [SVGImage(p) for p in self._make_series_paths(temp_dir, datetime.datetime(2020, 7, 1), 2)]
+            an0, an1 = im0.annotations, im1.annotations
+            delta_t = (im1.datetime - im0.datetime).total_seconds()
+            np.random.seed(1)
+            ii = np.random.randint(0, len(an0), 12)
+            jj = np.random.randint(0, len(an1), 12)
+
+            # one forward of the network per pair
+            arr1 = im1.read(cache=True)
+            expected = []
+            with torch.no_grad():
+                for i, j in zip(ii, jj):
+                    d = DataEntry(an0[i], an1[j], arr1, None)
+                    expected.append(pred._net(d.as_dict(add_dim=True))[0].item())
+
+            with torch.no_grad():
+                self.assertTrue(np.allclose(pred._score_pairs(an0, an1, ii, jj, delta_t), expected, atol=1e-5))
+                # pairs are scored in several chunks, with embeddings from the store
+                pred._pair_batch_size = 5
+                self.assertTrue(np.allclose(pred._score_pairs(an0, an1, ii, jj, delta_t), expected, atol=1e-5))
+            arr = pred.match_all_annots(an0, an1, score_threshold=0)
+            self.assertTrue(np.allclose(arr[ii, jj], expected, atol=1e-5))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_parallel_drafting(self):
+        import datetime
+        from sticky_pi_ml.image import ImageSeries
+        from sticky_pi_ml.siamese_insect_matcher.matcher import Matcher
+
+        temp_dir = tempfile.mkdtemp(prefix='sticky_pi_test_')
+        try:
+            bndl = self._make_bundle(temp_dir)
+            start = datetime.datetime(2020, 7, 1)
+            paths = self._make_series_paths(temp_dir, start, 6)
+
+            def match(matcher):
+                series = ImageSeries('0a5bb6f4', start, start + datetime.timedelta(days=1))
+                series.extend(SVGImage(p) for p in paths)
+                return [[(a.datetime, a.center.real, a.center.imag) for a in t] for t in matcher.match(series)]
+
+            expected = match(Matcher(bndl))
+            self.assertGreater(len(expected), 0)
+            for backend in ('thread', 'process'):
+                # the same tuboids, in the same order
+                self.assertEqual(match(Matcher(bndl, n_workers=3, draft_backend=backend)), expected)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_online_matcher(self):
+        import datetime
+        from sticky_pi_ml.image import ImageSeries
+        from sticky_pi_ml.siamese_insect_matcher.matcher import Matcher, OnlineMatcher
+
+        temp_dir = tempfile.mkdtemp(prefix='sticky_pi_test_')
+        try:
+            bndl = self._make_bundle(temp_dir)
+            start = datetime.datetime(2020, 7, 1)
+            paths = self._make_series_paths(temp_dir, start, 5)
+            end = start + datetime.timedelta(days=1)
+
+            series = ImageSeries('0a5bb6f4', start, end)
+            series.extend(SVGImage(p) for p in paths)
+            expected = Matcher(bndl).match(series)
+
+            online_matcher = OnlineMatcher(bndl, ImageSeries('0a5bb6f4', start, end))
+            tuboids = []
+            # the last image is not part of the tuboids of Matcher.match
+            for p in paths[:-1]:
+                tuboids.extend(online_matcher.add_image(SVGImage(p)))
+            tuboids.extend(online_matcher.flush())
+            self.assertEqual(online_matcher.n_open_tracks, 0)
+
+            def positions(tubs):
+                return sorted([(a.datetime, a.center.real, a.center.imag) for a in t] for t in tubs)
+
+            self.assertGreater(len(expected), 0)
+            self.assertEqual(positions(tuboids), positions(expected))
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_trainer(self):
         #fixme here, the bundle dir should be copied to avoid modifications?
         bndl = MLBundle(self._bundle_dir)
@@ -0,0 +1,67 @@
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+import cv2
+import numpy as np
+from sticky_pi_ml.tuboid import TiledTuboid
+
+test_dir = os.path.dirname(__file__)
+
+
+class TestTiledTuboid(unittest.TestCase):
+    _tuboid_dirs = sorted(os.path.dirname(p) for p in
+                          glob.glob(os.path.join(test_dir, 'tiled_tuboids', '**', TiledTuboid.metadata_tuboid_filename),
+                                    recursive=True))
+
+    def tearDown(self):
+        TiledTuboid.set_mosaic_cache(None)
+
+    def test_get_tiles(self):
+        for max_bytes in (None, 10 ** 8):
+            TiledTuboid.set_mosaic_cache(max_bytes)
+            for d in self._tuboid_dirs:
+                tuboid = TiledTuboid(d)
+                mosaic = cv2.imread(os.path.join(d, TiledTuboid.tiles_tuboid_filename))
+                w = tuboid._tile_width
+                tiles = tuboid.get_tiles(range(len(tuboid)))
+                for i, tile in enumerate(tiles):
+                    row, col = i // 4, i % 4
+                    self.assertTrue(np.array_equal(tile['array'], mosaic[row * w: (row + 1) * w, col * w: (col + 1) * w]))
+                    self.assertEqual(tile['scale'], tuboid.get_scale(i))
+                self.assertTrue(np.array_equal(tuboid.get_tile(1)['array'], tiles[1]['array']))
+
+        # one decoding per tuboid
+        self.assertEqual(TiledTuboid.mosaic_cache().stats['misses'], len(self._tuboid_dirs))
+
+    def test_pack(self):
+        from sticky_pi_ml.tuboid_pack import TuboidPackWriter, TuboidPackReader
+        temp_dir = tempfile.mkdtemp(prefix='sticky_pi_test_')
+        try:
+            path = os.path.join(temp_dir, 'series.tuboids')
+            with TuboidPackWriter(path) as pack:
+                written = [TiledTuboid(d).to_pack(pack) for d in self._tuboid_dirs]
+                # readable before the pack is closed
+                self.assertEqual(written[0].get_tile(0)['array'].shape, (224, 224, 3))
+            with self.assertRaises(ValueError):
+                TuboidPackReader(os.path.join(self._tuboid_dirs[0], TiledTuboid.metadata_tuboid_filename))
+
+            packed = TiledTuboid.from_pack(path)
+            self.assertEqual([os.path.basename(t.directory) for t in packed],
+                             [os.path.basename(d) for d in self._tuboid_dirs])
+            for d, tuboid in zip(self._tuboid_dirs, packed):
+                original = TiledTuboid(d)
+                self.assertEqual(list(tuboid), list(original))
+                self.assertEqual(tuboid.md5, original.md5)
+                self.assertEqual(tuboid.pack_path, path)
+                # tiles are re-encoded
+                for a, b in zip(tuboid.iter_tiles(), original.iter_tiles()):
+                    self.assertLess(np.abs(a['array'].astype(int) - b['array'].astype(int)).mean(), 1)
+                # and back to a directory
+                unpacked = tuboid.to_directory(temp_dir)
+                self.assertIsNone(unpacked.pack_path)
+                self.assertEqual(unpacked.md5, original.md5)
+                self.assertEqual(unpacked.n_tiles, original.n_tiles)
+        finally:
+            shutil.rmtree(temp_dir)
@@ -26,6 +26,45 @@ class MockPredictor(Predictor):
         return out
 
 
+class StubTileModel(object):
+    # detects one square per tile, whose size depends on the content of the tile. Inputs are recorded
+    _position = 200
+
+    def __init__(self):
+        self.inputs = []
+
+    def __call__(self, batch):
+        import torch
+        from detectron2.structures import Instances, Boxes
+        out = []
+        for b in batch:
+            self.inputs.append(b)
+            h, w = b['image'].shape[1:]
+            x0 = y0 = self._position
+            size = 40 + int(b['image'].mean()) % 40
+            instances = Instances((h, w))
+            instances.pred_boxes = Boxes(torch.tensor([[x0, y0, x0 + size, y0 + size]], dtype=torch.float32))
+            instances.scores = torch.tensor([0.99])
+            instances.pred_classes = torch.tensor([0])
+            instances.pred_masks = torch.zeros((1, h, w), dtype=torch.bool)
+            instances.pred_masks[0, y0: y0 + size, x0: x0 + size] = True
+            out.append({'instances': instances})
+        return out
+
+
+class StubDetectronPredictor(object):
+    # tiles are not resized, but converted to RGB
+    input_format = 'RGB'
+
+    def __init__(self):
+        self.model = StubTileModel()
+        self.aug = self
+
+    def get_transform(self, image):
+        from detectron2.data.transforms import NoOpTransform
+        return NoOpTransform()
+
+
 test_dir = os.path.dirname(__file__)
 
 
@@ -101,6 +140,136 @@ class TestUID(unittest.TestCase):
             shutil.rmtree(todel)
             pass
 
+    def test_client_predict_pipelined(self):
+        class RecordingClient(LocalClient):
+            uploaded = None
+
+            def put_uid_annotations(self, annotations, *args, **kwargs):
+                self.uploaded = (self.uploaded or []) + list(annotations)
+                return super().put_uid_annotations(annotations, *args, **kwargs)
+
+        info = [{'device': '%', 'start_datetime': "1970-01-01_00-00-00", 'end_datetime': "2070-01-01_00-00-00"}]
+        ims_to_pred = [im for im in sorted(glob.glob(os.path.join(self._raw_images_dir, '**', '*.jpg')))]
+        client_temp_dirs = [tempfile.mkdtemp(prefix='sticky_pi_client_') for _ in range(2)]
+        try:
+            uploaded = []
+            for client_temp_dir, pipelined in zip(client_temp_dirs, (False, True)):
+                cli = RecordingClient(client_temp_dir)
+                bndl = ClientMLBundle(self._bundle_dir, cli)
+                bndl.sync_local_to_remote()
+                cli.put_images(ims_to_pred)
+                pred = MockPredictor(bndl)
+                pred._version = '1604062778-262624ad1767b977801645a8addefbe6'
+                if pipelined:
+                    pred.detect_client_pipelined(info, download_queue_size=2, upload_chunk_size=3)
+                    self.assertEqual(pred.pipeline_status['n_uploaded'], len(ims_to_pred))
+                else:
+                    pred.detect_client(info)
+                uploaded.append(sorted(cli.uploaded, key=lambda a: (a['metadata']['device'],
+                                                                    str(a['metadata']['datetime']))))
+                # all the images are annotated
+                work_queue = pred._work_queue(cli, info)
+                try:
+                    self.assertEqual(work_queue.pending(), [])
+                finally:
+                    work_queue.remove()
+
+            self.assertEqual(len(uploaded[0]), len(ims_to_pred))
+            self.assertEqual(uploaded[1], uploaded[0])
+        finally:
+            for d in client_temp_dirs:
+                shutil.rmtree(d)
+
+    def test_client_predict_pipelined_upload_error(self):
+        import threading
+
+        class FailingClient(LocalClient):
+            def put_uid_annotations(self, *args, **kwargs):
+                raise ValueError('Upload failed')
+
+        client_temp_dir = tempfile.mkdtemp(prefix='sticky_pi_client_')
+        todel = tempfile.mkdtemp(prefix='sticky_pi_test_')
+        try:
+            cli = FailingClient(client_temp_dir)
+            bndl = ClientMLBundle(self._bundle_dir, cli)
+            bndl.sync_local_to_remote()
+            ims_to_pred = [im for im in sorted(glob.glob(os.path.join(self._raw_images_dir, '**', '*.jpg')))]
+            cli.put_images(ims_to_pred)
+            pred = MockPredictor(bndl)
+            pred._version = '1604062778-262624ad1767b977801645a8addefbe6'
+
+            errors = []
+
+            def run():
+                try:
+                    # with a single slot queue, the detector and the feeder wait on each other when the upload fails
+                    pred.detect_client_pipelined(download_queue_size=1, upload_chunk_size=1)
+                except Exception as e:
+                    errors.append(e)
+
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+            thread.join(timeout=60)
+            self.assertFalse(thread.is_alive(), 'The pipeline did not stop after the upload failed')
+            self.assertEqual(len(errors), 1)
+            self.assertIsInstance(errors[0], ValueError)
+        finally:
+            shutil.rmtree(client_temp_dir)
+            shutil.rmtree(todel)
+
+    def test_detect_tiles(self):
+        import torch
+        from sticky_pi_ml.image import Image
+
+        bndl = MLBundle(self._bundle_dir)
+        padding = 32
+        bndl.config.ORIGINAL_IMAGE_PADDING = padding
+        with Predictor(bndl, tile_batch_size=2) as pred:
+            pred._detectron_predictor = StubDetectronPredictor()
+            image = Image(self._test_image)
+            annotations = pred._detect_instances(image)
+
+            padded = pred._pad_image(image)
+            self.assertEqual(padded.shape[:2], (image.shape[0] + 2 * padding, image.shape[1] + 2 * padding))
+            self.assertTrue(np.array_equal(padded[padding: -padding, padding: -padding], image.read()))
+            offsets, x_n_tiles, y_n_tiles = pred._tile_offsets(padded.shape)
+            self.assertGreater(x_n_tiles, 1)
+            self.assertGreater(y_n_tiles, 1)
+            tw = pred._tile_width
+            # tiles overlap, and cover the whole padded image
+            xs = sorted({x for _, (x, _) in offsets})
+            ys = sorted({y for _, (_, y) in offsets})
+            for r, size in ((xs, padded.shape[1]), (ys, padded.shape[0])):
+                self.assertEqual(r[0], 0)
+                self.assertEqual(r[-1] + tw, size)
+                self.assertTrue(all(b - a <= tw - pred._minimum_tile_overlap for a, b in zip(r, r[1:])))
+
+            inputs = pred._detectron_predictor.model.inputs
+            self.assertEqual(len(inputs), len(offsets))
+            for inp, (_, (x, y)) in zip(inputs, offsets):
+                self.assertEqual((inp['height'], inp['width']), (tw, tw))
+                expected = padded[y: y + tw, x: x + tw, ::-1].transpose(2, 0, 1).astype(np.float32)
+                self.assertTrue(torch.equal(inp['image'], torch.from_numpy(expected)))
+
+            # one square per tile, at its position in the original image (the masks are dilated by one pixel)
+            position = StubTileModel._position - padding - 1
+            self.assertEqual(sorted(a.bbox[:2] for a in annotations),
+                             sorted((x + position, y + position) for _, (x, y) in offsets))
+
+            # the tiles of several images are batched together, across image boundaries
+            images = [Image(p) for p in sorted(glob.glob(os.path.join(self._raw_images_dir, '**', '*.jpg')))[:3]]
+            pred._tile_batch_size = 4
+            self.assertNotEqual(len(offsets) % pred._tile_batch_size, 0)
+            expected = [pred._detect_instances(im) for im in images]
+            batch = pred._detect_instances_batch(images)
+            self.assertEqual(len(batch), len(images))
+            for annots, expected_annots in zip(batch, expected):
+                self.assertEqual(len(annots), len(expected_annots))
+                for a, b in zip(annots, expected_annots):
+                    self.assertTrue(np.array_equal(a.contour, b.contour))
+            for annotated, im in zip(pred.detect_batch(images), images):
+                self.assertEqual(len(annotated.annotations), len(pred._detect_instances(im)))
+
     # def test_validate(self):
     #     bndl = MLBundle(self._bundle_dir)
     # #     # bndl.dataset.visualise(augment=True)
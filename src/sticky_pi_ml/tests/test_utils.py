@@ -0,0 +1,50 @@
+import unittest
+import numpy as np
+from sticky_pi_ml.utils import BBoxGrid, BoundedCache
+
+
+class TestUtils(unittest.TestCase):
+
+    def test_bbox_grid(self):
+        rng = np.random.RandomState(1)
+        boxes = []
+        for _ in range(200):
+            x, y = rng.randint(0, 2000, 2)
+            w, h = rng.randint(1, 300, 2)
+            boxes.append((x, y, x + w, y + h))
+
+        grid = BBoxGrid(cell_size=128)
+        for b in boxes:
+            grid.insert(b)
+        self.assertEqual(len(grid), len(boxes))
+
+        for q in boxes[:50]:
+            expected = [k for k, b in enumerate(boxes)
+                        if b[0] <= q[2] and q[0] <= b[2] and b[1] <= q[3] and q[1] <= b[3]]
+            self.assertEqual(grid.query(q), expected)
+
+    def test_bounded_cache(self):
+        cache = BoundedCache(max_entries=3)
+        for i in range(3):
+            cache.put(i, i * 10, scope='a')
+        self.assertEqual(cache.get(0, 'a'), 0)
+        self.assertIsNone(cache.get(0, 'b'))
+        # 1 is now the least recently used
+        cache.put(3, 30, scope='b')
+        self.assertIsNone(cache.get(1, 'a'))
+        self.assertEqual(cache.get(2, 'a'), 20)
+        self.assertEqual(cache.stats['hits'], 2)
+        self.assertEqual(cache.stats['misses'], 2)
+        self.assertEqual(cache.stats['evictions'], 1)
+
+        cache.clear('a')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get(3, 'b'), 30)
+        cache.clear(all_scopes=True)
+        self.assertEqual(cache.stats['bytes'], 0)
+
+        cache = BoundedCache(max_bytes=100, sizeof=lambda x: 10)
+        for i in range(10):
+            cache.put(i, i)
+        self.assertEqual(len(cache), 5)
+        self.assertEqual(cache.stats['bytes'], 100)
@@ -0,0 +1,36 @@
+import os
+import shutil
+import tempfile
+import datetime
+import unittest
+from sticky_pi_ml.work_queue import WorkQueue
+
+
+class TestWorkQueue(unittest.TestCase):
+    _items = [{'device': '0a5bb6f4', 'datetime': datetime.datetime(2020, 6, 20, 20, 19, 15)},
+              {'device': '0a5bb6f4', 'datetime': datetime.datetime(2020, 6, 20, 20, 37, 59)},
+              {'device': '1b74105a', 'datetime': datetime.datetime(2020, 7, 5, 10, 7, 16)}]
+
+    def test_resume(self):
+        temp_dir = tempfile.mkdtemp(prefix='sticky_pi_test_')
+        try:
+            path = os.path.join(temp_dir, 'queue.db')
+            wq = WorkQueue(path, 'job-1')
+            self.assertFalse(wq.is_populated)
+            wq.populate(self._items)
+            self.assertEqual(len(wq), 3)
+            wq.mark_done(wq.pending(2))
+
+            # e.g. after a crash
+            wq = WorkQueue(path, 'job-1')
+            self.assertTrue(wq.is_populated)
+            self.assertEqual(wq.pending(), self._items[2:])
+
+            # another job discards the queue
+            wq = WorkQueue(path, 'job-2')
+            self.assertFalse(wq.is_populated)
+            self.assertEqual(len(wq), 0)
+            wq.remove()
+            self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(temp_dir)
@@ -1,15 +1,23 @@
-import copy
+import hashlib
+import itertools
+import logging
 import os
+import shutil
+import sys
 import cv2
 import numpy as np
 from sticky_pi_ml.utils import pad_to_square
 from sticky_pi_ml.annotations import Annotation
 from sticky_pi_ml.image import ImageSeries
-from sticky_pi_ml.utils import string_to_datetime, md5
-from typing import List
+from sticky_pi_ml.utils import string_to_datetime, md5, BoundedCache
+from sticky_pi_ml.tuboid_pack import TuboidPackWriter, TuboidPackReader, read_blobs
+from typing import List, Dict, Any, Tuple
 
 
 class Tuboid(list):
+    # unlike `id()`, never reused within a process, so it can key caches that outlive tuboids
+    _uid_counter = itertools.count()
+
     def __init__(self, annotations: List[Annotation],
                  matcher_version: str,
                  parent_series: ImageSeries = None):
@@ -30,11 +38,11 @@ class Tuboid(list):
         self._parent_series = parent_series
         self._device = d
         self._id = -1
+        self._uid = next(self._uid_counter)
         self._matcher_version = matcher_version
         self._all_timestamps = [a.datetime.timestamp() for a in self]
         self._all_timestamps = np.array(self._all_timestamps).astype(np.float)
         self._all_bboxes = np.array([a.bbox for a in self]).astype(np.float)
-        self._cached_conv = {}
 
     def __repr__(self):
         return "%s, %s(%s), %s(%s) (N=%i)" % (self._device, self.head_datetime, self.head.center,
@@ -53,6 +61,10 @@ class Tuboid(list):
     def id(self):
         return self._id
 
+    @property
+    def uid(self) -> int:
+        return self._uid
+
     @property
     def matcher_version(self):
         return self._matcher_version
@@ -103,6 +115,13 @@ class Tuboid(list):
     def device(self):
         return self._device
 
+    @property
+    def timestamps(self) -> np.ndarray:
+        """
+        :return: the sorted timestamps of the annotations, in seconds
+        """
+        return self._all_timestamps
+
     @property
     def tail(self):
         return self[-1]
@@ -126,10 +145,25 @@ class TiledTuboid(list):
     context_tuboid_filename = 'context.jpg'
     metadata_tuboid_filename = 'metadata.txt'
     _max_tuboid_duration = 24 * 3600
-
-    def __init__(self, tuboid_dir):
+    _tiles_encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 100]
+    _context_encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
+    # decoded mosaics (or tiles, for packed tuboids), shared by all instances.
+    # Disabled (None) by default, see `set_mosaic_cache`
+    _mosaic_cache = None
+
+    def __init__(self, tuboid_dir: str, pack_entry: Dict[str, Any] = None):
+        """
+        A tuboid, as saved by :func:`~sticky_pi_ml.tuboid.TiledTuboid.from_tuboid`: either a directory, with a mosaic
+        of tiles, a context image and a metadata file, or an entry in a pack
+        (see :mod:`~sticky_pi_ml.tuboid_pack`).
+
+        :param tuboid_dir: the directory of the tuboid. For a packed tuboid, ``<pack path>/<tuboid name>``
+        :param pack_entry: the entry of a packed tuboid. ``None`` to read a directory
+        """
         super().__init__()
         self._tuboid_dir = os.path.normpath(tuboid_dir)
+        self._pack_entry = pack_entry
+        self._md5 = None if pack_entry is None else pack_entry['md5']
 
         fields = os.path.basename(self._tuboid_dir).split('.')
         if len(fields) == 5:
@@ -150,28 +184,55 @@ class TiledTuboid(list):
 
         self._n_tiles = 0
 
-        with open(os.path.join(self._tuboid_dir, self.metadata_tuboid_filename), 'r') as f:
-            while True:
-                line = f.readline().rstrip()
-                if not line:
-                    break
-                prefix, center_real, center_imag, scale = line.split(',')
-                device, annotation_datetime = prefix.split('.')
-                annotation_datetime = string_to_datetime(annotation_datetime)
-                assert device == self._device
-                if first_shot_datetime is None:
-                    first_shot_datetime = annotation_datetime
-                if (annotation_datetime - first_shot_datetime).total_seconds() <= self._max_tuboid_duration:
-                    self._n_tiles += 1
-                center = float(center_real) + 01j * float(center_imag)
-                scale = float(scale)
-                o = {'datetime': annotation_datetime, 'center': center, 'scale': scale}
-                self.append(o)
+        if pack_entry is None:
+            self._metadata = []
+            with open(os.path.join(self._tuboid_dir, self.metadata_tuboid_filename), 'r') as f:
+                while True:
+                    line = f.readline().rstrip()
+                    if not line:
+                        break
+                    prefix, center_real, center_imag, scale = line.split(',')
+                    self._metadata.append((prefix, float(center_real), float(center_imag), float(scale)))
+        else:
+            self._metadata = pack_entry['metadata']
+
+        for prefix, center_real, center_imag, scale in self._metadata:
+            device, annotation_datetime = prefix.split('.')
+            annotation_datetime = string_to_datetime(annotation_datetime)
+            assert device == self._device
+            if first_shot_datetime is None:
+                first_shot_datetime = annotation_datetime
+            if (annotation_datetime - first_shot_datetime).total_seconds() <= self._max_tuboid_duration:
+                self._n_tiles += 1
+            center = center_real + 01j * center_imag
+            o = {'datetime': annotation_datetime, 'center': center, 'scale': scale}
+            self.append(o)
         assert self._n_tiles > 1, f'Only {self._n_tiles} tiles found. need at least 2'
+        assert pack_entry is None or len(pack_entry['tiles']) == self._n_tiles
+
+    @classmethod
+    def set_mosaic_cache(cls, max_bytes: int = None):
+        """
+        Sets a least recently used cache of decoded mosaics, shared by all tiled tuboids
+        (e.g. so that a training set is not decoded at every epoch).
+
+        :param max_bytes: the size of the cache, in bytes. ``None`` to disable the cache
+        """
+        if max_bytes is None:
+            cls._mosaic_cache = None
+        else:
+            cls._mosaic_cache = BoundedCache(max_bytes=max_bytes,
+                                             sizeof=lambda x: x.nbytes if isinstance(x, np.ndarray) else sys.getsizeof(x))
+
+    @classmethod
+    def mosaic_cache(cls) -> BoundedCache:
+        return cls._mosaic_cache
 
     @property
     def md5(self):
-        return md5(os.path.join(self._tuboid_dir, self.metadata_tuboid_filename))
+        if self._md5 is None:
+            self._md5 = md5(os.path.join(self._tuboid_dir, self.metadata_tuboid_filename))
+        return self._md5
 
     @property
     def n_tiles(self):
@@ -181,62 +242,159 @@ class TiledTuboid(list):
     def directory(self):
         return self._tuboid_dir
 
+    @property
+    def pack_path(self) -> str:
+        """
+        :return: the path of the pack of the tuboid. ``None`` if the tuboid is a directory
+        """
+        return None if self._pack_entry is None else self._pack_entry['path']
+
     def iter_tiles(self):
-        for i in range(self._n_tiles):
-            yield self.get_tile(i)
+        if self._pack_entry is not None:
+            # packed tiles are decoded individually, as they are needed
+            for i in range(self._n_tiles):
+                yield self.get_tile(i)
+        else:
+            for tile in self.get_tiles(range(self._n_tiles)):
+                yield tile
 
     def get_scale(self, item: int) -> float:
         return self[item]['scale']
 
-    def get_tile(self, item: int) -> np.ndarray:
-        assert item < self._n_tiles
-        row = item // 4
-        col = item % 4
-        im = cv2.imread(os.path.join(self._tuboid_dir, self.tiles_tuboid_filename))
-        tile = im[row * self._tile_width: row * self._tile_width + self._tile_width,
-                  col * self._tile_width: col * self._tile_width + self._tile_width,
-                  :]
-
-        out = copy.deepcopy(self[item])
-        out['array'] = tile
+    def read_mosaic(self) -> np.ndarray:
+        """
+        :return: the decoded mosaic of all tiles, from the shared cache when it is enabled.
+            It must not be modified, as it may be shared
+        """
+        if self._pack_entry is not None:
+            return self._tiles_to_mosaic(self._read_packed_tiles(range(self._n_tiles)))
+        if self._mosaic_cache is None:
+            return cv2.imread(os.path.join(self._tuboid_dir, self.tiles_tuboid_filename))
+        key = self._tuboid_dir, self.md5
+        mosaic = self._mosaic_cache.get(key)
+        if mosaic is None:
+            mosaic = cv2.imread(os.path.join(self._tuboid_dir, self.tiles_tuboid_filename))
+            self._mosaic_cache.put(key, mosaic)
+        return mosaic
+
+    def get_tiles(self, items: List[int]) -> List[Dict[str, Any]]:
+        """
+        Reads several tiles, decoding the mosaic only once (or, for a packed tuboid, only the tiles requested).
+
+        :param items: the indices of the tiles
+        :return: for each tile, its metadata and its ``'array'``. The arrays must not be modified, as they may be
+            shared (e.g. views of the mosaic)
+        """
+        items = list(items)
+        for i in items:
+            assert i < self._n_tiles
+        if self._pack_entry is not None:
+            arrays = self._read_packed_tiles(items)
+        else:
+            mosaic = self.read_mosaic()
+            w = self._tile_width
+            arrays = [mosaic[(i // 4) * w: (i // 4) * w + w, (i % 4) * w: (i % 4) * w + w, :] for i in items]
+        # metadata values are immutable, so a shallow copy is enough
+        out = []
+        for i, array in zip(items, arrays):
+            tile = dict(self[i])
+            tile['array'] = array
+            out.append(tile)
         return out
 
+    def get_tile(self, item: int) -> Dict[str, Any]:
+        return self.get_tiles([item])[0]
+
+    def _read_packed_tiles(self, items: List[int]) -> List[np.ndarray]:
+        decoded = {}
+        if self._mosaic_cache is not None:
+            for i in set(items):
+                array = self._mosaic_cache.get((self._tuboid_dir, self.md5, i))
+                if array is not None:
+                    decoded[i] = array
+        missing = sorted(set(items) - set(decoded.keys()))
+        blobs = read_blobs(self._pack_entry['path'], [self._pack_entry['tiles'][i] for i in missing])
+        for i, blob in zip(missing, blobs):
+            decoded[i] = cv2.imdecode(np.frombuffer(blob, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if self._mosaic_cache is not None:
+                self._mosaic_cache.put((self._tuboid_dir, self.md5, i), decoded[i])
+        return [decoded[i] for i in items]
+
+    def _read_context(self) -> bytes:
+        if self._pack_entry is not None:
+            return read_blobs(self._pack_entry['path'], [self._pack_entry['context']])[0]
+        with open(os.path.join(self._tuboid_dir, self.context_tuboid_filename), 'rb') as f:
+            return f.read()
+
     @classmethod
-    def from_tuboid(cls, tuboid: Tuboid, tuboid_root_dir: str):
+    def _tiles_to_mosaic(cls, tiles: List[np.ndarray]) -> np.ndarray:
+        tile_width = cls._tile_width
+        n_rows = 1 + (len(tiles) - 1) // 4
+        out_array = np.zeros((n_rows * tile_width, tile_width * 4, 3), dtype=np.uint8)
+        for i, im in enumerate(tiles):
+            row = i // 4
+            col = i % 4
+            out_array[row * tile_width: row * tile_width + tile_width,
+                      col * tile_width: col * tile_width + tile_width,
+                      :] = im
+        return out_array
+
+    @classmethod
+    def _metadata_lines(cls, metadata: List[Tuple[str, float, float, float]]) -> List[str]:
+        return ["%s,%f,%f,%f\n" % m for m in metadata]
+
+    @classmethod
+    def _save(cls, name: str, metadata: List[Tuple[str, float, float, float]], tiles: List[np.ndarray],
+              context: bytes, tuboid_root_dir: str = None, pack: TuboidPackWriter = None,
+              md5_: str = None) -> 'TiledTuboid':
+        metadata_lines = cls._metadata_lines(metadata)
+        if pack is not None:
+            if md5_ is None:
+                md5_ = hashlib.md5(''.join(metadata_lines).encode()).hexdigest()
+            encoded_tiles = [cv2.imencode('.jpg', t, params=cls._tiles_encode_param)[1].tobytes() for t in tiles]
+            entry = pack.add(name, md5_, metadata, encoded_tiles, context)
+            return TiledTuboid(os.path.join(pack.path, name), pack_entry=entry)
 
-        assert tuboid.parent_series is not None
         assert os.path.isdir(tuboid_root_dir)
+        series_id = name.rsplit('.', 1)[0]
+        tuboid_dir = os.path.join(tuboid_root_dir, series_id, name)
+        os.makedirs(tuboid_dir, exist_ok=True)
+        with open(os.path.join(tuboid_dir, cls.metadata_tuboid_filename), 'w') as f:
+            f.writelines(metadata_lines)
+        cv2.imwrite(os.path.join(tuboid_dir, cls.tiles_tuboid_filename), cls._tiles_to_mosaic(tiles),
+                    params=cls._tiles_encode_param)
+        with open(os.path.join(tuboid_dir, cls.context_tuboid_filename), 'wb') as f:
+            f.write(context)
+        return TiledTuboid(tuboid_dir)
+
+    @classmethod
+    def from_tuboid(cls, tuboid: Tuboid, tuboid_root_dir: str = None, pack: TuboidPackWriter = None):
+        """
+        Saves a tuboid, either as a directory, in ``<tuboid_root_dir>/<series id>/``, or in a pack.
+
+        :param tuboid: a tuboid, with a parent series
+        :param tuboid_root_dir: the root directory of the tuboid directories
+        :param pack: a pack to write the tuboid in, instead of a directory
+        :return: the saved tuboid
+        """
+        assert tuboid.parent_series is not None
+        assert (tuboid_root_dir is None) != (pack is None), 'Exactly one of `tuboid_root_dir` and `pack` is needed'
 
         tile_width = cls._tile_width
 
         series_id = tuboid.parent_series.name + '.' + tuboid.matcher_version
-        tuboid_dir = "%s.%04d" % (series_id, tuboid.id)
-        # tempdir = tempfile.mkdtemp()
-
-        tuboid_dir = os.path.join(tuboid_root_dir, series_id, tuboid_dir)
-        os.makedirs(tuboid_dir, exist_ok=True)
+        name = "%s.%04d" % (series_id, tuboid.id)
 
         # we only save the first day of images
         images_to_save = []
-        metadata_lines = []
+        metadata = []
         for i, (im, par_im, scale, center) in enumerate(tuboid.all_annotation_sub_images(scale_width=tile_width)):
             prefix = os.path.splitext(par_im.filename)[0]
-            metadata_lines.append("%s,%f,%f,%f\n" % (prefix, center.real, center.imag, scale))
+            metadata.append((prefix, center.real, center.imag, scale))
             if (tuboid[i].datetime - tuboid.head_datetime).total_seconds() <= cls._max_tuboid_duration:
                 images_to_save.append(im)
 
-        assert len(metadata_lines) > 2
-
-        n_to_save = len(images_to_save)
-        n_rows = 1 + (n_to_save - 1) // 4
-        out_array = np.zeros((n_rows * tile_width, tile_width * 4, 3), dtype=np.uint8)
-
-        for i, im in enumerate(images_to_save):
-            row = i // 4
-            col = i % 4
-            out_array[row * cls._tile_width: row * cls._tile_width + cls._tile_width,
-                      col * cls._tile_width: col * cls._tile_width + cls._tile_width,
-                      :] = im
+        assert len(metadata) > 2
 
         arr = np.copy(tuboid.head.parent_image_array(cache=False))
         bbox = tuboid.head.bbox
@@ -244,16 +402,47 @@ class TiledTuboid(list):
                       thickness=7)
         cv2.rectangle(arr, (bbox[0], bbox[1]), (bbox[0] + bbox[2], bbox[1] + bbox[3]), color=(255, 255, 0),
                       thickness=4)
+        context = cv2.imencode('.jpg', arr, params=cls._context_encode_param)[1].tobytes()
 
-        with open(os.path.join(tuboid_dir, cls.metadata_tuboid_filename), 'w') as f:
-            f.writelines(metadata_lines)
-
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 100]
-        cv2.imwrite(os.path.join(tuboid_dir, cls.tiles_tuboid_filename), out_array,
-                    params=encode_param)
+        return cls._save(name, metadata, images_to_save, context, tuboid_root_dir=tuboid_root_dir, pack=pack)
 
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
-        cv2.imwrite(os.path.join(tuboid_dir, cls.context_tuboid_filename), arr,
-                    params=encode_param)
+    @classmethod
+    def from_pack(cls, path: str) -> List['TiledTuboid']:
+        """
+        :param path: the path of a pack
+        :return: all the tuboids of the pack
+        """
+        reader = TuboidPackReader(path)
+        out = []
+        for i in range(len(reader)):
+            entry = reader.entry(i)
+            out.append(TiledTuboid(os.path.join(reader.path, entry['name']), pack_entry=entry))
+        return out
 
-        return TiledTuboid(tuboid_dir)
+    def to_pack(self, pack: TuboidPackWriter) -> 'TiledTuboid':
+        """
+        Copies this tuboid in a pack. Tiles are decoded and re-encoded individually.
+
+        :param pack: a pack to write the tuboid in
+        :return: the packed tuboid
+        """
+        return self._save(os.path.basename(self._tuboid_dir), self._metadata,
+                          [t['array'] for t in self.iter_tiles()], self._read_context(), pack=pack, md5_=self.md5)
+
+    def to_directory(self, tuboid_root_dir: str) -> 'TiledTuboid':
+        """
+        Copies this tuboid as a directory, in ``<tuboid_root_dir>/<series id>/``.
+
+        :param tuboid_root_dir: the root directory of the tuboid directories
+        :return: the tuboid directory
+        """
+        name = os.path.basename(self._tuboid_dir)
+        if self._pack_entry is None:
+            tuboid_dir = os.path.join(tuboid_root_dir, name.rsplit('.', 1)[0], name)
+            shutil.copytree(self._tuboid_dir, tuboid_dir)
+            return TiledTuboid(tuboid_dir)
+        out = self._save(name, self._metadata, self._read_packed_tiles(range(self._n_tiles)), self._read_context(),
+                         tuboid_root_dir=tuboid_root_dir)
+        if out.md5 != self.md5:
+            logging.warning('The metadata of %s was not saved as in its original file (different md5)' % name)
+        return out
@@ -0,0 +1,181 @@
+"""
+A single-file container for the tiled tuboids of a series, as an alternative to one directory per tuboid.
+
+The file is made of a fixed header, the encoded images (one per tile, and one context image per tuboid),
+then an index: a table of columns (numpy arrays, stored as an uncompressed ``npz``) with
+
+* one row per tuboid: ``tuboid_name``, ``tuboid_md5``, ``tuboid_first_row``, ``tuboid_n_rows``,
+  ``tuboid_context_offset``, ``tuboid_context_length``;
+* one row per line of the tuboid metadata: ``prefix``, ``center_real``, ``center_imag``, ``scale``,
+  ``tile_offset``, ``tile_length`` (a length of 0 when the line has no tile).
+
+The header holds the position of the index, so any image can be read with a single seek.
+"""
+
+import io
+import os
+import struct
+import numpy as np
+from typing import Dict, List, Any, Tuple
+
+PACK_EXTENSION = '.tuboids'
+_MAGIC = b'STPITUB\x00'
+_FORMAT_VERSION = 1
+# magic, version, index offset, index length
+_HEADER = struct.Struct('<8sIQQ')
+
+_TUBOID_COLUMNS = ('tuboid_name', 'tuboid_md5', 'tuboid_first_row', 'tuboid_n_rows',
+                   'tuboid_context_offset', 'tuboid_context_length')
+_ROW_COLUMNS = ('prefix', 'center_real', 'center_imag', 'scale', 'tile_offset', 'tile_length')
+_COLUMN_TYPES = {'tuboid_name': np.str_, 'tuboid_md5': np.str_,
+                 'tuboid_first_row': np.int64, 'tuboid_n_rows': np.int64,
+                 'tuboid_context_offset': np.uint64, 'tuboid_context_length': np.uint64,
+                 'prefix': np.str_, 'center_real': np.float64, 'center_imag': np.float64, 'scale': np.float64,
+                 'tile_offset': np.uint64, 'tile_length': np.uint64}
+
+
+class TuboidPackWriter(object):
+    def __init__(self, path: str):
+        """
+        Writes tuboids in a new pack. Images are written as they are added; the index when the writer is closed.
+        Tuboids can be read back, from their entries, before the pack is closed.
+
+        :param path: the path of the pack file. It is overwritten
+        """
+        self._path = os.path.normpath(path)
+        self._file = open(self._path, 'wb')
+        self._file.write(_HEADER.pack(_MAGIC, _FORMAT_VERSION, 0, 0))
+        self._columns = {c: [] for c in _TUBOID_COLUMNS + _ROW_COLUMNS}
+        self._names = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._names)
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def _write(self, data: bytes) -> Tuple[int, int]:
+        offset = self._file.tell()
+        self._file.write(data)
+        return offset, len(data)
+
+    def add(self, name: str, md5: str, metadata: List[Tuple[str, float, float, float]], tiles: List[bytes],
+            context: bytes) -> Dict[str, Any]:
+        """
+        :param name: the name of the tuboid, as its directory name
+        :param md5: the md5 of the tuboid metadata file
+        :param metadata: the metadata lines, as ``(prefix, center real, center imaginary, scale)``
+        :param tiles: the encoded tiles, for the first lines of the metadata
+        :param context: the encoded context image
+        :return: the entry of the tuboid, see :func:`~sticky_pi_ml.tuboid_pack.TuboidPackReader.entry`
+        """
+        assert name not in self._names, 'Tuboid %s is already in %s' % (name, self._path)
+        assert len(tiles) <= len(metadata)
+        cols = self._columns
+        cols['tuboid_name'].append(name)
+        cols['tuboid_md5'].append(md5)
+        cols['tuboid_first_row'].append(len(cols['prefix']))
+        cols['tuboid_n_rows'].append(len(metadata))
+        for c, v in zip(('tuboid_context_offset', 'tuboid_context_length'), self._write(context)):
+            cols[c].append(v)
+        for i, (prefix, center_real, center_imag, scale) in enumerate(metadata):
+            cols['prefix'].append(prefix)
+            cols['center_real'].append(center_real)
+            cols['center_imag'].append(center_imag)
+            cols['scale'].append(scale)
+            offset, length = self._write(tiles[i]) if i < len(tiles) else (0, 0)
+            cols['tile_offset'].append(offset)
+            cols['tile_length'].append(length)
+        self._names.add(name)
+        # so that the images can be read while writing
+        self._file.flush()
+        return _entry(self._path, {c: np.array(cols[c][-1:], dtype=_COLUMN_TYPES[c]) for c in _TUBOID_COLUMNS},
+                      {c: np.array(cols[c][-len(metadata):], dtype=_COLUMN_TYPES[c]) for c in _ROW_COLUMNS}, 0)
+
+    def close(self):
+        if self._file.closed:
+            return
+        buffer = io.BytesIO()
+        np.savez(buffer, **{c: np.array(v, dtype=_COLUMN_TYPES[c]) for c, v in self._columns.items()})
+        index_offset, index_length = self._write(buffer.getvalue())
+        self._file.seek(0)
+        self._file.write(_HEADER.pack(_MAGIC, _FORMAT_VERSION, index_offset, index_length))
+        self._file.close()
+
+
+class TuboidPackReader(object):
+    def __init__(self, path: str):
+        """
+        Reads the index of a closed pack.
+
+        :param path: the path of the pack file
+        """
+        self._path = os.path.normpath(path)
+        with open(self._path, 'rb') as f:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                raise ValueError('Not a tuboid pack: %s' % self._path)
+            magic, version, index_offset, index_length = _HEADER.unpack(header)
+            if magic != _MAGIC:
+                raise ValueError('Not a tuboid pack: %s' % self._path)
+            if version != _FORMAT_VERSION:
+                raise ValueError('Unsupported tuboid pack version %i in %s' % (version, self._path))
+            if index_offset == 0:
+                raise ValueError('Tuboid pack %s was not closed' % self._path)
+            f.seek(index_offset)
+            index = np.load(io.BytesIO(f.read(index_length)), allow_pickle=False)
+            self._tuboids = {c: index[c] for c in _TUBOID_COLUMNS}
+            self._rows = {c: index[c] for c in _ROW_COLUMNS}
+
+    def __len__(self):
+        return len(self._tuboids['tuboid_name'])
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def names(self) -> List[str]:
+        return self._tuboids['tuboid_name'].tolist()
+
+    def entry(self, i: int) -> Dict[str, Any]:
+        """
+        :param i: the position of a tuboid in the pack
+        :return: a dictionary with the ``'path'`` of the pack, and the ``'name'``, ``'md5'``, ``'metadata'``,
+            ``'tiles'`` (offsets and lengths) and ``'context'`` (offset and length) of the tuboid
+        """
+        first = int(self._tuboids['tuboid_first_row'][i])
+        n_rows = int(self._tuboids['tuboid_n_rows'][i])
+        return _entry(self._path, self._tuboids, {c: v[first: first + n_rows] for c, v in self._rows.items()}, i)
+
+
+def _entry(path: str, tuboids: Dict[str, np.ndarray], rows: Dict[str, np.ndarray], i: int) -> Dict[str, Any]:
+    n_tiles = int(np.count_nonzero(rows['tile_length']))
+    return {'path': path,
+            'name': str(tuboids['tuboid_name'][i]),
+            'md5': str(tuboids['tuboid_md5'][i]),
+            'metadata': list(zip(rows['prefix'].tolist(), rows['center_real'].tolist(),
+                                 rows['center_imag'].tolist(), rows['scale'].tolist())),
+            'tiles': list(zip(rows['tile_offset'][:n_tiles].tolist(), rows['tile_length'][:n_tiles].tolist())),
+            'context': (int(tuboids['tuboid_context_offset'][i]), int(tuboids['tuboid_context_length'][i]))}
+
+
+def read_blobs(path: str, blobs: List[Tuple[int, int]]) -> List[bytes]:
+    """
+    :param path: the path of a pack
+    :param blobs: the offsets and lengths of encoded images
+    :return: the encoded images
+    """
+    out = []
+    with open(path, 'rb') as f:
+        for offset, length in blobs:
+            f.seek(offset)
+            out.append(f.read(length))
+    return out
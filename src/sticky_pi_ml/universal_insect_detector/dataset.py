@@ -42,7 +42,7 @@ except ImportError:
 from detectron2.structures import BoxMode
 from detectron2.data import DatasetCatalog, MetadataCatalog
 from sticky_pi_ml.dataset import BaseDataset
-from sticky_pi_ml.image import SVGImage
+from sticky_pi_ml.image import SVGImage, Image as StickyPiImage
 from sticky_pi_ml.utils import md5
 from sticky_pi_ml.universal_insect_detector.palette import Palette
 
@@ -114,7 +114,8 @@ def _parse_one_image(svg_file, cache_dir, palette, config):
     with open(pre_extracted_jpg, 'rb') as im_file:
         md5_sum = md5(im_file)
     # todo file can be a MEMORY BUFFER
-    h, w, _ = cv2.imread(pre_extracted_jpg).shape
+    # the shape is read from the jpeg header, without decoding it
+    h, w, _ = StickyPiImage(pre_extracted_jpg, foreign=True).shape
 
     im_dic = {'file_name': pre_extracted_jpg,
               'height': h,
@@ -1,8 +1,13 @@
 import requests
 import os
+import json
 import tempfile
 import shutil
 import math
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import cv2
 import numpy as np
@@ -15,9 +20,11 @@ from sticky_pi_ml.universal_insect_detector.ml_bundle import MLBundle
 from sticky_pi_ml.universal_insect_detector.palette import Palette
 from sticky_pi_ml.annotations import Annotation
 from sticky_pi_ml.image import Image
+from sticky_pi_ml.utils import BBoxGrid
+from sticky_pi_ml.work_queue import WorkQueue
 
 import pandas as pd
-from typing import Union
+from typing import Union, List, Tuple, Iterator
 
 try:
     from sticky_pi_ml.universal_insect_detector.ml_bundle import ClientMLBundle
@@ -33,16 +40,89 @@ except ImportError:
 
 class Predictor(BasePredictor):
     _detect_client_chunk_size = 64
+    _work_queue_filename = '.uid_work_queue.db'
     _minimum_tile_overlap = 500
     _score_threshold = 0.85
     _iou_threshold = 0.33
-
-    def __init__(self, ml_bundle: Ml_bundle_type):
+    _tile_width = 1024
+    # number of tiles sent to the detectron model in one forward pass
+    _tile_batch_size = 4
+    _merge_grid_cell_size = 256
+    # number of threads converting instance masks to polygons. cv2 releases the GIL
+    _n_postprocessing_threads = 4
+    # extra pixels around predicted boxes when cropping masks, so that dilation does not reach the crop border
+    _mask_crop_margin = 4
+
+    def __init__(self, ml_bundle: Ml_bundle_type, tile_batch_size: int = None, n_postprocessing_threads: int = None):
         super().__init__(ml_bundle)
+        if tile_batch_size is not None:
+            assert tile_batch_size > 0
+            self._tile_batch_size = tile_batch_size
+        if n_postprocessing_threads is not None:
+            assert n_postprocessing_threads > 0
+            self._n_postprocessing_threads = n_postprocessing_threads
+        self._postprocessing_pool = ThreadPoolExecutor(max_workers=self._n_postprocessing_threads)
+        self._pipeline_status = {}
         self._min_width = self._ml_bundle.config.MIN_MAX_OBJ_SIZE[0]
         self._palette = Palette({k: v for k, v in self._ml_bundle.config.CLASSES})
         self._detectron_predictor = DefaultPredictor(self._ml_bundle.config)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Stops the post-processing threads. The predictor cannot detect afterwards.
+        """
+        self._postprocessing_pool.shutdown(wait=True)
+
+    def _images_to_annotate(self, client, info: InfoType) -> pd.DataFrame:
+        """
+        :return: the metadata of the images in ``info`` that are not annotated by this algorithm/version yet
+        """
+        client_resp = client.get_images_with_uid_annotations_series(info, what_image='metadata',
+                                                                    what_annotation='metadata')
+
+        if len(client_resp) == 0:
+            return pd.DataFrame()
+
+        df = pd.DataFrame(client_resp)
+
+        if 'algo_name' not in df.columns:
+            logging.info('No annotations for the requested images. Fetching all!')
+            df['algo_version'] = None
+            df['algo_name'] = ""
+
+        df = df.sort_values(by=['algo_version', 'datetime'])
+        df = df.drop_duplicates(subset=['id'], keep='last')
+
+        # here, we filter/sort df to keep only images that are not annotated by this version.
+        # we sort by version tag
+
+        conditions = (self.version > df.algo_version) | \
+                     (df.algo_version.isnull()) | \
+                     (self.name != df.algo_name)
+
+        return df[conditions]
+
+    def _work_queue(self, client, info: InfoType) -> WorkQueue:
+        """
+        :return: the persistent queue of images left to annotate for this algorithm/version and ``info``.
+            If it does not exist yet, it is computed from the client, once.
+        """
+        signature = json.dumps({'name': self.name, 'version': self.version, 'info': info}, default=str,
+                               sort_keys=True)
+        work_queue = WorkQueue(os.path.join(self._ml_bundle.root_dir, self._work_queue_filename), signature)
+        if not work_queue.is_populated:
+            df = self._images_to_annotate(client, info)
+            work_queue.populate([df.iloc[i][['device', 'datetime']].to_dict() for i in range(len(df))])
+        else:
+            logging.info('Resuming from work queue %s: %i images left' % (work_queue.path, len(work_queue)))
+        return work_queue
+
     def detect_client(self, info: InfoType = None, *args, **kwargs):
         assert issubclass(type(self._ml_bundle), ClientMLBundle), \
             "This method only works for MLBundles linked to a client"
@@ -55,63 +135,220 @@ class Predictor(BasePredictor):
                      'end_datetime': "2070-01-01_00-00-00"}]
             logging.info('No info provided. Fetching all annotations')
         while True:
-            client_resp = client.get_images_with_uid_annotations_series(info, what_image='metadata',
-                                                                        what_annotation='metadata')
-
-            if len(client_resp) == 0:
+            work_queue = self._work_queue(client, info)
+            if len(work_queue) == 0:
+                work_queue.remove()
+                logging.info('All annotations uploaded!')
                 return
 
-            df = pd.DataFrame(client_resp)
-
-            if 'algo_name' not in df.columns:
-                logging.info('No annotations for the requested images. Fetching all!')
-                df['algo_version'] = None
-                df['algo_name'] = ""
-
-            df = df.sort_values(by=['algo_version', 'datetime'])
-            df = df.drop_duplicates(subset=['id'], keep='last')
-
-            # here, we filter/sort df to keep only images that are not annotated by this version.
-            # we sort by version tag
-
-            conditions = (self.version > df.algo_version) | \
-                         (df.algo_version.isnull()) | \
-                         (self.name != df.algo_name)
+            while True:
+                query = work_queue.pending(self._detect_client_chunk_size)
+                if len(query) == 0:
+                    break
+                self._detect_client_chunk(client, query, *args, **kwargs)
+                work_queue.mark_done(query)
+            # we scan the images again, in case new ones were added while we were processing the queue
+            work_queue.remove()
+
+    def _detect_client_chunk(self, client, query, *args, **kwargs):
+        image_data = client.get_images(info=query, what='image')
+        urls = [im['url'] for im in image_data]
+
+        all_annots = []
+        for u in urls:
+            temp_dir = None
+            try:
+                if not os.path.isfile(u):
+                    temp_dir = tempfile.mkdtemp()
+                    filename = os.path.basename(u).split('?')[0]
+                    resp = requests.get(u).content
+                    with open(os.path.join(temp_dir, filename), 'wb') as file:
+                        file.write(resp)
+                    u = os.path.join(temp_dir, filename)
+
+                im = Image(u)
+                annotated_im = self.detect(im, *args, **kwargs)
+                logging.info('Detecting in image %s' % im)
+                annots = annotated_im.annotation_dict(as_json=False)
+                all_annots.append(annots)
+                logging.info("Staging annotations: %s" % annotated_im)
+            finally:
+                if temp_dir:
+                    shutil.rmtree(temp_dir)
+
+        logging.info("Sending %i annotations to client" % len(all_annots))
+        client.put_uid_annotations(all_annots)
+
+    @property
+    def pipeline_status(self) -> dict:
+        """
+        The progress of the last (or current) :meth:`detect_client_pipelined` run:
+        number of images queued, downloaded, detected and uploaded, and the depth of the download and upload queues.
+        """
+        return dict(self._pipeline_status)
+
+    def detect_client_pipelined(self, info: InfoType = None, n_download_threads: int = 4,
+                                download_queue_size: int = 16, upload_chunk_size: int = 16, *args, **kwargs):
+        """
+        Same as :meth:`detect_client`, but network I/O overlaps with inference. Three stages run concurrently:
+
+        * download -- ``n_download_threads`` threads, each with its own pooled HTTP session, fetch images ahead of the
+          detector. At most ``download_queue_size`` images are in flight or waiting to be processed
+        * detection -- in the calling thread, in the order images were queued
+        * upload -- a thread sends annotations to the client ``upload_chunk_size`` images at a time
+
+        Progress and queue depths are available through :attr:`pipeline_status`.
+        """
+        assert issubclass(type(self._ml_bundle), ClientMLBundle), \
+            "This method only works for MLBundles linked to a client"
+        client = self._ml_bundle.client
+        # we do not assume the client is thread safe
+        client_lock = threading.Lock()
 
-            df = df[conditions]
-            if len(df) == 0:
-                logging.info('All annotations uploaded!')
-                return
+        if info is None:
+            info = [{'device': '%',
+                     'start_datetime': "1970-01-01_00-00-00",
+                     'end_datetime': "2070-01-01_00-00-00"}]
+            logging.info('No info provided. Fetching all annotations')
 
-            query = [df.iloc[i][['device', 'datetime']].to_dict() for i in
-                     range(min(len(df), self._detect_client_chunk_size))]
-            image_data = client.get_images(info=query, what='image')
-            urls = [im['url'] for im in image_data]
+        self._pipeline_status = {'n_queued': 0, 'n_downloaded': 0, 'n_detected': 0, 'n_uploaded': 0,
+                                 'download_queue_depth': 0, 'upload_queue_depth': 0}
+        status_lock = threading.Lock()
+        sessions = threading.local()
+        temp_dir = tempfile.mkdtemp()
+        download_queue = queue.Queue(maxsize=download_queue_size)
+        # contains annotation dicts, `threading.Event`s to request a flush, or `None` to flush and stop
+        upload_queue = queue.Queue()
+        stop = threading.Event()
+        errors = []
+
+        def increment_status(key, n=1):
+            with status_lock:
+                self._pipeline_status[key] += n
+                self._pipeline_status['download_queue_depth'] = download_queue.qsize()
+                self._pipeline_status['upload_queue_depth'] = upload_queue.qsize()
+
+        def download(url):
+            if os.path.isfile(url):
+                local = url
+            else:
+                if not hasattr(sessions, 'session'):
+                    sessions.session = requests.Session()
+                filename = os.path.basename(url).split('?')[0]
+                resp = sessions.session.get(url)
+                resp.raise_for_status()
+                local = os.path.join(temp_dir, filename)
+                with open(local, 'wb') as file:
+                    file.write(resp.content)
+            increment_status('n_downloaded')
+            return local
+
+        def put_until_stopped(item):
+            while not stop.is_set():
+                try:
+                    download_queue.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def feed(pending):
+            # resolve urls a chunk at a time, so signed urls do not expire while waiting in the queue
+            try:
+                for i in range(0, len(pending), self._detect_client_chunk_size):
+                    query = pending[i: i + self._detect_client_chunk_size]
+                    with client_lock:
+                        image_data = client.get_images(info=query, what='image')
+                    for im in image_data:
+                        if not put_until_stopped(download_pool.submit(download, im['url'])):
+                            return
+                        increment_status('n_queued')
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # not queued if the pipeline was stopped. The detection loop then stops on `errors`
+                put_until_stopped(None)
 
+        def upload():
             all_annots = []
-            for u in urls:
-                temp_dir = None
-                try:
-                    if not os.path.isfile(u):
-                        temp_dir = tempfile.mkdtemp()
-                        filename = os.path.basename(u).split('?')[0]
-                        resp = requests.get(u).content
-                        with open(os.path.join(temp_dir, filename), 'wb') as file:
-                            file.write(resp)
-                        u = os.path.join(temp_dir, filename)
-
-                    im = Image(u)
-                    annotated_im = self.detect(im, *args, **kwargs)
-                    logging.info('Detecting in image %s' % im)
-                    annots = annotated_im.annotation_dict(as_json=False)
-                    all_annots.append(annots)
-                    logging.info("Staging annotations: %s" % annotated_im)
-                finally:
-                    if temp_dir:
-                        shutil.rmtree(temp_dir)
-
-            logging.info("Sending %i annotations to client" % len(all_annots))
-            client.put_uid_annotations(all_annots)
+            try:
+                while True:
+                    item = upload_queue.get()
+                    if isinstance(item, dict):
+                        all_annots.append(item)
+                    if all_annots and (not isinstance(item, dict) or len(all_annots) >= upload_chunk_size):
+                        logging.info("Sending %i annotations to client" % len(all_annots))
+                        with client_lock:
+                            client.put_uid_annotations(all_annots)
+                        work_queue.mark_done([a['metadata'] for a in all_annots])
+                        increment_status('n_uploaded', len(all_annots))
+                        all_annots = []
+                    if isinstance(item, threading.Event):
+                        item.set()
+                    elif item is None:
+                        return
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+
+        download_pool = ThreadPoolExecutor(max_workers=n_download_threads)
+        with client_lock:
+            work_queue = self._work_queue(client, info)
+        uploader = threading.Thread(target=upload, daemon=True)
+        uploader.start()
+        try:
+            while not errors:
+                pending = work_queue.pending()
+                if len(pending) == 0:
+                    work_queue.remove()
+                    logging.info('All annotations uploaded!')
+                    break
+                logging.info('%i images to annotate' % len(pending))
+                feeder = threading.Thread(target=feed, args=(pending,), daemon=True)
+                feeder.start()
+                while not errors:
+                    # we do not wait for the sentinel alone, as the feeder may stop (e.g. if the upload fails) first
+                    try:
+                        future = download_queue.get(timeout=1)
+                    except queue.Empty:
+                        continue
+                    if future is None:
+                        break
+                    path = future.result()
+                    try:
+                        im = Image(path)
+                        logging.info('Detecting in image %s' % im)
+                        annotated_im = self.detect(im, *args, **kwargs)
+                        upload_queue.put(annotated_im.annotation_dict(as_json=False))
+                        logging.info("Staging annotations: %s" % annotated_im)
+                    finally:
+                        if os.path.dirname(path) == temp_dir:
+                            os.remove(path)
+                    increment_status('n_detected')
+                    logging.info('Pipeline status: %s' % self.pipeline_status)
+                if errors:
+                    # the feeder may be waiting for room in the queue
+                    stop.set()
+                feeder.join()
+                # all annotations of this round must be uploaded before we query the images left to annotate
+                flushed = threading.Event()
+                upload_queue.put(flushed)
+                while not flushed.wait(timeout=1) and uploader.is_alive():
+                    pass
+                if errors:
+                    break
+                # we scan the images again, in case new ones were added while we were processing the queue
+                work_queue.remove()
+                with client_lock:
+                    work_queue = self._work_queue(client, info)
+        finally:
+            stop.set()
+            upload_queue.put(None)
+            uploader.join()
+            download_pool.shutdown(wait=True)
+            shutil.rmtree(temp_dir)
+        if errors:
+            raise errors[0]
 
     def detect(self, image: Image, *args, **kwargs) -> Image:
 
@@ -121,6 +358,22 @@ class Predictor(BasePredictor):
         new_image.tag_detector_version(self._name, self.version)
         return new_image
 
+    def detect_batch(self, images: List[Image]) -> List[Image]:
+        """
+        Like :meth:`detect`, but for several images. The tiles of all images are pooled and sent to the
+        detectron model ``tile_batch_size`` at a time, so the batches stay full even at image boundaries.
+
+        :param images: a list of images to segment
+        :return: a list of annotated images, in the same order as ``images``
+        """
+        out = []
+        for image, instances in zip(images, self._detect_instances_batch(images)):
+            new_image = image.copy()
+            new_image.set_annotations(instances)
+            new_image.tag_detector_version(self._name, self.version)
+            out.append(new_image)
+        return out
+
     def _mask_to_polygons(self, mask, offset, dilate_kernel_size=3):
         mask = np.ascontiguousarray(mask.cpu())  # some versions of cv2 does not support incontiguous arr
         kernel = np.ones((dilate_kernel_size, dilate_kernel_size))
@@ -158,127 +411,168 @@ class Predictor(BasePredictor):
         largest_contour = np.argmax([cv2.contourArea(c) for c in contours])
         return contours[largest_contour]
 
-    def _detect_instances(self, img: Image):
-        polys = []
-        classes = []
-        logging.debug(img)
-
-        array = cv2.copyMakeBorder(img.read(),
-                                   self._ml_bundle.config.ORIGINAL_IMAGE_PADDING,
-                                   self._ml_bundle.config.ORIGINAL_IMAGE_PADDING,
-                                   self._ml_bundle.config.ORIGINAL_IMAGE_PADDING,
-                                   self._ml_bundle.config.ORIGINAL_IMAGE_PADDING,
-                                   cv2.BORDER_CONSTANT, value=(0, 0, 0))
-        # array = img.read()
-
-        # todo
-        # make exception to removing edge objects on the edge of the actual image
-        # think about what to do when object fully overlap as they come from multiple detections
-        # self intersecting contours :(
-
-        if array.shape[1] <= 1024:
+    def _pad_image(self, img: Image) -> np.ndarray:
+        return cv2.copyMakeBorder(img.read(),
+                                  self._ml_bundle.config.ORIGINAL_IMAGE_PADDING,
+                                  self._ml_bundle.config.ORIGINAL_IMAGE_PADDING,
+                                  self._ml_bundle.config.ORIGINAL_IMAGE_PADDING,
+                                  self._ml_bundle.config.ORIGINAL_IMAGE_PADDING,
+                                  cv2.BORDER_CONSTANT, value=(0, 0, 0))
+
+    def _tile_offsets(self, shape: Tuple[int, ...]) -> Tuple[List[Tuple[Tuple[int, int], Tuple[int, int]]], int, int]:
+        """
+        :param shape: the shape of the padded image
+        :return: ``(offsets, x_n_tiles, y_n_tiles)``. ``offsets`` is a list of ``((m, n), (x, y))``, where ``m, n`` are
+            the column and row index of a tile, and ``x, y`` the coordinates of its top left corner
+        """
+        tw = self._tile_width
+        if shape[1] <= tw:
             x_range = [0]
             x_n_tiles = 1
         else:
-            x_n_tiles = math.ceil(1 + (array.shape[1] - 1024) / (1024 - self._minimum_tile_overlap))
-            x_stride = (array.shape[1] - 1024) // (x_n_tiles - 1)
-            x_range = [r for r in range(0, array.shape[1] - 1023, x_stride)]
+            x_n_tiles = math.ceil(1 + (shape[1] - tw) / (tw - self._minimum_tile_overlap))
+            x_stride = (shape[1] - tw) // (x_n_tiles - 1)
+            x_range = [r for r in range(0, shape[1] - tw + 1, x_stride)]
 
-        if array.shape[0] <= 1024:
+        if shape[0] <= tw:
             y_range = [0]
             y_n_tiles = 1
 
         else:
-            y_n_tiles = math.ceil(1 + (array.shape[0] - 1024) / (1024 - self._minimum_tile_overlap))
-            y_stride = (array.shape[0] - 1024) // (y_n_tiles - 1)
-            y_range = [r for r in range(0, array.shape[0] - 1023, y_stride)]
+            y_n_tiles = math.ceil(1 + (shape[0] - tw) / (tw - self._minimum_tile_overlap))
+            y_stride = (shape[0] - tw) // (y_n_tiles - 1)
+            y_range = [r for r in range(0, shape[0] - tw + 1, y_stride)]
         offsets = []
         for n, j in enumerate(y_range):
             for m, i in enumerate(x_range):
                 offsets.append(((m, n), (i, j)))
-
-        for i, ((m, n), o) in enumerate(offsets):
-            logging.info(f"{img.filename}, {i}/{len(offsets)}")
-            im_1 = array[o[1]: (o[1] + 1024), o[0]: (o[0] + 1024)]
-            p = self._detectron_predictor(im_1)
-            p_bt = p['instances'].pred_boxes.tensor
-            big_enough = torch.zeros_like(p_bt[:, 0], dtype=torch.bool)
-            big_enough = big_enough.__or__(p_bt[:, 2] - p_bt[:, 0] > self._ml_bundle.config.MIN_MAX_OBJ_SIZE[0])
-            big_enough = big_enough.__or__(p_bt[:, 3] - p_bt[:, 1] > self._ml_bundle.config.MIN_MAX_OBJ_SIZE[0])
-
-            # print("Keeping, removing")
-            # print(sum(big_enough), len(big_enough))
-            # p['instances'] = p['instances'][big_enough]
-            # print(len(p['instances']))
-
-            # p_bt = p['instances'].pred_boxes.tensor
-
-            # p['instances'] = p['instances'][]
-            # we remove redundant edge instances as they should overlap
-            non_edge_cases = torch.ones_like(p_bt[:, 0], dtype=torch.bool)
-
-            if m > 0:
-                non_edge_cases = non_edge_cases.__and__(p_bt[:, 0] > 32)
-            if m < x_n_tiles - 1:
-                non_edge_cases = non_edge_cases.__and__(p_bt[:, 2] < 1024 - 32)
-
-            if n > 0:
-                non_edge_cases = non_edge_cases.__and__(p_bt[:, 1] > 32)
-            if n < y_n_tiles - 1:
-                non_edge_cases = non_edge_cases.__and__(p_bt[:, 3] < 1024 - 32)
-
-
-            p['instances'] = p['instances'][non_edge_cases.__and__(big_enough)]
-            p['instances'] = p['instances'][p['instances'].scores > self._score_threshold]
-            classes_for_one_inst = []
-            poly_for_one_inst = []
-
-            #fixme, this could be parallelised
-            for i in range(len(p['instances'])):
-                instance_offset = (o[0] - self._ml_bundle.config.ORIGINAL_IMAGE_PADDING,
-                                   o[1] - self._ml_bundle.config.ORIGINAL_IMAGE_PADDING)
-
-                poly = self._mask_to_polygons(p['instances'].pred_masks[i, :, :],
-                                              offset=instance_offset)
-                if poly is not None:
-                    poly_for_one_inst.append(poly)
-                    classes_for_one_inst.append(
-                        int(p['instances'].pred_classes[i]) + 1)  # as we want one-indexed classes
-            polys.append(poly_for_one_inst)
-            classes.append(classes_for_one_inst)
-
+        return offsets, x_n_tiles, y_n_tiles
+
+    def _predict_tiles(self, tiles: Iterator[np.ndarray]) -> Iterator[dict]:
+        """
+        Runs the detectron model over tiles, ``self._tile_batch_size`` at a time.
+        This reproduces ``DefaultPredictor.__call__``, but with a batch dimension.
+
+        :param tiles: an iterable of BGR arrays
+        :return: a generator of predictions (dictionaries with an ``'instances'`` field), one per tile, in order
+        """
+        predictor = self._detectron_predictor
+        # ``transform_gen`` was renamed ``aug`` in detectron2 v0.3
+        aug = predictor.aug if hasattr(predictor, 'aug') else predictor.transform_gen
+        batch = []
+
+        def run(batch):
+            with torch.no_grad():
+                return predictor.model(batch)
+
+        for tile in tiles:
+            if predictor.input_format == "RGB":
+                tile = tile[:, :, ::-1]
+            height, width = tile.shape[:2]
+            image = aug.get_transform(tile).apply_image(tile)
+            image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+            batch.append({"image": image, "height": height, "width": width})
+            if len(batch) == self._tile_batch_size:
+                yield from run(batch)
+                batch = []
+        if batch:
+            yield from run(batch)
+
+    def _tile_instances_to_polygons(self, p: dict, tile_index: Tuple[int, int], o: Tuple[int, int],
+                                    x_n_tiles: int, y_n_tiles: int) -> Tuple[List[np.ndarray], List[int]]:
+        m, n = tile_index
+        tw = self._tile_width
+        p_bt = p['instances'].pred_boxes.tensor
+        big_enough = torch.zeros_like(p_bt[:, 0], dtype=torch.bool)
+        big_enough = big_enough.__or__(p_bt[:, 2] - p_bt[:, 0] > self._ml_bundle.config.MIN_MAX_OBJ_SIZE[0])
+        big_enough = big_enough.__or__(p_bt[:, 3] - p_bt[:, 1] > self._ml_bundle.config.MIN_MAX_OBJ_SIZE[0])
+
+        # we remove redundant edge instances as they should overlap
+        non_edge_cases = torch.ones_like(p_bt[:, 0], dtype=torch.bool)
+
+        if m > 0:
+            non_edge_cases = non_edge_cases.__and__(p_bt[:, 0] > 32)
+        if m < x_n_tiles - 1:
+            non_edge_cases = non_edge_cases.__and__(p_bt[:, 2] < tw - 32)
+
+        if n > 0:
+            non_edge_cases = non_edge_cases.__and__(p_bt[:, 1] > 32)
+        if n < y_n_tiles - 1:
+            non_edge_cases = non_edge_cases.__and__(p_bt[:, 3] < tw - 32)
+
+        instances = p['instances'][non_edge_cases.__and__(big_enough)]
+        instances = instances[instances.scores > self._score_threshold]
+        # masks are cropped to their (padded) predicted box before they are moved to the cpu and dilated,
+        # so the cost of post-processing scales with the size of objects rather than the size of tiles
+        instance_offset = (o[0] - self._ml_bundle.config.ORIGINAL_IMAGE_PADDING,
+                           o[1] - self._ml_bundle.config.ORIGINAL_IMAGE_PADDING)
+        tile_h, tile_w = instances.pred_masks.shape[1:3]
+        margin = self._mask_crop_margin
+        crops = []
+        for i, box in enumerate(instances.pred_boxes.tensor.tolist()):
+            x0 = max(0, math.floor(box[0]) - margin)
+            y0 = max(0, math.floor(box[1]) - margin)
+            x1 = min(tile_w, math.ceil(box[2]) + margin + 1)
+            y1 = min(tile_h, math.ceil(box[3]) + margin + 1)
+            crops.append((instances.pred_masks[i, y0:y1, x0:x1],
+                          (instance_offset[0] + x0, instance_offset[1] + y0)))
+
+        polys = self._postprocessing_pool.map(lambda c: self._mask_to_polygons(c[0], offset=c[1]), crops)
+
+        classes_for_one_inst = []
+        poly_for_one_inst = []
+        pred_classes = instances.pred_classes.tolist()
+        for poly, pred_class in zip(polys, pred_classes):
+            if poly is not None:
+                poly_for_one_inst.append(poly)
+                classes_for_one_inst.append(pred_class + 1)  # as we want one-indexed classes
+        return poly_for_one_inst, classes_for_one_inst
+
+    def _merge_tile_polygons(self, img: Image, offsets, polys, classes) -> List[Annotation]:
         overlappers = []
         for i in range(len(offsets)):
             overlappers_sub = []
             for j in range(len(offsets)):
-                if i != j and abs(offsets[j][1][0] - offsets[i][1][0]) < 1024 and abs(
-                        offsets[j][1][1] - offsets[i][1][1]) < 1024:
+                if i != j and abs(offsets[j][1][0] - offsets[i][1][0]) < self._tile_width and abs(
+                        offsets[j][1][1] - offsets[i][1][1]) < self._tile_width:
                     overlappers_sub.append(j)
             overlappers.append(overlappers_sub)
 
         all_valid = []  # (origin, pred_class, poly)
+        valid_shapes = []
+        # accepted polygons are indexed by bounding box, so we only compute the exact iou of pairs that may overlap
+        grid = BBoxGrid(cell_size=self._merge_grid_cell_size)
+        n_valid_per_tile = [0] * len(offsets)
+        # pairs of polygons from overlapping tiles, the ones whose bounding boxes intersect, and the ones compared
+        n_pairs, n_candidates, n_tested = 0, 0, 0
 
         # merge predictions from several overlaping tiles
         for origin, poly_one_pred in enumerate(polys):
             for i, p1 in enumerate(poly_one_pred):
                 add = True
                 p_shape_1 = Polygon(np.squeeze(p1))
-                for v in all_valid:
-                    if origin not in overlappers[v[0]]:
-                        continue
-                    p2 = v[2]
-                    p_shape_2 = Polygon(np.squeeze(p2))
-
-                    # todo check bounding box overlap
+                bbox_1 = tuple(np.min(p1, axis=(0, 1))) + tuple(np.max(p1, axis=(0, 1)))
+                n_pairs += sum([n_valid_per_tile[j] for j in overlappers[origin]])
+                candidates = [k for k in grid.query(bbox_1) if origin in overlappers[all_valid[k][0]]]
+                n_candidates += len(candidates)
+                for k in candidates:
+                    p_shape_2 = valid_shapes[k]
+                    n_tested += 1
                     try:
                         iou = p_shape_1.intersection(p_shape_2).area / p_shape_1.union(p_shape_2).area
                     except Exception as e:
                         iou = 1  # fixme topological exception
                     if iou > self._iou_threshold:
                         add = False
-                        continue
+                        break
                 if add:
                     all_valid.append((origin, classes[origin][i], p1))
+                    valid_shapes.append(p_shape_1)
+                    grid.insert(bbox_1)
+                    n_valid_per_tile[origin] += 1
+
+        logging.info(f"{img.filename}: merging tiles, {n_pairs - n_candidates}/{n_pairs} polygon pairs pruned by "
+                     f"bounding box, {n_tested} compared")
         annotation_list = []
         for _, pred_class, poly in all_valid:
             stroke = self._palette.get_stroke_from_id(pred_class)
@@ -286,3 +580,41 @@ class Predictor(BasePredictor):
             a = Annotation(poly, parent_image=img, stroke_colour=stroke, name=class_name)
             annotation_list.append(a)
         return annotation_list
+
+    def _detect_instances(self, img: Image) -> List[Annotation]:
+        return self._detect_instances_batch([img])[0]
+
+    def _detect_instances_batch(self, images: List[Image]) -> List[List[Annotation]]:
+        # todo
+        # make exception to removing edge objects on the edge of the actual image
+        # think about what to do when object fully overlap as they come from multiple detections
+        # self intersecting contours :(
+
+        # we read and pad images lazily, so that only the images spanned by the current batch are in memory
+        tiling = [None] * len(images)
+        # (image index, tile index) of the tiles sent to the model, in order
+        tile_refs = deque()
+
+        def iter_tiles():
+            for k, img in enumerate(images):
+                logging.debug(img)
+                array = self._pad_image(img)
+                tiling[k] = self._tile_offsets(array.shape)
+                offsets = tiling[k][0]
+                for i, (_, o) in enumerate(offsets):
+                    logging.info(f"{img.filename}, {i}/{len(offsets)}")
+                    tile_refs.append((k, i))
+                    yield array[o[1]: (o[1] + self._tile_width), o[0]: (o[0] + self._tile_width)]
+
+        polys = [[] for _ in images]
+        classes = [[] for _ in images]
+        for p in self._predict_tiles(iter_tiles()):
+            k, i = tile_refs.popleft()
+            offsets, x_n_tiles, y_n_tiles = tiling[k]
+            tile_index, o = offsets[i]
+            poly_for_one_inst, classes_for_one_inst = self._tile_instances_to_polygons(p, tile_index, o,
+                                                                                       x_n_tiles, y_n_tiles)
+            polys[k].append(poly_for_one_inst)
+            classes[k].append(classes_for_one_inst)
+
+        return [self._merge_tile_polygons(img, tiling[k][0], polys[k], classes[k]) for k, img in enumerate(images)]
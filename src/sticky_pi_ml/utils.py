@@ -4,12 +4,15 @@ import dotenv
 import argparse
 import logging
 import hashlib
+import sys
+from collections import OrderedDict
 import numpy as np
 from shapely.geometry import Polygon
 import logging
 import cv2
-from typing import List, Tuple, Union, IO
+from typing import List, Tuple, Union, IO, Any, Callable, Dict, Hashable
 import datetime
+from sticky_pi_ml.assignment import assign
 
 STRING_DATETIME_FORMAT = '%Y-%m-%d_%H-%M-%S'
 
@@ -28,10 +31,11 @@ def md5(file: Union[IO, str], chunksize=32768):
     return hash_md5.hexdigest()
 
 
-def iou_match_pairs(arr: np.ndarray, iou_threshold: float) -> List[Tuple[int, int]]:
+def iou_match_pairs(arr: np.ndarray, iou_threshold: float, method: str = 'greedy') -> List[Tuple[int, int]]:
     """
     :param arr: a triangular 2d array containing iou values
     :param iou_threshold: the threshold under which two objects do not match
+    :param method: the assignment method, see :func:`sticky_pi_ml.assignment.assign`
     :return: A list of matched object, by index. None for no match.
     """
     pairs = []
@@ -46,11 +50,8 @@ def iou_match_pairs(arr: np.ndarray, iou_threshold: float) -> List[Tuple[int, in
     for i in im_not_in_gt:
         pairs.append((None, i))
 
-    while np.sum(arr) > 0:
-        i, j = np.unravel_index(arr.argmax(), arr.shape)
+    for i, j, _ in assign(arr, method):
         pairs.append((i, j))
-        arr[i, :] = 0
-        arr[:, j] = 0
     return pairs
 
 
@@ -86,6 +87,152 @@ def iou(poly1: Polygon, poly2: Polygon):
         return 0
 
 
+class BBoxGrid(object):
+    def __init__(self, cell_size: int = 256):
+        """
+        A uniform grid over axis-aligned bounding boxes, to find which boxes may overlap a query box without testing
+        all of them. Boxes can be inserted incrementally.
+
+        :param cell_size: the width of the (square) grid cells, in pixels
+        """
+        self._cell_size = cell_size
+        self._cells = {}
+        self._bboxes = []
+
+    def __len__(self):
+        return len(self._bboxes)
+
+    def _cells_of(self, bbox: Tuple[float, float, float, float]):
+        x0, y0, x1, y1 = [int(b // self._cell_size) for b in bbox]
+        for i in range(x0, x1 + 1):
+            for j in range(y0, y1 + 1):
+                yield i, j
+
+    def insert(self, bbox: Tuple[float, float, float, float]) -> int:
+        """
+        :param bbox: a box as ``(x_min, y_min, x_max, y_max)``
+        :return: the index of the inserted box
+        """
+        idx = len(self._bboxes)
+        self._bboxes.append(bbox)
+        for c in self._cells_of(bbox):
+            if c not in self._cells:
+                self._cells[c] = []
+            self._cells[c].append(idx)
+        return idx
+
+    def query(self, bbox: Tuple[float, float, float, float]) -> List[int]:
+        """
+        :param bbox: a box as ``(x_min, y_min, x_max, y_max)``
+        :return: the sorted indices of all inserted boxes that intersect ``bbox``
+        """
+        candidates = set()
+        for c in self._cells_of(bbox):
+            candidates.update(self._cells.get(c, []))
+        out = []
+        for k in sorted(candidates):
+            b = self._bboxes[k]
+            if b[0] <= bbox[2] and bbox[0] <= b[2] and b[1] <= bbox[3] and bbox[1] <= b[3]:
+                out.append(k)
+        return out
+
+
+class BoundedCache(object):
+    def __init__(self, max_entries: int = None, max_bytes: int = None, sizeof: Callable[[Any], int] = sys.getsizeof):
+        """
+        A least recently used cache, bounded in number of entries and/or bytes, that counts its hits, misses and
+        evictions. Keys can be grouped in scopes (e.g. one per image series), that are cleared together.
+        Unlike ``functools.lru_cache`` on methods, it does not keep references to the arguments, so keys should
+        be plain identifiers (e.g. ``Tuboid.uid``) rather than the objects themselves.
+
+        :param max_entries: the maximal number of entries. ``None`` for no limit
+        :param max_bytes: the maximal total size of the keys and values, as measured by ``sizeof``. ``None`` for no limit
+        :param sizeof: a function giving the size of a key or a value, in bytes
+        """
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._entries = OrderedDict()
+        self._scopes = {}
+        self._n_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ', '.join('%s=%i' % kv for kv in self.stats.items()))
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'entries': len(self._entries),
+                'bytes': self._n_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions}
+
+    def get(self, key: Hashable, scope: Hashable = None, default: Any = None) -> Any:
+        """
+        :param key: the key of the entry
+        :param scope: the scope of the entry
+        :param default: the value returned on a miss
+        :return: the cached value, or ``default``
+        """
+        try:
+            value, _ = self._entries[scope, key]
+        except KeyError:
+            self._misses += 1
+            return default
+        self._entries.move_to_end((scope, key))
+        self._hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any, scope: Hashable = None):
+        """
+        Adds, or replaces, an entry and evicts the least recently used ones until the cache fits in its limits.
+
+        :param key: the key of the entry
+        :param value: the value to cache
+        :param scope: the scope of the entry
+        """
+        self._remove((scope, key))
+        n_bytes = self._sizeof(key) + self._sizeof(value)
+        self._entries[scope, key] = value, n_bytes
+        self._scopes.setdefault(scope, set()).add(key)
+        self._n_bytes += n_bytes
+        while len(self._entries) > 0 and \
+                ((self._max_entries is not None and len(self._entries) > self._max_entries) or
+                 (self._max_bytes is not None and self._n_bytes > self._max_bytes)):
+            self._remove(next(iter(self._entries)))
+            self._evictions += 1
+
+    def clear(self, scope: Hashable = None, all_scopes: bool = False):
+        """
+        :param scope: the scope to remove the entries of
+        :param all_scopes: whether to remove all entries, regardless of ``scope``
+        """
+        if all_scopes:
+            self._entries.clear()
+            self._scopes.clear()
+            self._n_bytes = 0
+            return
+        for key in list(self._scopes.get(scope, [])):
+            self._remove((scope, key))
+
+    def _remove(self, scoped_key: Tuple[Hashable, Hashable]):
+        entry = self._entries.pop(scoped_key, None)
+        if entry is None:
+            return
+        scope, key = scoped_key
+        self._n_bytes -= entry[1]
+        keys = self._scopes[scope]
+        keys.discard(key)
+        if len(keys) == 0:
+            del self._scopes[scope]
+
+
 def detectron_to_pytorch_transform(Class):
     """
     Takes a transform class from detectron2 and return a regular pytorch transform class
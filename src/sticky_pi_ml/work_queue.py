@@ -0,0 +1,122 @@
+import os
+import sqlite3
+import logging
+import datetime
+from typing import List, Dict, Tuple
+
+from sticky_pi_ml.utils import datetime_to_string, string_to_datetime
+
+
+class WorkQueue(object):
+    _table_name = 'WORK_QUEUE'
+    _meta_table_name = 'WORK_QUEUE_META'
+
+    def __init__(self, path: str, signature: str):
+        """
+        A persistent list of images (as ``device``, ``datetime``) to process, stored in an sqlite file.
+        The queue is computed once, and items are checkpointed as they are done,
+        so that an interrupted job can resume without listing all the images again.
+
+        :param path: the sqlite file
+        :param signature: a string identifying the job (e.g. algorithm name, version and query).
+            An existing queue with a different signature is discarded
+        """
+        self._path = path
+        self._signature = signature
+        if os.path.isfile(self._path) and self._stored_signature() != self._signature:
+            logging.info('Work queue %s belongs to another job. Discarding it' % self._path)
+            self.remove()
+
+        conn = self._connect()
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS %s (device TEXT, datetime TEXT, done INTEGER, "
+                         "PRIMARY KEY (device, datetime))" % self._table_name)
+            conn.execute("CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value TEXT)" % self._meta_table_name)
+            conn.execute("INSERT OR IGNORE INTO %s VALUES ('signature', ?)" % self._meta_table_name, (self._signature,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # one connection per operation, so the queue can be used from several threads
+        return sqlite3.connect(self._path, timeout=60)
+
+    def _stored_signature(self):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT value FROM %s WHERE key = 'signature'" % self._meta_table_name).fetchone()[0]
+        except (sqlite3.DatabaseError, TypeError):
+            return None
+        finally:
+            conn.close()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def is_populated(self) -> bool:
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT value FROM %s WHERE key = 'populated'" %
+                                self._meta_table_name).fetchone() is not None
+        finally:
+            conn.close()
+
+    def populate(self, items: List[Dict]):
+        """
+        :param items: dictionaries with (at least) the fields ``device`` and ``datetime``
+        """
+        conn = self._connect()
+        try:
+            conn.executemany("INSERT OR IGNORE INTO %s VALUES (?, ?, 0)" % self._table_name,
+                             [self._key(it) for it in items])
+            conn.execute("INSERT OR REPLACE INTO %s VALUES ('populated', ?)" % self._meta_table_name,
+                         (datetime_to_string(datetime.datetime.now()),))
+            conn.commit()
+        finally:
+            conn.close()
+        logging.info('Work queue %s: %i items to process' % (self._path, len(self)))
+
+    def pending(self, n: int = None) -> List[Dict]:
+        """
+        :param n: the maximal number of items to return. All by default
+        :return: items that are not done yet, as dictionaries with the fields ``device`` and ``datetime``,
+            sorted by datetime
+        """
+        query = "SELECT device, datetime FROM %s WHERE done = 0 ORDER BY datetime, device" % self._table_name
+        if n is not None:
+            query += " LIMIT %i" % n
+        conn = self._connect()
+        try:
+            rows = conn.execute(query).fetchall()
+        finally:
+            conn.close()
+        return [{'device': d, 'datetime': string_to_datetime(t)} for d, t in rows]
+
+    def mark_done(self, items: List[Dict]):
+        conn = self._connect()
+        try:
+            conn.executemany("UPDATE %s SET done = 1 WHERE device = ? AND datetime = ?" % self._table_name,
+                             [self._key(it) for it in items])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def remove(self):
+        if os.path.isfile(self._path):
+            os.remove(self._path)
+
+    def __len__(self):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM %s WHERE done = 0" % self._table_name).fetchone()[0]
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _key(item: Dict) -> Tuple[str, str]:
+        dt = item['datetime']
+        if not isinstance(dt, str):
+            dt = datetime_to_string(dt)
+        return item['device'], dt